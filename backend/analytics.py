@@ -0,0 +1,917 @@
+"""Query builders for the dashboard analytics endpoints"""
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import Optional, List, Tuple
+
+from sqlalchemy import func, and_, or_, case, column, distinct, exists, select, table
+from sqlalchemy.orm import Session, aliased
+
+from models import (
+    AppRegistry, Event, EventHourly, EventDaily, PageHourly, PageDaily, RollupState,
+    Session as UserSession, UserFirstSeen
+)
+from sketches import HyperLogLog
+
+ROLLUP_NAME = "events"
+# rollup_state row of the first-seen backfill, which walks history backwards;
+# once its watermark reaches FIRST_SEEN_COMPLETE every event is reflected
+FIRST_SEEN_NAME = "first_seen"
+FIRST_SEEN_COMPLETE = datetime(1970, 1, 1)
+# rollup_state row recording the cutoff the app registry was seeded up to
+APP_REGISTRY_NAME = "app_registry"
+# rollup_state row of the sessionization job: events before it are in the session metrics
+SESSIONS_NAME = "sessions"
+# rollup_state row of partition retention: raw events before it were dropped
+RETENTION_NAME = "retention"
+# Materialized views of per-user activity per UTC day and per hour of the last
+# HOURLY_VIEW_HOURS hours; their rollup_state rows hold the last refresh time
+DAILY_VIEW = "mv_user_activity_daily"
+HOURLY_VIEW = "mv_user_activity_hourly"
+HOURLY_VIEW_HOURS = 48
+
+# Dimension values shared by raw event queries and the rollup tables
+event_app_name = Event.app_name
+event_domain = Event.domain
+event_country = func.coalesce(Event.country, 'Unknown')
+
+# Dimensions /api/analytics/breakdown groups by, with their raw event expression
+BREAKDOWN_DIMENSIONS = {
+    "page_url": Event.page_url,
+    "country": event_country,
+    "event_type": Event.event_type,
+    "app_name": event_app_name,
+}
+MAX_BREAKDOWN_VALUES = 100
+
+
+def app_filters(app_name: Optional[str] = None, domain: Optional[str] = None) -> list:
+    """Filters restricting events to a single app and/or domain"""
+    filters = []
+    if app_name:
+        filters.append(event_app_name == app_name)
+    if domain:
+        filters.append(event_domain == domain)
+    return filters
+
+
+def activity_view(name: str):
+    return table(
+        name, column("bucket"), column("app_name"), column("domain"),
+        column("user_id"), column("event_count"), column("conversions")
+    )
+
+
+daily_view = activity_view(DAILY_VIEW)
+hourly_view = activity_view(HOURLY_VIEW)
+
+
+def rollup_filters(model, app_name: Optional[str] = None, domain: Optional[str] = None) -> list:
+    """Filters restricting a rollup table to a single app and/or domain"""
+    filters = []
+    if app_name:
+        filters.append(model.app_name == app_name)
+    if domain:
+        filters.append(model.domain == domain)
+    return filters
+
+
+def scope_part(value):
+    """Escape ``\\`` and ``:`` in an app name or domain, so an app name holding
+    ':' cannot produce the scope of another (app, domain) pair
+
+    Works on plain strings and on SQL string expressions alike.
+    """
+    if isinstance(value, str):
+        return value.replace("\\", "\\\\").replace(":", "\\:")
+    return func.replace(func.replace(value, "\\", "\\\\"), ":", "\\:")
+
+
+def dimension_scopes(app_name: str, domain: str) -> Tuple[str, ...]:
+    """Scopes an event is counted in, one per filter the API accepts
+
+    Works on plain strings and on SQL string expressions alike.
+    """
+    app_name, domain = scope_part(app_name), scope_part(domain)
+    return ("_all", "app:" + app_name, "domain:" + domain, "app:" + app_name + ":" + domain)
+
+
+def filter_scope(app_name: Optional[str], domain: Optional[str]) -> str:
+    if app_name and domain:
+        return f"app:{scope_part(app_name)}:{scope_part(domain)}"
+    if app_name:
+        return f"app:{scope_part(app_name)}"
+    if domain:
+        return f"domain:{scope_part(domain)}"
+    return "_all"
+
+
+def utc_naive(value: datetime) -> datetime:
+    """Normalize to a naive UTC datetime, the representation of rollup buckets"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def as_utc(value: datetime) -> datetime:
+    """Attach UTC to a naive UTC datetime before comparing it with created_at"""
+    return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+
+def floor_hour(value: datetime) -> datetime:
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def ceil_hour(value: datetime) -> datetime:
+    floored = floor_hour(value)
+    return floored if floored == value else floored + timedelta(hours=1)
+
+
+def floor_day(value: datetime) -> datetime:
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def ceil_day(value: datetime) -> datetime:
+    floored = floor_day(value)
+    return floored if floored == value else floored + timedelta(days=1)
+
+
+def rollup_watermark(db: Session) -> Optional[datetime]:
+    """Every event before the returned UTC hour is aggregated into the rollups"""
+    state = db.get(RollupState, ROLLUP_NAME)
+    return state.rolled_up_to if state else None
+
+
+def retained_from(db: Session, start: Optional[datetime] = None) -> Optional[datetime]:
+    """UTC start of the raw events kept by retention when a range starting at
+    ``start`` reaches before it, i.e. when raw-event answers miss history"""
+    state = db.get(RollupState, RETENTION_NAME)
+    if state is None or (start is not None and utc_naive(start) >= state.rolled_up_to):
+        return None
+    return as_utc(state.rolled_up_to)
+
+
+def view_refreshed_at(db: Session, name: str) -> Optional[datetime]:
+    """UTC time of the last refresh of a materialized view, None if never refreshed"""
+    state = db.get(RollupState, name)
+    return state.rolled_up_to if state else None
+
+
+def summary_metrics(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    prev_start: datetime,
+    prev_end: datetime,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+) -> dict:
+    """Current and previous period metrics from one conditional-aggregation scan"""
+    start, end, prev_start, prev_end = map(as_utc, (start, end, prev_start, prev_end))
+    in_current = and_(Event.created_at >= start, Event.created_at <= end)
+    in_prev = and_(Event.created_at >= prev_start, Event.created_at <= prev_end)
+    is_conversion = Event.event_type == 'conversion'
+
+    row = db.query(
+        func.count(distinct(Event.user_id)).filter(in_current).label('total_users'),
+        func.count(Event.id).filter(in_current).label('event_count'),
+        func.count(Event.id).filter(and_(in_current, is_conversion)).label('conversions'),
+        func.count(distinct(Event.user_id)).filter(in_prev).label('prev_total_users'),
+        func.count(Event.id).filter(in_prev).label('prev_event_count'),
+        func.count(Event.id).filter(and_(in_prev, is_conversion)).label('prev_conversions'),
+    ).filter(
+        Event.created_at >= min(start, prev_start),
+        Event.created_at <= max(end, prev_end),
+        *app_filters(app_name, domain)
+    ).one()
+
+    metrics = {key: value or 0 for key, value in row._mapping.items()}
+    metrics["new_users"], metrics["prev_new_users"] = new_user_counts(
+        db, start, end, prev_start, prev_end, app_name=app_name, domain=domain
+    )
+
+    return metrics
+
+
+def new_user_counts(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    prev_start: datetime,
+    prev_end: datetime,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+) -> Tuple[int, int]:
+    """Users whose first event under the filter falls in the current and previous period
+
+    An index range count over user_first_seen once its backfill has covered
+    all history; until then a raw scan checking each active user for
+    earlier events.
+    """
+    start, end, prev_start, prev_end = map(as_utc, (start, end, prev_start, prev_end))
+    state = db.get(RollupState, FIRST_SEEN_NAME)
+    if state is None or state.rolled_up_to > FIRST_SEEN_COMPLETE:
+        return _new_user_counts_raw(db, start, end, prev_start, prev_end, app_name, domain)
+
+    first_seen = UserFirstSeen.first_seen
+    row = db.query(
+        func.count().filter(and_(first_seen >= start, first_seen <= end)),
+        func.count().filter(and_(first_seen >= prev_start, first_seen <= prev_end)),
+    ).filter(
+        UserFirstSeen.scope == filter_scope(app_name, domain),
+        first_seen >= min(start, prev_start),
+        first_seen <= max(end, prev_end)
+    ).one()
+    return row[0] or 0, row[1] or 0
+
+
+def _new_user_counts_raw(db, start, end, prev_start, prev_end, app_name, domain):
+    earlier = aliased(Event)
+
+    def seen_before(moment):
+        return exists(select(earlier.id).where(
+            earlier.user_id == Event.user_id,
+            earlier.created_at < moment,
+            *rollup_filters(earlier, app_name, domain)
+        ))
+
+    row = db.query(
+        func.count(distinct(Event.user_id)).filter(
+            and_(Event.created_at >= start, Event.created_at <= end, ~seen_before(start))
+        ),
+        func.count(distinct(Event.user_id)).filter(
+            and_(Event.created_at >= prev_start, Event.created_at <= prev_end, ~seen_before(prev_start))
+        ),
+    ).filter(
+        Event.created_at >= min(start, prev_start),
+        Event.created_at <= max(end, prev_end),
+        *app_filters(app_name, domain)
+    ).one()
+    return row[0] or 0, row[1] or 0
+
+
+def session_metrics(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    prev_start: datetime,
+    prev_end: datetime,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+) -> dict:
+    """Session count, average duration, bounce rate and pageviews per session
+    for sessions starting in the current and previous period
+
+    Read from the per-session columns the sessionization job maintains, so
+    sessions it has not reached yet (the last few minutes) are left out.
+    """
+    start, end, prev_start, prev_end = map(as_utc, (start, end, prev_start, prev_end))
+    metrics = {}
+    for prefix, lo, hi in (("", start, end), ("prev_", prev_start, prev_end)):
+        in_period = and_(UserSession.start_time >= lo, UserSession.start_time <= hi)
+        row = db.query(
+            func.count(),
+            func.avg(UserSession.duration_seconds),
+            func.avg(case((UserSession.bounced, 1.0), else_=0.0)),
+            func.avg(UserSession.pageviews)
+        ).filter(
+            in_period,
+            UserSession.event_count > 0,
+            *rollup_filters(UserSession, app_name, domain)
+        ).one()
+        metrics[f"{prefix}sessions"] = row[0] or 0
+        metrics[f"{prefix}avg_session_duration"] = round(float(row[1] or 0), 1)
+        metrics[f"{prefix}bounce_rate"] = round(float(row[2] or 0) * 100, 1)
+        metrics[f"{prefix}pages_per_session"] = round(float(row[3] or 0), 2)
+    return metrics
+
+
+def _rollup_plan(start: datetime, end: datetime, watermark: datetime):
+    """Split [start, end] into daily and hourly rollup ranges plus raw edges
+
+    Rollups only cover whole hours before the watermark, so the partial
+    hour at the start and everything after the watermark (the open bucket)
+    are read from raw events.
+    """
+    start, end = utc_naive(start), utc_naive(end)
+    covered_start = ceil_hour(start)
+    covered_end = min(floor_hour(end), watermark)
+    if covered_end <= covered_start:
+        return [], [], [(start, end)]
+
+    day_start, day_end = ceil_day(covered_start), floor_day(covered_end)
+    if day_start < day_end:
+        days = [(day_start, day_end)]
+        hours = [(covered_start, day_start), (day_end, covered_end)]
+    else:
+        days = []
+        hours = [(covered_start, covered_end)]
+    hours = [(lo, hi) for lo, hi in hours if lo < hi]
+
+    raw = [(covered_end, end)]
+    if start < covered_start:
+        raw.insert(0, (start, covered_start))
+    return days, hours, raw
+
+
+def _rollup_period(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    watermark: datetime,
+    app_name: Optional[str],
+    domain: Optional[str]
+):
+    """Distinct users, events and conversions for [start, end] from rollups plus raw edges"""
+    days, hours, raw = _rollup_plan(start, end, watermark)
+    users = HyperLogLog()
+    event_count = conversions = 0
+
+    for model, ranges in ((EventDaily, days), (EventHourly, hours)):
+        if not ranges:
+            continue
+        rows = db.query(model.event_type, model.event_count, model.users).filter(
+            or_(*[and_(model.bucket >= lo, model.bucket < hi) for lo, hi in ranges]),
+            *rollup_filters(model, app_name, domain)
+        ).all()
+        for event_type, count, sketch in rows:
+            event_count += count
+            if event_type == 'conversion':
+                conversions += count
+            users.merge_bytes(sketch)
+
+    row = db.query(
+        func.count(Event.id),
+        func.count(Event.id).filter(Event.event_type == 'conversion'),
+        func.array_agg(distinct(Event.user_id))
+    ).filter(
+        *_raw_edge_filters(raw),
+        *app_filters(app_name, domain)
+    ).one()
+    event_count += row[0] or 0
+    conversions += row[1] or 0
+    users.update(row[2] or [])
+
+    return users.count(), event_count, conversions
+
+
+def _raw_edge_filters(raw: list) -> list:
+    """Event filters for the raw edges of a ``_rollup_plan``"""
+    # Raw edges are half-open except the last one, which keeps the inclusive end
+    edges = [
+        and_(
+            Event.created_at >= as_utc(lo),
+            Event.created_at <= as_utc(hi) if index == len(raw) - 1 else Event.created_at < as_utc(hi)
+        )
+        for index, (lo, hi) in enumerate(raw)
+    ]
+    return [
+        # Outer bounds keep the OR of edges prunable to the partitions it touches
+        Event.created_at >= as_utc(raw[0][0]),
+        Event.created_at <= as_utc(raw[-1][1]),
+        or_(*edges)
+    ]
+
+
+def rollup_summary_metrics(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    prev_start: datetime,
+    prev_end: datetime,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+) -> dict:
+    """Same metrics as summary_metrics, read from the rollups for closed buckets
+
+    Event and conversion counts stay exact; distinct users come from merged
+    HyperLogLog sketches. Falls back to the raw scan until the rollup job
+    has run at least once.
+    """
+    watermark = rollup_watermark(db)
+    if watermark is None:
+        return summary_metrics(db, start, end, prev_start, prev_end, app_name=app_name, domain=domain)
+
+    total_users, event_count, conversions = _rollup_period(db, start, end, watermark, app_name, domain)
+    prev_total_users, prev_event_count, prev_conversions = _rollup_period(
+        db, prev_start, prev_end, watermark, app_name, domain
+    )
+
+    metrics = {
+        "total_users": total_users,
+        "event_count": event_count,
+        "conversions": conversions,
+        "prev_total_users": prev_total_users,
+        "prev_event_count": prev_event_count,
+        "prev_conversions": prev_conversions,
+    }
+
+    # Exact in both modes: first-seen times are stored per user
+    metrics["new_users"], metrics["prev_new_users"] = new_user_counts(
+        db, start, end, prev_start, prev_end, app_name=app_name, domain=domain
+    )
+
+    return metrics
+
+
+def build_summary(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None,
+    approximate: bool = True,
+    views: bool = False
+) -> dict:
+    """AnalyticsSummary payload: period metrics, changes against the previous
+    period of the same length, and the trend series
+
+    With ``views`` the user, event and conversion metrics and the trend come
+    from the materialized views once they have been refreshed, as of
+    ``data_as_of``; otherwise they are live.
+    """
+    # Calculate previous period for comparison
+    period_length = (end - start).days
+    prev_start = start - timedelta(days=period_length)
+    prev_end = start
+
+    source = "rollups" if approximate else "raw"
+    data_as_of = as_utc(datetime.utcnow())
+    compute_metrics = rollup_summary_metrics if approximate else summary_metrics
+    compute_trend = rollup_trend_series if approximate else trend_series
+
+    view = pick_activity_view(db, prev_start) if views else None
+    if view is not None:
+        view_table, step, refreshed_at = view
+        metrics = view_summary_metrics(
+            db, view_table, step, start, end, prev_start, prev_end, app_name=app_name, domain=domain
+        )
+        if _trend_buckets(start, end)[1] == step:
+            compute_trend = partial(view_trend_series, view=view_table)
+        source, data_as_of = "views", as_utc(refreshed_at)
+    else:
+        metrics = compute_metrics(db, start, end, prev_start, prev_end, app_name=app_name, domain=domain)
+
+    # Calculate percentage changes
+    def calc_change(current, previous):
+        if previous == 0:
+            return 100.0 if current > 0 else 0.0
+        return round(((current - previous) / previous) * 100, 1)
+
+    trend_data = compute_trend(db, start, end, app_name=app_name, domain=domain)
+    sessions = session_metrics(db, start, end, prev_start, prev_end, app_name=app_name, domain=domain)
+
+    return {
+        "total_users": metrics["total_users"],
+        "total_users_change": calc_change(metrics["total_users"], metrics["prev_total_users"]),
+        "event_count": metrics["event_count"],
+        "event_count_change": calc_change(metrics["event_count"], metrics["prev_event_count"]),
+        "conversions": metrics["conversions"],
+        "conversions_change": calc_change(metrics["conversions"], metrics["prev_conversions"]),
+        "new_users": metrics["new_users"],
+        "new_users_change": calc_change(metrics["new_users"], metrics["prev_new_users"]),
+        "sessions": sessions["sessions"],
+        "sessions_change": calc_change(sessions["sessions"], sessions["prev_sessions"]),
+        "avg_session_duration": sessions["avg_session_duration"],
+        "avg_session_duration_change": calc_change(
+            sessions["avg_session_duration"], sessions["prev_avg_session_duration"]
+        ),
+        "bounce_rate": sessions["bounce_rate"],
+        "bounce_rate_change": calc_change(sessions["bounce_rate"], sessions["prev_bounce_rate"]),
+        "pages_per_session": sessions["pages_per_session"],
+        "trend_data": trend_data,
+        "source": source,
+        "data_as_of": data_as_of,
+        # The rollups keep history past retention; raw events and the views do not
+        "retained_from": None if source == "rollups" else retained_from(db, prev_start)
+    }
+
+
+def pick_activity_view(db: Session, since: datetime) -> Optional[Tuple[object, timedelta, datetime]]:
+    """(view, bucket width, refresh time) of the activity view to read from
+    ``since`` on: the hourly view when it covers that far back, else the
+    daily one; None when neither has been refreshed"""
+    refreshed_at = view_refreshed_at(db, HOURLY_VIEW)
+    if refreshed_at is not None and floor_hour(utc_naive(since)) >= (
+        floor_hour(refreshed_at) - timedelta(hours=HOURLY_VIEW_HOURS)
+    ):
+        return hourly_view, timedelta(hours=1), refreshed_at
+    refreshed_at = view_refreshed_at(db, DAILY_VIEW)
+    if refreshed_at is not None:
+        return daily_view, timedelta(days=1), refreshed_at
+    return None
+
+
+def view_summary_metrics(
+    db: Session,
+    view,
+    step: timedelta,
+    start: datetime,
+    end: datetime,
+    prev_start: datetime,
+    prev_end: datetime,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+) -> dict:
+    """Same metrics as summary_metrics from an activity view, one row per
+    user and bucket; ranges widen to the buckets they touch"""
+    floor = floor_hour if step == timedelta(hours=1) else floor_day
+    start, end, prev_start, prev_end = map(utc_naive, (start, end, prev_start, prev_end))
+    in_current = and_(view.c.bucket >= floor(start), view.c.bucket <= end)
+    in_prev = and_(view.c.bucket >= floor(prev_start), view.c.bucket <= prev_end)
+
+    row = db.query(
+        func.count(distinct(view.c.user_id)).filter(in_current).label('total_users'),
+        func.sum(view.c.event_count).filter(in_current).label('event_count'),
+        func.sum(view.c.conversions).filter(in_current).label('conversions'),
+        func.count(distinct(view.c.user_id)).filter(in_prev).label('prev_total_users'),
+        func.sum(view.c.event_count).filter(in_prev).label('prev_event_count'),
+        func.sum(view.c.conversions).filter(in_prev).label('prev_conversions'),
+    ).filter(
+        view.c.bucket >= floor(min(start, prev_start)),
+        view.c.bucket <= max(end, prev_end),
+        *rollup_filters(view.c, app_name, domain)
+    ).one()
+
+    metrics = {key: int(value or 0) for key, value in row._mapping.items()}
+    metrics["new_users"], metrics["prev_new_users"] = new_user_counts(
+        db, start, end, prev_start, prev_end, app_name=app_name, domain=domain
+    )
+    return metrics
+
+
+def view_trend_series(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None,
+    view=daily_view
+) -> List[dict]:
+    """Distinct users per trend bucket from an activity view whose buckets
+    have the trend's width; daily trend buckets map to UTC days"""
+    buckets, step, label_format = _trend_buckets(start, end)
+    if not buckets:
+        return []
+
+    floor = floor_hour if step == timedelta(hours=1) else floor_day
+    origin = floor(utc_naive(buckets[0]))
+    rows = db.query(view.c.bucket, func.count(distinct(view.c.user_id))).filter(
+        view.c.bucket >= origin,
+        view.c.bucket < origin + len(buckets) * step,
+        *rollup_filters(view.c, app_name, domain)
+    ).group_by(view.c.bucket).all()
+    users_by_bucket = {int((bucket - origin) / step): users for bucket, users in rows}
+
+    return [
+        {
+            "date": bucket_start.strftime(label_format),
+            "users": users_by_bucket.get(index, 0)
+        }
+        for index, bucket_start in enumerate(buckets)
+    ]
+
+
+def _trend_buckets(start: datetime, end: datetime):
+    """Bucket starts, width and label format (hourly for <=24h, daily for longer periods)"""
+    period_hours = (end - start).total_seconds() / 3600
+
+    if period_hours <= 24:
+        origin = start.replace(minute=0, second=0, microsecond=0)
+        step = timedelta(hours=1)
+        label_format = "%Y-%m-%d %H:%M:%S"
+    else:
+        origin = start
+        step = timedelta(days=1)
+        label_format = "%Y-%m-%d"
+
+    buckets = []
+    current = origin
+    while current <= end:
+        buckets.append(current)
+        current += step
+    return buckets, step, label_format
+
+
+def _bucket_index(origin: datetime, step: timedelta):
+    """Bucket index relative to the first bucket, so daily buckets stay aligned
+    to the requested start time rather than to calendar days"""
+    return func.floor(
+        func.extract('epoch', Event.created_at - origin) / step.total_seconds()
+    ).label('bucket')
+
+
+def trend_series(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+) -> List[dict]:
+    """Exact distinct users per trend bucket from one grouped raw query"""
+    buckets, step, label_format = _trend_buckets(start, end)
+    if not buckets:
+        return []
+
+    bucket = _bucket_index(as_utc(buckets[0]), step)
+    rows = db.query(
+        bucket,
+        func.count(distinct(Event.user_id))
+    ).filter(
+        Event.created_at >= as_utc(buckets[0]),
+        Event.created_at < as_utc(buckets[-1] + step),
+        *app_filters(app_name, domain)
+    ).group_by(bucket).all()
+
+    users_by_bucket = {int(index): users for index, users in rows}
+
+    return [
+        {
+            "date": bucket_start.strftime(label_format),
+            "users": users_by_bucket.get(index, 0)
+        }
+        for index, bucket_start in enumerate(buckets)
+    ]
+
+
+def rollup_trend_series(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+) -> List[dict]:
+    """Approximate distinct users per trend bucket from merged hourly sketches
+
+    Hours that lie entirely inside one trend bucket and before the rollup
+    watermark are read from events_hourly. Hours straddling two buckets
+    (daily buckets follow the start time, not UTC midnight) and everything
+    after the watermark are collected from raw events in one grouped query.
+    """
+    watermark = rollup_watermark(db)
+    if watermark is None:
+        return trend_series(db, start, end, app_name=app_name, domain=domain)
+
+    buckets, step, label_format = _trend_buckets(start, end)
+    if not buckets:
+        return []
+
+    origin = utc_naive(buckets[0])
+    sketches = [HyperLogLog() for _ in buckets]
+
+    raw_ranges = []
+    covered_start = covered_end = None
+    for index in range(len(buckets)):
+        lo = origin + index * step
+        hi = lo + step
+        full_start, full_end = ceil_hour(lo), min(floor_hour(hi), watermark)
+        if full_end <= full_start:
+            raw_ranges.append((lo, hi))
+            continue
+        covered_start = covered_start or full_start
+        covered_end = full_end
+        if lo < full_start:
+            raw_ranges.append((lo, full_start))
+        if full_end < hi:
+            raw_ranges.append((full_end, hi))
+
+    if covered_start is not None:
+        hourly_rows = db.query(EventHourly.bucket, EventHourly.users).filter(
+            EventHourly.bucket >= covered_start,
+            EventHourly.bucket < covered_end,
+            *rollup_filters(EventHourly, app_name, domain)
+        ).all()
+        for hour, sketch in hourly_rows:
+            index = int((hour - origin) / step)
+            bucket_end = origin + (index + 1) * step
+            # Straddling hours are counted from raw events instead
+            if index < len(sketches) and hour + timedelta(hours=1) <= bucket_end:
+                sketches[index].merge_bytes(sketch)
+
+    if raw_ranges:
+        raw_ranges = _merge_ranges(raw_ranges)
+        bucket = _bucket_index(as_utc(origin), step)
+        raw_rows = db.query(
+            bucket,
+            func.array_agg(distinct(Event.user_id))
+        ).filter(
+            Event.created_at >= as_utc(raw_ranges[0][0]),
+            Event.created_at < as_utc(raw_ranges[-1][1]),
+            or_(*[
+                and_(Event.created_at >= as_utc(lo), Event.created_at < as_utc(hi))
+                for lo, hi in raw_ranges
+            ]),
+            *app_filters(app_name, domain)
+        ).group_by(bucket).all()
+        for index, user_ids in raw_rows:
+            sketches[int(index)].update(user_ids or [])
+
+    return [
+        {
+            "date": bucket_start.strftime(label_format),
+            "users": sketch.count()
+        }
+        for bucket_start, sketch in zip(buckets, sketches)
+    ]
+
+
+def _merge_ranges(ranges: list) -> list:
+    """Coalesce adjacent or overlapping [lo, hi) ranges"""
+    merged = []
+    for lo, hi in sorted(ranges):
+        if merged and lo <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], hi))
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def list_apps(db: Session, exact: bool = False) -> List[dict]:
+    """Apps/domains seen so far with their event and distinct user counts
+
+    One row per app from the app registry, which ingest keeps current.
+    Until the registry has been seeded the totals are merged from the
+    rollups as in ``app_totals``. User counts are sketch estimates unless
+    ``exact`` asks for the precise COUNT(DISTINCT) scan.
+    """
+    if exact:
+        return _list_apps_raw(db)
+
+    if db.get(RollupState, APP_REGISTRY_NAME) is not None:
+        return [
+            {
+                "app_name": app.app_name,
+                "domain": app.domain,
+                "event_count": app.event_count,
+                "user_count": app.user_count,
+                "first_seen": app.first_seen,
+                "last_seen": app.last_seen
+            }
+            for app in db.query(AppRegistry).all()
+        ]
+
+    if rollup_watermark(db) is None:
+        return _list_apps_raw(db)
+    return [
+        {
+            "app_name": app_name,
+            "domain": domain,
+            "event_count": app["event_count"],
+            "user_count": app["users"].count(),
+            "first_seen": app["first_seen"],
+            "last_seen": app["last_seen"]
+        }
+        for (app_name, domain), app in app_totals(db).items()
+    ]
+
+
+def app_totals(db: Session, until: Optional[datetime] = None) -> dict:
+    """Event count, user sketch and first/last seen per (app_name, domain)
+    for the events before ``until`` (default: all; never before the watermark)
+
+    Closed hours come from the daily rollups (whose current-day row holds
+    every hour up to the watermark); only events after the watermark are
+    scanned from the raw table.
+    """
+    watermark = rollup_watermark(db)
+    apps = {}
+
+    def app_entry(app_name, domain, event_count, first_seen, last_seen):
+        app = apps.setdefault((app_name, domain), {
+            "event_count": 0, "users": HyperLogLog(), "first_seen": None, "last_seen": None
+        })
+        app["event_count"] += event_count
+        if first_seen and (app["first_seen"] is None or first_seen < app["first_seen"]):
+            app["first_seen"] = first_seen
+        if last_seen and (app["last_seen"] is None or last_seen > app["last_seen"]):
+            app["last_seen"] = last_seen
+        return app
+
+    if watermark is not None:
+        rollup_rows = db.query(
+            EventDaily.app_name, EventDaily.domain, EventDaily.event_count,
+            EventDaily.users, EventDaily.first_seen, EventDaily.last_seen
+        ).filter(EventDaily.bucket < watermark).all()
+        for app_name, domain, event_count, sketch, first_seen, last_seen in rollup_rows:
+            app_entry(app_name, domain, event_count, first_seen, last_seen)["users"].merge_bytes(sketch)
+
+    filters = []
+    if watermark is not None:
+        filters.append(Event.created_at >= as_utc(watermark))
+    if until is not None:
+        filters.append(Event.created_at < as_utc(until))
+    raw_rows = db.query(
+        event_app_name,
+        event_domain,
+        func.count(Event.id),
+        func.array_agg(distinct(Event.user_id)),
+        func.min(Event.created_at),
+        func.max(Event.created_at)
+    ).filter(*filters).group_by(event_app_name, event_domain).all()
+    for app_name, domain, event_count, user_ids, first_seen, last_seen in raw_rows:
+        app_entry(app_name, domain, event_count, first_seen, last_seen)["users"].update(user_ids or [])
+
+    return apps
+
+
+def _list_apps_raw(db: Session) -> List[dict]:
+    """Exact app listing straight from the events table"""
+    apps = db.query(
+        event_app_name.label('app_name'),
+        event_domain.label('domain'),
+        func.count(Event.id).label('event_count'),
+        func.count(distinct(Event.user_id)).label('user_count'),
+        func.min(Event.created_at).label('first_seen'),
+        func.max(Event.created_at).label('last_seen')
+    ).group_by(event_app_name, event_domain).all()
+
+    return [
+        {
+            "app_name": app.app_name,
+            "domain": app.domain,
+            "event_count": app.event_count,
+            "user_count": app.user_count,
+            "first_seen": app.first_seen,
+            "last_seen": app.last_seen
+        }
+        for app in apps
+    ]
+
+
+def breakdown(
+    db: Session,
+    dimension: str,
+    start: datetime,
+    end: datetime,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None,
+    limit: int = 10,
+    exact: bool = False
+) -> dict:
+    """Top values of a dimension in [start, end] by events, with distinct users
+
+    Closed buckets are read from the rollups (pages from the top-pages
+    rollups) and only the raw edges are scanned. Values are ranked on
+    summed counts first, so sketches are merged for the top ``limit``
+    values only. Page counts are lower bounds: a page outside an hour's
+    top ``PAGE_TOP_K`` is not counted for that hour. ``exact`` (or no
+    rollup run yet) groups the raw events instead.
+    """
+    column = BREAKDOWN_DIMENSIONS[dimension]
+    watermark = None if exact else rollup_watermark(db)
+    if watermark is None:
+        event_count = func.count(Event.id)
+        rows = db.query(column, event_count, func.count(distinct(Event.user_id))).filter(
+            Event.created_at >= as_utc(start),
+            Event.created_at <= as_utc(end),
+            column.isnot(None),
+            *app_filters(app_name, domain)
+        ).group_by(column).order_by(event_count.desc(), column).limit(limit).all()
+        return {
+            "dimension": dimension,
+            "approximate": False,
+            "values": [{"value": value, "events": events, "users": users} for value, events, users in rows],
+            "retained_from": retained_from(db, start),
+        }
+
+    days, hours, raw = _rollup_plan(start, end, watermark)
+    models = (PageDaily, PageHourly) if dimension == "page_url" else (EventDaily, EventHourly)
+    rollups = [
+        (model, [
+            or_(*[and_(model.bucket >= lo, model.bucket < hi) for lo, hi in ranges]),
+            *rollup_filters(model, app_name, domain)
+        ])
+        for model, ranges in zip(models, (days, hours)) if ranges
+    ]
+
+    counts = {}
+    for model, filters in rollups:
+        value_column = getattr(model, dimension)
+        rows = db.query(value_column, func.sum(model.event_count)).filter(*filters).group_by(value_column).all()
+        for value, events in rows:
+            counts[value] = counts.get(value, 0) + events
+
+    raw_rows = db.query(column, func.count(Event.id), func.array_agg(distinct(Event.user_id))).filter(
+        *_raw_edge_filters(raw),
+        column.isnot(None),
+        *app_filters(app_name, domain)
+    ).group_by(column).all()
+    raw_users = {}
+    for value, events, user_ids in raw_rows:
+        counts[value] = counts.get(value, 0) + events
+        raw_users[value] = user_ids
+
+    top = sorted(counts, key=lambda value: (-counts[value], value))[:limit]
+    sketches = {value: HyperLogLog().update(raw_users.get(value) or []) for value in top}
+    for model, filters in rollups if top else []:
+        value_column = getattr(model, dimension)
+        for value, sketch in db.query(value_column, model.users).filter(*filters, value_column.in_(top)):
+            sketches[value].merge_bytes(sketch)
+
+    return {
+        "dimension": dimension,
+        "approximate": True,
+        "values": [
+            {"value": value, "events": counts[value], "users": sketches[value].count()}
+            for value in top
+        ],
+    }
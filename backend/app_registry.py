@@ -0,0 +1,200 @@
+"""App registry: per app/domain totals kept current from ingest for /api/apps"""
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Tuple
+
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from analytics import APP_REGISTRY_NAME, app_totals, utc_naive
+from models import AppRegistry, RollupState
+from sketches import HyperLogLog
+
+logger = logging.getLogger(__name__)
+
+# Taken shared by flushes and exclusively while the registry is seeded
+APP_REGISTRY_LOCK_ID = 73010004
+
+
+def floor_minute(value: datetime) -> datetime:
+    return value.replace(second=0, microsecond=0)
+
+
+class AppRegistryBuffer:
+    """Ingest totals per (app_name, domain, minute) not yet in app_registry
+
+    Ingest adds to it after each commit and a periodic flush folds it into
+    the table, so the hot app rows are locked once per flush instead of
+    once per batch. The minute lets a flush drop what the registry seed
+    already counted: the seed covers events before its cutoff minute.
+    """
+
+    def __init__(self):
+        self._totals: Dict[tuple, dict] = {}
+        self._lock = threading.Lock()
+        self.seeded = False
+
+    def record(self, events: Iterable[Tuple[str, str, str, datetime]]):
+        """Add ``(app_name, domain, user_id, created_at)`` tuples of committed events"""
+        with self._lock:
+            for app_name, domain, user_id, created_at in events:
+                key = (app_name, domain, floor_minute(utc_naive(created_at)))
+                totals = self._totals.get(key)
+                if totals is None:
+                    totals = self._totals[key] = {
+                        "event_count": 0, "users": set(), "first_seen": created_at, "last_seen": created_at
+                    }
+                totals["event_count"] += 1
+                totals["users"].add(user_id)
+                totals["first_seen"] = min(totals["first_seen"], created_at)
+                totals["last_seen"] = max(totals["last_seen"], created_at)
+
+    def take(self) -> Dict[tuple, dict]:
+        with self._lock:
+            totals, self._totals = self._totals, {}
+        return totals
+
+    def restore(self, totals: Dict[tuple, dict]):
+        """Put back totals a failed flush could not write"""
+        with self._lock:
+            for key, pending in totals.items():
+                current = self._totals.get(key)
+                if current is None:
+                    self._totals[key] = pending
+                    continue
+                current["event_count"] += pending["event_count"]
+                current["users"] |= pending["users"]
+                current["first_seen"] = min(current["first_seen"], pending["first_seen"])
+                current["last_seen"] = max(current["last_seen"], pending["last_seen"])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending_keys": len(self._totals),
+                "pending_events": sum(totals["event_count"] for totals in self._totals.values()),
+            }
+
+
+app_buffer = AppRegistryBuffer()
+
+
+def flush_app_registry(db: Session):
+    """Scheduled job: fold the buffered ingest totals into app_registry"""
+    pending = app_buffer.take()
+    # Runs once even with nothing buffered, so an idle API still seeds the registry
+    if not pending and app_buffer.seeded:
+        return
+    try:
+        _flush(db, pending)
+    except Exception:
+        db.rollback()
+        app_buffer.restore(pending)
+        raise
+    app_buffer.seeded = True
+
+
+def _flush(db: Session, pending: Dict[tuple, dict]):
+    cutoff = _lock_seeded(db)
+    totals = {}
+    for (app_name, domain, minute), delta in pending.items():
+        if minute < cutoff:
+            continue
+        app = totals.setdefault((app_name, domain), {
+            "event_count": 0, "users": HyperLogLog(), "first_seen": None, "last_seen": None
+        })
+        app["event_count"] += delta["event_count"]
+        app["users"].update(delta["users"])
+        app["first_seen"] = _earliest(app["first_seen"], delta["first_seen"])
+        app["last_seen"] = _latest(app["last_seen"], delta["last_seen"])
+    apply_app_totals(db, totals)
+    db.commit()
+
+
+def add_backdated_events(db: Session, events: Iterable[Tuple[str, str, str, datetime]]):
+    """Add ``(app_name, domain, user_id, created_at)`` tuples of bulk-loaded
+    events straight to the registry, in the caller's transaction
+
+    A registry that is not seeded yet is left alone: its seed counts them.
+    """
+    db.execute(select(func.pg_advisory_xact_lock_shared(APP_REGISTRY_LOCK_ID)))
+    if db.get(RollupState, APP_REGISTRY_NAME) is None:
+        return
+    totals = {}
+    for app_name, domain, user_id, created_at in events:
+        app = totals.setdefault((app_name, domain), {
+            "event_count": 0, "users": HyperLogLog(), "first_seen": None, "last_seen": None
+        })
+        app["event_count"] += 1
+        app["users"].add(user_id)
+        app["first_seen"] = _earliest(app["first_seen"], created_at)
+        app["last_seen"] = _latest(app["last_seen"], created_at)
+    apply_app_totals(db, totals)
+
+
+def apply_app_totals(db: Session, totals: dict):
+    """Add ``app_totals``-shaped totals to the registry rows, creating missing ones"""
+    if not totals:
+        return
+    empty = HyperLogLog().to_bytes()
+    db.execute(insert(AppRegistry).values([
+        {"app_name": app_name, "domain": domain, "event_count": 0, "users": empty, "user_count": 0}
+        for app_name, domain in totals
+    ]).on_conflict_do_nothing())
+
+    rows = db.query(AppRegistry).filter(
+        tuple_(AppRegistry.app_name, AppRegistry.domain).in_(list(totals))
+    ).order_by(AppRegistry.app_name, AppRegistry.domain).with_for_update().all()
+    for row in rows:
+        app = totals[(row.app_name, row.domain)]
+        users = HyperLogLog.from_bytes(row.users).merge(app["users"])
+        row.event_count += app["event_count"]
+        row.users = users.to_bytes()
+        row.user_count = users.count()
+        row.first_seen = _earliest(row.first_seen, app["first_seen"])
+        row.last_seen = _latest(row.last_seen, app["last_seen"])
+
+
+def _lock_seeded(db: Session) -> datetime:
+    """Take the shared registry lock, seeding the registry first if needed;
+    returns the seed cutoff"""
+    db.execute(select(func.pg_advisory_xact_lock_shared(APP_REGISTRY_LOCK_ID)))
+    state = db.get(RollupState, APP_REGISTRY_NAME)
+    if state is None:
+        db.rollback()
+        seed_app_registry(db)
+        db.execute(select(func.pg_advisory_xact_lock_shared(APP_REGISTRY_LOCK_ID)))
+        state = db.get(RollupState, APP_REGISTRY_NAME)
+    return state.rolled_up_to
+
+
+def seed_app_registry(db: Session, reset: bool = False) -> int:
+    """Build the registry from the rollups and raw events before the current
+    minute; with ``reset`` an existing registry is rebuilt. Returns apps seeded"""
+    db.execute(select(func.pg_advisory_xact_lock(APP_REGISTRY_LOCK_ID)))
+    state = db.get(RollupState, APP_REGISTRY_NAME)
+    if state is not None and not reset:
+        db.commit()
+        return 0
+
+    cutoff = floor_minute(datetime.utcnow())
+    totals = app_totals(db, until=cutoff)
+    db.query(AppRegistry).delete()
+    apply_app_totals(db, totals)
+    if state is None:
+        db.add(RollupState(name=APP_REGISTRY_NAME, rolled_up_to=cutoff))
+    else:
+        state.rolled_up_to = cutoff
+    db.commit()
+
+    logger.info("Seeded the app registry with %d apps up to %s", len(totals), cutoff)
+    return len(totals)
+
+
+def _earliest(current, value):
+    return value if current is None or (value is not None and value < current) else current
+
+
+def _latest(current, value):
+    return value if current is None or (value is not None and value > current) else current
@@ -0,0 +1,148 @@
+"""Redis-backed response cache with request coalescing for analytics endpoints"""
+import asyncio
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+import redis
+from fastapi.encoders import jsonable_encoder
+
+logger = logging.getLogger(__name__)
+
+GENERATION_ALL = "cache:gen:_all"
+
+# Returned instead of a reply when Redis cannot be reached
+_UNAVAILABLE = object()
+
+
+def generation_key(app_name: Optional[str]) -> str:
+    return f"cache:gen:{app_name}" if app_name else GENERATION_ALL
+
+
+def bump_generations(pipe, app_names: Iterable[str]):
+    """Queue generation bumps on a Redis pipeline for apps that received
+    backdated events (imports), which closed ranges do not expect"""
+    pipe.incr(GENERATION_ALL)
+    for app_name in set(app_names):
+        pipe.incr(generation_key(app_name))
+
+
+def normalize_window(start: datetime, end: datetime, granularity: int):
+    """Floor both ends of a range to ``granularity`` seconds so that dashboards
+    asking for "the last 7 days" a few seconds apart share one cache entry"""
+    if granularity <= 0:
+        return start, end
+    step = timedelta(seconds=granularity)
+
+    def floor(value: datetime) -> datetime:
+        return value - (value - datetime(1970, 1, 1, tzinfo=value.tzinfo)) % step
+
+    return floor(start), floor(end)
+
+
+class ResponseCache:
+    """Caches JSON-able responses in Redis and coalesces concurrent misses
+
+    Within a worker, callers asking for a key that is already being computed
+    await the same future. Across workers, a short Redis lock lets one worker
+    compute while the others poll for its result. Live events only reach
+    the open bucket, whose responses expire after the short open-range TTL.
+    Every key also carries the app's generation counter, which backdated
+    writes bump, so imports invalidate closed ranges without deleting keys.
+
+    ``redis_client`` is a ``redis.asyncio`` client and ``compute`` a coroutine
+    function, so neither a cache round-trip nor a miss blocks the event loop.
+    """
+
+    def __init__(self, redis_client, open_ttl: int, closed_ttl: int, lock_timeout: float = 10.0):
+        self.redis = redis_client
+        self.open_ttl = open_ttl
+        self.closed_ttl = closed_ttl
+        self.lock_timeout = lock_timeout
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    async def key(self, endpoint: str, params: dict, app_name: Optional[str]) -> str:
+        params = dict(params)
+        generation = await self._call(self.redis.get, generation_key(app_name))
+        params["_generation"] = generation.decode() if isinstance(generation, bytes) else None
+        digest = hashlib.sha1(json.dumps(jsonable_encoder(params), sort_keys=True).encode()).hexdigest()
+        return f"cache:{endpoint}:{digest}"
+
+    def ttl(self, open_range: bool) -> int:
+        return self.open_ttl if open_range else self.closed_ttl
+
+    async def get_or_compute(self, key: str, ttl: int, compute: Callable[[], Awaitable[dict]]):
+        cached = await self._load(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self._compute_once(key, ttl, compute)
+            future.set_result(value)
+            return value
+        except Exception as exc:
+            future.set_exception(exc)
+            future.exception()  # retrieved here so lone failures are not logged twice
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _compute_once(self, key: str, ttl: int, compute: Callable[[], Awaitable[dict]]):
+        lock_key = f"{key}:lock"
+        acquired = await self._call(self.redis.set, lock_key, 1, nx=True, px=int(self.lock_timeout * 1000))
+        if acquired is None:
+            # Another worker is computing this key; wait for its result
+            waited = 0.0
+            while waited < self.lock_timeout:
+                await asyncio.sleep(0.05)
+                waited += 0.05
+                cached = await self._load(key)
+                if cached is not None:
+                    self.coalesced += 1
+                    return cached
+
+        try:
+            value = jsonable_encoder(await compute())
+            await self._call(self.redis.set, key, json.dumps(value), ex=ttl)
+            return value
+        finally:
+            if acquired is True:
+                await self._call(self.redis.delete, lock_key)
+
+    async def _load(self, key: str):
+        raw = await self._call(self.redis.get, key)
+        return json.loads(raw) if isinstance(raw, bytes) else None
+
+    async def _call(self, method, *args, **kwargs):
+        """Run a Redis command, treating Redis outages as cache misses"""
+        try:
+            return await method(*args, **kwargs)
+        except redis.RedisError:
+            self.errors += 1
+            logger.warning("Response cache unavailable", exc_info=True)
+            return _UNAVAILABLE
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "inflight": len(self._inflight),
+        }
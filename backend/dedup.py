@@ -0,0 +1,127 @@
+"""Idempotent ingest: events whose client event_id was seen recently are dropped"""
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+import redis
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from analytics import as_utc
+from models import Event, EventId
+from schemas import EventCreate
+
+logger = logging.getLogger(__name__)
+
+# Seconds an event_id is remembered; a retry arriving later is stored again
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW_SECONDS", "86400"))
+DEDUP_PREFIX = "dedup:"
+
+
+def unique_events(events: List[EventCreate]) -> List[EventCreate]:
+    """Drop events repeating an event_id seen earlier in the same list"""
+    seen = set()
+    unique = []
+    for event in events:
+        if event.event_id is not None:
+            if event.event_id in seen:
+                continue
+            seen.add(event.event_id)
+        unique.append(event)
+    return unique
+
+
+class EventDeduplicator:
+    """Edge filter claiming event ids in Redis before events reach Postgres
+
+    Each id is claimed with ``SET NX EX`` for the dedup window, so memory is
+    bounded by the ids of one window. A Redis outage lets events through;
+    the event_ids table still turns duplicates away.
+    """
+
+    def __init__(self, redis_client, window: int = DEDUP_WINDOW):
+        self.redis = redis_client
+        self.window = window
+        self.dropped = 0
+        self.errors = 0
+
+    async def claim(self, events: List[EventCreate]) -> Tuple[List[EventCreate], List[str]]:
+        """Events not seen within the window, and the ids claimed for them"""
+        received = len(events)
+        events = unique_events(events)
+        ids = [event.event_id for event in events if event.event_id is not None]
+        if not ids:
+            return events, []
+
+        pipe = self.redis.pipeline(transaction=False)
+        for event_id in ids:
+            pipe.set(DEDUP_PREFIX + event_id, 1, nx=True, ex=self.window)
+        try:
+            claimed = dict(zip(ids, await pipe.execute()))
+        except redis.RedisError:
+            self.errors += 1
+            logger.warning("Dedup filter unavailable", exc_info=True)
+            self.dropped += received - len(events)
+            return events, []
+
+        fresh = [event for event in events if event.event_id is None or claimed[event.event_id]]
+        self.dropped += received - len(fresh)
+        return fresh, [event_id for event_id in ids if claimed[event_id]]
+
+    async def release(self, event_ids: List[str]):
+        """Forget claims of events that could not be written, so their retries get through"""
+        if not event_ids:
+            return
+        try:
+            await self.redis.delete(*(DEDUP_PREFIX + event_id for event_id in event_ids))
+        except redis.RedisError:
+            self.errors += 1
+            logger.warning("Could not release dedup claims", exc_info=True)
+
+    def stats(self) -> dict:
+        return {"window_seconds": self.window, "dropped": self.dropped, "errors": self.errors}
+
+
+def claim_event_ids(db: Session, events: List[EventCreate], timestamps: List[datetime]) -> List[int]:
+    """Record the event ids of a batch in event_ids, in the caller's
+    transaction; returns the positions of the events to store"""
+    rows = {}
+    for event, created_at in zip(events, timestamps):
+        if event.event_id is not None and event.event_id not in rows:
+            rows[event.event_id] = {"event_id": event.event_id, "created_at": created_at}
+    claimed = set()
+    if rows:
+        # Sorted so concurrent batches take row locks in the same order
+        claimed = set(db.execute(
+            insert(EventId).values(sorted(rows.values(), key=lambda row: row["event_id"]))
+            .on_conflict_do_nothing()
+            .returning(EventId.event_id)
+        ).scalars())
+
+    keep = []
+    for index, event in enumerate(events):
+        if event.event_id is None:
+            keep.append(index)
+        elif event.event_id in claimed:
+            claimed.discard(event.event_id)
+            keep.append(index)
+    return keep
+
+
+def find_event(db: Session, event_id: str) -> Optional[Event]:
+    """The stored event carrying a client event_id ingested within the window"""
+    seen = db.get(EventId, event_id)
+    if seen is None:
+        return None
+    return db.query(Event).filter(Event.created_at == seen.created_at, Event.event_id == event_id).first()
+
+
+def prune_event_ids(db: Session) -> int:
+    """Scheduled job: forget event ids older than the dedup window; returns rows deleted"""
+    cutoff = as_utc(datetime.utcnow() - timedelta(seconds=DEDUP_WINDOW))
+    deleted = db.query(EventId).filter(EventId.created_at < cutoff).delete(synchronize_session=False)
+    db.commit()
+    if deleted:
+        logger.info("Pruned %d event ids older than %s", deleted, cutoff)
+    return deleted
@@ -0,0 +1,131 @@
+"""Maintenance of user_first_seen, the first event time of each user per scope"""
+import logging
+from datetime import datetime, timedelta
+from typing import Iterable, List, Tuple
+
+from sqlalchemy import case, func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from analytics import (
+    FIRST_SEEN_COMPLETE, FIRST_SEEN_NAME, dimension_scopes,
+    as_utc, utc_naive, floor_day
+)
+from models import Event, RollupState, UserFirstSeen
+
+logger = logging.getLogger(__name__)
+
+# Days of history scanned per transaction by the backfill
+FIRST_SEEN_CHUNK_DAYS = 7
+# Postgres advisory lock id keeping concurrent API workers from backfilling twice
+FIRST_SEEN_LOCK_ID = 73010003
+
+
+def first_seen_rows(events: Iterable[Tuple[str, str, str, datetime]]) -> List[dict]:
+    """One row per (scope, user) with the earliest time among
+    ``(app_name, domain, user_id, created_at)`` tuples"""
+    earliest = {}
+    for app_name, domain, user_id, created_at in events:
+        for scope in dimension_scopes(app_name, domain):
+            key = (scope, user_id)
+            if key not in earliest or created_at < earliest[key]:
+                earliest[key] = created_at
+    # Sorted so concurrent batches take row locks in the same order
+    return [
+        {"scope": scope, "user_id": user_id, "first_seen": created_at}
+        for (scope, user_id), created_at in sorted(earliest.items())
+    ]
+
+
+def upsert_first_seen(db: Session, rows: List[dict], backdated: bool = False):
+    """Record first-seen rows; existing users are left alone unless the rows
+    are ``backdated`` (imports, backfill), which may move them earlier"""
+    if not rows:
+        return
+    stmt = insert(UserFirstSeen).values(rows)
+    if backdated:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserFirstSeen.scope, UserFirstSeen.user_id],
+            set_={"first_seen": stmt.excluded.first_seen},
+            where=stmt.excluded.first_seen < UserFirstSeen.first_seen
+        )
+    else:
+        # Live events are never older than what is stored
+        stmt = stmt.on_conflict_do_nothing(index_elements=[UserFirstSeen.scope, UserFirstSeen.user_id])
+    db.execute(stmt)
+
+
+def rebuild_first_seen(db: Session, start: datetime, end: datetime) -> int:
+    """Fold the events in [start, end) into user_first_seen in one grouped
+    scan; returns the rows written (the caller commits)"""
+    # One grouping set per scope; grouping() tells which set a row came from
+    scopes = dimension_scopes(Event.app_name, Event.domain)
+    scope = case(
+        (func.grouping(Event.app_name, Event.domain) == 0, scopes[3]),
+        (func.grouping(Event.app_name) == 0, scopes[1]),
+        (func.grouping(Event.domain) == 0, scopes[2]),
+        else_=scopes[0]
+    )
+    grouped = select(
+        scope, Event.user_id, func.min(Event.created_at)
+    ).where(
+        Event.created_at >= as_utc(start),
+        Event.created_at < as_utc(end)
+    ).group_by(
+        func.grouping_sets(
+            tuple_(Event.user_id),
+            tuple_(Event.app_name, Event.user_id),
+            tuple_(Event.domain, Event.user_id),
+            tuple_(Event.app_name, Event.domain, Event.user_id)
+        )
+    )
+
+    stmt = insert(UserFirstSeen).from_select(["scope", "user_id", "first_seen"], grouped)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserFirstSeen.scope, UserFirstSeen.user_id],
+        set_={"first_seen": stmt.excluded.first_seen},
+        where=stmt.excluded.first_seen < UserFirstSeen.first_seen
+    )
+    return db.execute(stmt).rowcount
+
+
+def backfill_first_seen(db: Session) -> int:
+    """Scheduled job: fold events that predate ingest-time first-seen
+    tracking into user_first_seen, newest first; returns days processed"""
+    processed = 0
+    while True:
+        days = _backfill_chunk(db)
+        if not days:
+            return processed
+        processed += days
+
+
+def _backfill_chunk(db: Session) -> int:
+    if not db.execute(select(func.pg_try_advisory_xact_lock(FIRST_SEEN_LOCK_ID))).scalar():
+        db.rollback()
+        return 0
+
+    state = db.get(RollupState, FIRST_SEEN_NAME)
+    if state is None:
+        # Ingest has been recording first-seen rows since this process started
+        state = RollupState(name=FIRST_SEEN_NAME, rolled_up_to=datetime.utcnow())
+        db.add(state)
+
+    end = state.rolled_up_to
+    if end <= FIRST_SEEN_COMPLETE:
+        db.commit()
+        return 0
+
+    first_event = db.query(func.min(Event.created_at)).scalar()
+    history_start = floor_day(utc_naive(first_event)) if first_event else end
+    start = max(history_start, end - timedelta(days=FIRST_SEEN_CHUNK_DAYS))
+    rows = rebuild_first_seen(db, start, end) if start < end else 0
+
+    state.rolled_up_to = start if start > history_start else FIRST_SEEN_COMPLETE
+    db.commit()
+
+    if state.rolled_up_to == FIRST_SEEN_COMPLETE:
+        logger.info("First-seen backfill complete (%d rows in the last chunk)", rows)
+    else:
+        logger.info("Backfilled first-seen times back to %s (%d rows)", start, rows)
+    return max((end - start).days, 1)
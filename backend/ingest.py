@@ -0,0 +1,378 @@
+"""Event ingestion helpers shared by the single and batch event endpoints"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, case, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from analytics import as_utc
+from app_registry import app_buffer
+from database import SessionLocal
+from dedup import claim_event_ids, find_event
+from first_seen import first_seen_rows, upsert_first_seen
+from models import Event, Session as UserSession
+from realtime import queue_realtime_updates
+from schemas import EventCreate
+from session_state import SessionStateCache
+
+logger = logging.getLogger(__name__)
+
+# Sessions' last_activity is written at most every SESSION_WRITE_INTERVAL
+# seconds per session (0 writes on every event); the rest is flushed by a job
+session_state = SessionStateCache(
+    max_size=int(os.getenv("SESSION_CACHE_SIZE", "100000")),
+    ttl=float(os.getenv("SESSION_CACHE_TTL", "1800")),
+    write_interval=float(os.getenv("SESSION_WRITE_INTERVAL", "30"))
+)
+
+
+def event_dimensions(properties: Optional[dict]):
+    """app_name and domain columns for an event, as promoted from its properties"""
+    properties = properties or {}
+    app_name = properties.get("app_name")
+    domain = properties.get("domain")
+    return (
+        str(app_name) if app_name not in (None, "") else "legacy",
+        str(domain) if domain not in (None, "") else "unknown",
+    )
+
+
+def event_row(event: EventCreate) -> dict:
+    """Column values of the events row for an incoming event"""
+    app_name, domain = event_dimensions(event.properties)
+    return {
+        "event_type": event.event_type,
+        "user_id": event.user_id,
+        "session_id": event.session_id,
+        "page_url": event.page_url,
+        "country": event.country,
+        "properties": event.properties or {},
+        "app_name": app_name,
+        "domain": domain,
+        "event_id": event.event_id,
+    }
+
+
+def write_event(db: Session, event: EventCreate) -> Tuple[Event, bool]:
+    """Insert a single event and upsert its session; returns the stored row
+    and True, or the original row and False when the event's event_id was
+    ingested already"""
+    row = event_row(event)
+    # Set here rather than by the database so every derived total sees the same time
+    created_at = as_utc(datetime.utcnow())
+    if event.event_id is not None and not claim_event_ids(db, [event], [created_at]):
+        db.rollback()
+        original = find_event(db, event.event_id)
+        if original is not None:
+            return original, False
+        # The original is gone (retention), so this copy is stored in its place
+    db_event = Event(**row, created_at=created_at)
+    db.add(db_event)
+    sessions = plan_sessions([event], [created_at])
+    try:
+        _upsert_session_rows(db, sessions)
+        upsert_first_seen(db, first_seen_rows([(row["app_name"], row["domain"], row["user_id"], created_at)]))
+        db.commit()
+    except Exception:
+        session_state.restore(sessions)
+        raise
+    app_buffer.record([(row["app_name"], row["domain"], row["user_id"], created_at)])
+    db.refresh(db_event)
+    return db_event, True
+
+
+def write_events(
+    db: Session,
+    events: List[EventCreate],
+    received_at: Optional[List[datetime]] = None
+) -> List[int]:
+    """Insert a batch of events, upsert their sessions and first-seen rows and
+    add them to the app registry buffer; returns the positions in ``events``
+    of the events stored, which leaves out those whose event_id was ingested
+    already
+
+    ``received_at`` carries the time each event reached the API when the
+    write is deferred, so queued events keep their original timestamps.
+    """
+    if not events:
+        return []
+
+    # Aware timestamps: asyncpg reads naive values bound to timestamptz as local time
+    if received_at:
+        timestamps = [as_utc(value) for value in received_at]
+    else:
+        timestamps = [as_utc(datetime.utcnow())] * len(events)
+
+    keep = claim_event_ids(db, events, timestamps)
+    if len(keep) < len(events):
+        events = [events[index] for index in keep]
+        timestamps = [timestamps[index] for index in keep]
+        if not events:
+            db.commit()
+            return []
+
+    rows = [dict(event_row(event), created_at=created_at) for event, created_at in zip(events, timestamps)]
+    seen = [(row["app_name"], row["domain"], row["user_id"], row["created_at"]) for row in rows]
+    sessions = plan_sessions(events, timestamps)
+    try:
+        db.execute(insert(Event).values(rows))
+        _upsert_session_rows(db, sessions)
+        upsert_first_seen(db, first_seen_rows(seen))
+        db.commit()
+    except Exception:
+        session_state.restore(sessions)
+        raise
+    app_buffer.record(seen)
+
+    return keep
+
+
+def plan_sessions(events: List[EventCreate], timestamps: List[datetime]) -> List[dict]:
+    """Session rows that create or extend the sessions of a batch of events,
+    leaving out sessions whose state the session cache says is already
+    current enough; the caller hands them back to ``session_state.restore``
+    if its transaction fails"""
+    # Collapse the batch to one row per session - Postgres refuses to touch
+    # the same row twice in a single ON CONFLICT statement
+    sessions = {}
+    for event, created_at in zip(events, timestamps):
+        session = sessions.get(event.session_id)
+        if session is None:
+            sessions[event.session_id] = {
+                "session_id": event.session_id,
+                "user_id": event.user_id,
+                "start_time": created_at,
+                "last_activity": created_at,
+                "country": event.country,
+            }
+            continue
+        session["last_activity"] = max(session["last_activity"], created_at)
+        if session["country"] == "Unknown" and event.country != "Unknown":
+            session["country"] = event.country
+
+    return session_state.plan(list(sessions.values()))
+
+
+def flush_sessions(db: Session):
+    """Scheduled job: write the last_activity the session cache held back"""
+    rows = session_state.take_dirty()
+    if rows:
+        try:
+            _upsert_session_rows(db, rows)
+            db.commit()
+        except Exception:
+            session_state.restore(rows)
+            raise
+
+
+def _upsert_session_rows(db: Session, rows: List[dict]):
+    if not rows:
+        return
+    stmt = insert(UserSession).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserSession.session_id],
+        set_={
+            # Rows from another worker's cache or a delayed batch may be older
+            "last_activity": func.greatest(UserSession.last_activity, stmt.excluded.last_activity),
+            # Update country if it was Unknown and now we have a real country
+            "country": case(
+                (
+                    and_(UserSession.country == "Unknown", stmt.excluded.country != "Unknown"),
+                    stmt.excluded.country
+                ),
+                else_=UserSession.country
+            ),
+        }
+    )
+    db.execute(stmt)
+
+
+def queue_realtime(pipe, events: List[EventCreate], received_at: Optional[List[datetime]] = None):
+    """Queue the real-time counter updates for a batch on a Redis pipeline
+
+    Events count towards the minute they reached the API, ``received_at``
+    when they waited in the ingest queue, otherwise now.
+    """
+    dimensions = [event_dimensions(event.properties) for event in events]
+    if not received_at:
+        received_at = [datetime.utcnow()] * len(events)
+    queue_realtime_updates(
+        pipe,
+        (
+            (app_name, domain, event.user_id, event.country, received)
+            for event, (app_name, domain), received in zip(events, dimensions, received_at)
+        )
+    )
+
+
+def record_realtime(redis_client, events: List[EventCreate], received_at: Optional[List[datetime]] = None):
+    """Bump the real-time Redis counters for a batch in a single round-trip"""
+    if not events:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    queue_realtime(pipe, events, received_at)
+    pipe.execute()
+
+
+async def record_realtime_async(redis_client, events: List[EventCreate]):
+    """``record_realtime`` for a ``redis.asyncio`` client"""
+    if not events:
+        return
+    pipe = redis_client.pipeline(transaction=False)
+    queue_realtime(pipe, events)
+    await pipe.execute()
+
+
+class IngestQueue:
+    """Bounded in-process buffer drained into Postgres by a background task
+
+    Events are flushed in micro-batches of up to ``batch_size`` events or
+    whatever has accumulated after ``flush_interval`` seconds, whichever
+    comes first. The database write runs in a worker thread so the event
+    loop keeps serving requests while a batch is being committed.
+    """
+
+    def __init__(self, redis_client, max_size: int, batch_size: int, flush_interval: float, deduplicator=None):
+        self.redis_client = redis_client
+        # Releases the event_id claims of batches that fail to write
+        self.deduplicator = deduplicator
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: Optional[asyncio.Future] = None
+
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.failed = 0
+        self.realtime_failed = 0
+        self.flushes = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def put_many(self, events: List[EventCreate], claimed: Iterable[str] = ()) -> bool:
+        """Queue events without waiting; returns False when there is no room for all of them
+
+        ``claimed`` are the event ids the dedup filter claimed for these events.
+        """
+        if self.max_size - self.queue.qsize() < len(events):
+            self.rejected += len(events)
+            return False
+
+        now = datetime.utcnow()
+        claimed = set(claimed)
+        for event in events:
+            self.queue.put_nowait((event, now, event.event_id if event.event_id in claimed else None))
+        self.enqueued += len(events)
+        return True
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flusher and write out everything still buffered"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        # A cancelled flusher may have left a batch mid-write or half collected
+        if self._inflight:
+            await self._inflight
+            self._inflight = None
+
+        while not self.queue.empty():
+            batch = []
+            while not self.queue.empty() and len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+            await self._flush(batch)
+
+    async def _run(self):
+        while True:
+            batch = []
+            try:
+                batch.append(await self.queue.get())
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # Shutdown while collecting: hand the events already taken off
+                # the queue to stop(), which waits for the in-flight write
+                if batch:
+                    self._inflight = asyncio.ensure_future(self._flush(batch))
+                raise
+            # Shielded so shutdown never abandons a batch that is already being written
+            self._inflight = asyncio.ensure_future(self._flush(batch))
+            await asyncio.shield(self._inflight)
+
+    async def _flush(self, batch):
+        if not batch:
+            return
+
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self._write, batch)
+            self.flushed += len(batch)
+        except Exception:
+            self.failed += len(batch)
+            logger.exception("Failed to flush %d queued events", len(batch))
+            # Let the clients' retries of the lost events through the dedup filter
+            if self.deduplicator:
+                await self.deduplicator.release([event_id for _, _, event_id in batch if event_id is not None])
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.flushes += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+
+    def _write(self, batch):
+        events = [event for event, _, _ in batch]
+        received_at = [received for _, received, _ in batch]
+        db = SessionLocal()
+        try:
+            kept = write_events(db, events, received_at)
+        finally:
+            db.close()
+        # Events dropped as duplicates of stored ones were counted with the original
+        events = [events[index] for index in kept]
+        received_at = [received_at[index] for index in kept]
+        # The rows are committed: a Redis failure must neither count the batch
+        # as failed nor release its dedup claims, it only costs realtime counts
+        try:
+            record_realtime(self.redis_client, events, received_at)
+        except Exception:
+            self.realtime_failed += len(events)
+            logger.warning("Could not update realtime counters for %d queued events", len(events), exc_info=True)
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.max_size,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "flushed": self.flushed,
+            "failed": self.failed,
+            "realtime_failed": self.realtime_failed,
+            "flushes": self.flushes,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0.0,
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
@@ -0,0 +1,148 @@
+"""Funnel and cohort retention analysis over per-user event sequences"""
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from analytics import app_filters, as_utc, retained_from, utc_naive
+from models import Event
+
+# Rows fetched per server-side cursor round-trip by the funnel scan
+FUNNEL_CHUNK_ROWS = 10_000
+MAX_FUNNEL_STEPS = 10
+RETENTION_PERIODS = {"day": timedelta(days=1), "week": timedelta(weeks=1)}
+
+
+def funnel_report(
+    db: Session,
+    steps: List[str],
+    start: datetime,
+    end: datetime,
+    window: timedelta,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+) -> dict:
+    """Users reaching each step of an ordered funnel within ``window`` of its first step
+
+    One pass over the steps' events sorted by user and time, read through a
+    server-side cursor. Per user, ``starts[k]`` holds the latest first-step
+    time of a chain that reached step k in order; keeping the latest one
+    leaves the most room in the window for the steps after it.
+    """
+    # Steps an event type stands for, last first, so one event advances a chain by one step
+    positions = {}
+    for index, event_type in enumerate(steps):
+        positions.setdefault(event_type, []).insert(0, index)
+
+    stmt = select(Event.user_id, Event.event_type, Event.created_at).where(
+        Event.created_at >= as_utc(start),
+        Event.created_at <= as_utc(end),
+        Event.event_type.in_(list(positions)),
+        *app_filters(app_name, domain)
+    ).order_by(Event.user_id, Event.created_at).execution_options(yield_per=FUNNEL_CHUNK_ROWS)
+
+    # reached[k]: users whose furthest step is k
+    reached = [0] * len(steps)
+    current_user = None
+    starts = [None] * len(steps)
+
+    def finish():
+        for index in range(len(steps) - 1, -1, -1):
+            if starts[index] is not None:
+                reached[index] += 1
+                return
+
+    for rows in db.execute(stmt).partitions():
+        for user_id, event_type, created_at in rows:
+            if user_id != current_user:
+                finish()
+                current_user = user_id
+                starts = [None] * len(steps)
+            for index in positions[event_type]:
+                if index == 0:
+                    starts[0] = created_at
+                elif starts[index - 1] is not None and created_at - starts[index - 1] <= window:
+                    if starts[index] is None or starts[index - 1] > starts[index]:
+                        starts[index] = starts[index - 1]
+    finish()
+
+    # Users reaching step k = users whose furthest step is k or later
+    users = []
+    total = 0
+    for count in reversed(reached):
+        total += count
+        users.insert(0, total)
+
+    return {
+        "window_hours": window.total_seconds() / 3600,
+        "retained_from": retained_from(db, start),
+        "steps": [
+            {
+                "event_type": event_type,
+                "users": count,
+                "conversion_rate": round(count / users[0] * 100, 1) if users[0] else 0.0,
+                "step_conversion_rate": (
+                    100.0 if index == 0 else
+                    round(count / users[index - 1] * 100, 1) if users[index - 1] else 0.0
+                ),
+            }
+            for index, (event_type, count) in enumerate(zip(steps, users))
+        ]
+    }
+
+
+def retention_report(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    period: str = "week",
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+) -> dict:
+    """Cohort retention grid: users grouped by their first active period in the
+    range and the share of them active in each later period
+
+    Periods are UTC days or ISO weeks. One query: events collapse to distinct
+    (user, period) pairs, a window function tags each pair with the user's
+    first period and the pairs are counted per (cohort, period).
+    """
+    step = RETENTION_PERIODS[period]
+    period_start = func.date_trunc(period, func.timezone('UTC', Event.created_at)).label('period')
+    activity = select(Event.user_id, period_start).where(
+        Event.created_at >= as_utc(start),
+        Event.created_at <= as_utc(end),
+        *app_filters(app_name, domain)
+    ).group_by(Event.user_id, period_start).subquery()
+
+    cohort = func.min(activity.c.period).over(partition_by=activity.c.user_id).label('cohort')
+    tagged = select(activity.c.period, cohort).subquery()
+    rows = db.execute(
+        select(tagged.c.cohort, tagged.c.period, func.count())
+        .group_by(tagged.c.cohort, tagged.c.period)
+        .order_by(tagged.c.cohort, tagged.c.period)
+    ).all()
+
+    first_period = utc_naive(start).replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "week":
+        first_period -= timedelta(days=first_period.weekday())
+    periods = int((utc_naive(end) - first_period) / step) + 1
+
+    grid = {}
+    for cohort_start, active_period, count in rows:
+        retained = grid.setdefault(cohort_start, [0] * (periods - int((cohort_start - first_period) / step)))
+        retained[int((active_period - cohort_start) / step)] = count
+
+    return {
+        "period": period,
+        "retained_from": retained_from(db, start),
+        "cohorts": [
+            {
+                "cohort": cohort_start.strftime("%Y-%m-%d"),
+                "users": retained[0],
+                "retained": retained,
+                "retention": [round(count / retained[0] * 100, 1) if retained[0] else 0.0 for count in retained],
+            }
+            for cohort_start, retained in grid.items()
+        ]
+    }
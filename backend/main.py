@@ -1,24 +1,53 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from datetime import datetime, timedelta
 from typing import Optional, List
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, distinct
+from sqlalchemy.ext.asyncio import AsyncSession
+import asyncio
+import contextvars
+import time
 import redis
+import redis.asyncio
 import json
+from concurrent.futures import ThreadPoolExecutor
 
-from database import get_db, engine, Base
-from models import Event, User, Session as UserSession
+from database import (
+    get_db, get_async_db, engine, async_engine, report_engine, Base,
+    SessionLocal, ReportSessionLocal, REPORT_WORKERS
+)
+from models import User
 from schemas import (
-    EventCreate, EventResponse, AnalyticsSummary,
-    RealtimeUsers, UserLogin, Token, TimeRange
+    EventCreate, EventResponse, EventBatchResponse, AnalyticsSummary,
+    FunnelReport, RetentionReport, BreakdownReport, RealtimeUsers, UserLogin, Token, TimeRange
 )
 from auth import create_access_token, verify_token
+from ingest import write_event, write_events, record_realtime_async, flush_sessions, session_state, IngestQueue
+from analytics import (
+    BREAKDOWN_DIMENSIONS, MAX_BREAKDOWN_VALUES, breakdown, build_summary, list_apps, retained_from,
+    utc_naive, floor_hour
+)
+from cache import ResponseCache, normalize_window
+from journeys import MAX_FUNNEL_STEPS, RETENTION_PERIODS, funnel_report, retention_report
+from rollups import run_rollups
+from first_seen import backfill_first_seen
+from sessionize import run_sessionization
+from app_registry import app_buffer, flush_app_registry
+from partitions import maintain_partitions, prepare_partitions
+from dedup import EventDeduplicator, find_event, prune_event_ids
+from views import DAILY_VIEW_REFRESH_INTERVAL, HOURLY_VIEW_REFRESH_INTERVAL, refresh_daily_view, refresh_hourly_view
+from scheduler import Scheduler
+from realtime import realtime_snapshot, redis_realtime_snapshot, RealtimeBroadcaster
+from transfer import EXPORT_FORMATS, MAX_PAGE_ROWS, decode_cursor, export_stream, list_events_stream
+from metrics import metrics, RequestStats, current_request, instrument_engine, instrument_redis, gauges
 import os
 
-# Create tables
+# Create tables, then the partitions events needs to accept inserts
 Base.metadata.create_all(bind=engine)
+with SessionLocal() as startup_db:
+    prepare_partitions(startup_db)
 
 app = FastAPI(title="Analytics Dashboard API", version="1.0.0")
 
@@ -46,8 +75,224 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Redis connection
-redis_client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+# Redis connections: the blocking client is used from worker threads (ingest
+# queue), request handlers use the asyncio client
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+redis_client = instrument_redis(redis.from_url(REDIS_URL))
+async_redis_client = instrument_redis(redis.asyncio.from_url(REDIS_URL))
+
+instrument_engine(engine)
+instrument_engine(report_engine)
+instrument_engine(async_engine.sync_engine)
+
+# ?profile=1 returns the response wrapped with a per-query timing breakdown;
+# off unless enabled since it exposes SQL to API clients
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    """Record latency, SQL and Redis work per route, and serve ?profile=1"""
+    stats = RequestStats(profile=PROFILING_ENABLED and request.query_params.get("profile") == "1")
+    token = current_request.set(stats)
+    started = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        current_request.reset(token)
+        elapsed = time.perf_counter() - started
+        route = request.scope.get("route")
+        metrics.observe_request(request.method, route.path if route else "unmatched", status_code, elapsed, stats)
+
+    response.headers["Server-Timing"] = (
+        f"db;dur={stats.db_seconds * 1000:.1f};desc=\"{stats.queries} queries\", total;dur={elapsed * 1000:.1f}"
+    )
+    if not stats.profile or not response.headers.get("content-type", "").startswith("application/json"):
+        return response
+
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    profiled = JSONResponse(status_code=response.status_code, content={
+        "response": json.loads(body) if body else None,
+        "profile": {
+            "total_ms": round(elapsed * 1000, 3),
+            "db_ms": round(stats.db_seconds * 1000, 3),
+            "query_count": stats.queries,
+            "redis_commands": stats.redis_commands,
+            "redis_roundtrips": stats.redis_roundtrips,
+            "queries": stats.query_log,
+        }
+    })
+    # Keep Server-Timing, cache and CORS headers; the body length and type are the new response's
+    for name, value in response.headers.items():
+        if name not in ("content-length", "content-type"):
+            profiled.headers.append(name, value)
+    return profiled
+
+# Upper bound on events accepted by a single /api/events/batch request
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
+
+# Edge filter dropping retried events (same event_id) before they are written
+deduplicator = EventDeduplicator(async_redis_client)
+
+# Ingestion mode: "sync" commits every request before responding, "queue"
+# buffers events in memory and writes them behind the request in micro-batches
+INGEST_MODE = os.getenv("INGEST_MODE", "sync")
+ingest_queue = None
+
+@app.on_event("startup")
+async def start_ingest_queue():
+    # Built here rather than at import so the queue binds to uvicorn's event loop
+    global ingest_queue
+    if INGEST_MODE == "queue":
+        ingest_queue = IngestQueue(
+            redis_client,
+            max_size=int(os.getenv("INGEST_QUEUE_SIZE", "10000")),
+            batch_size=int(os.getenv("INGEST_BATCH_SIZE", "500")),
+            flush_interval=float(os.getenv("INGEST_FLUSH_INTERVAL", "1.0")),
+            deduplicator=deduplicator
+        )
+        await ingest_queue.start()
+
+@app.on_event("shutdown")
+async def stop_ingest_queue():
+    if ingest_queue:
+        await ingest_queue.stop()
+
+async def enqueue_events(events: List[EventCreate], claimed: List[str]) -> JSONResponse:
+    """Hand events to the write-behind queue, shedding load when it is full"""
+    if not ingest_queue.put_many(events, claimed):
+        await deduplicator.release(claimed)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Ingest queue is full, retry later",
+            headers={"Retry-After": "1"}
+        )
+    return JSONResponse(
+        status_code=status.HTTP_202_ACCEPTED,
+        content={"accepted": len(events)}
+    )
+
+# Serve summaries from the hourly/daily rollups; the job interval is in seconds (0 disables it)
+USE_ROLLUPS = os.getenv("USE_ROLLUPS", "true").lower() == "true"
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL", "60"))
+
+scheduler = Scheduler()
+scheduler.add("rollups", ROLLUP_INTERVAL, run_rollups)
+scheduler.add("sessions", session_state.write_interval.total_seconds(), flush_sessions)
+scheduler.add("sessionize", float(os.getenv("SESSIONIZE_INTERVAL", "300")), run_sessionization)
+scheduler.add("app_registry", float(os.getenv("APP_REGISTRY_FLUSH_INTERVAL", "5")), flush_app_registry)
+scheduler.add("first_seen", float(os.getenv("FIRST_SEEN_BACKFILL_INTERVAL", "3600")), backfill_first_seen)
+scheduler.add("partitions", float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600")), maintain_partitions)
+scheduler.add("view_daily", DAILY_VIEW_REFRESH_INTERVAL, refresh_daily_view)
+scheduler.add("view_hourly", HOURLY_VIEW_REFRESH_INTERVAL, refresh_hourly_view)
+scheduler.add("event_ids", float(os.getenv("DEDUP_PRUNE_INTERVAL", "3600")), prune_event_ids)
+
+@app.on_event("startup")
+async def start_scheduler():
+    await scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    await scheduler.stop()
+    # Write the session activity and app totals still held back in memory
+    if "sessions" in scheduler.stats:
+        await scheduler.run("sessions", flush_sessions)
+    if "app_registry" in scheduler.stats:
+        await scheduler.run("app_registry", flush_app_registry)
+
+# Redis response cache for summary and app list responses. Ranges reaching
+# into the current hour expire after CACHE_OPEN_TTL seconds, closed ranges after
+# CACHE_CLOSED_TTL seconds; imports invalidate both for the apps they touch
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+CACHE_GRANULARITY = int(os.getenv("CACHE_GRANULARITY", "60"))
+response_cache = None
+if CACHE_ENABLED:
+    response_cache = ResponseCache(
+        async_redis_client,
+        open_ttl=int(os.getenv("CACHE_OPEN_TTL", "30")),
+        closed_ttl=int(os.getenv("CACHE_CLOSED_TTL", "3600"))
+    )
+
+# Realtime data comes from the per-minute Redis keys written at ingest;
+# "postgres" queries events and sessions instead, as does a Redis outage
+REALTIME_SOURCE = os.getenv("REALTIME_SOURCE", "redis")
+
+async def compute_realtime(app_name: Optional[str], domain: Optional[str]) -> dict:
+    if REALTIME_SOURCE == "redis":
+        try:
+            return await redis_realtime_snapshot(async_redis_client, app_name=app_name, domain=domain)
+        except redis.RedisError:
+            pass
+    return await run_report(realtime_snapshot, app_name=app_name, domain=domain)
+
+# Realtime stream: one snapshot per REALTIME_STREAM_INTERVAL seconds per
+# (app_name, domain), shared by every connected dashboard
+REALTIME_STREAM_INTERVAL = float(os.getenv("REALTIME_STREAM_INTERVAL", "5"))
+# Comment lines sent on idle streams so proxies do not close them
+REALTIME_HEARTBEAT = 15.0
+realtime_broadcaster = RealtimeBroadcaster(compute_realtime, REALTIME_STREAM_INTERVAL)
+
+@app.on_event("shutdown")
+async def stop_realtime_broadcaster():
+    await realtime_broadcaster.stop()
+
+# Registered last: shutdown handlers run in order, after the queue and tickers stopped
+@app.on_event("shutdown")
+async def close_connections():
+    await async_redis_client.close()
+    await async_engine.dispose()
+    report_executor.shutdown()
+    report_engine.dispose()
+
+def use_cache(cache_control: Optional[str]) -> bool:
+    """Whether a request may be served from the response cache"""
+    return response_cache is not None and "no-cache" not in (cache_control or "")
+
+def parse_range(start_date: Optional[str], end_date: Optional[str], days: int):
+    """Parse ISO query parameters; a missing end is now, a missing start ``days`` before the end"""
+    end = datetime.fromisoformat(end_date.replace('Z', '+00:00')) if end_date else datetime.utcnow()
+    start = datetime.fromisoformat(start_date.replace('Z', '+00:00')) if start_date else end - timedelta(days=days)
+    return start, end
+
+# One thread per report connection, so a report never waits on the pool
+# while holding a thread and the default executor stays free for other work
+report_executor = ThreadPoolExecutor(max_workers=REPORT_WORKERS, thread_name_prefix="report")
+
+async def run_report(fn, *args, **kwargs):
+    """``fn(db, *args, **kwargs)`` on a report session in the report executor
+
+    Every report endpoint goes through here: they merge HyperLogLog sketches
+    or walk rows in Python, which under ``AsyncSession.run_sync`` would run
+    on the event loop and stall every other request, ingest and realtime
+    streams included.
+    """
+    def call():
+        db = ReportSessionLocal()
+        try:
+            return fn(db, *args, **kwargs)
+        finally:
+            db.close()
+    # Copied so the query instrumentation still sees the request being served
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(report_executor, context.run, call)
+
+async def retention_headers(start: Optional[datetime]) -> dict:
+    """``X-Retained-From`` for raw event streams reaching past the retained history"""
+    cutoff = await run_report(retained_from, start)
+    return {"X-Retained-From": cutoff.isoformat()} if cutoff else {}
+
+async def cached_report(endpoint: str, params: dict, start: datetime, end: datetime,
+                        app_name: Optional[str], cache_control: Optional[str], compute):
+    """``await compute(start, end)`` through the response cache, with the range
+    floored to CACHE_GRANULARITY so nearby requests share an entry"""
+    if not use_cache(cache_control):
+        return await compute(start, end)
+
+    start, end = normalize_window(start, end, CACHE_GRANULARITY)
+    open_range = utc_naive(end) >= floor_hour(datetime.utcnow())
+    key = await response_cache.key(endpoint, dict(params, start=start, end=end), app_name)
+    return await response_cache.get_or_compute(key, response_cache.ttl(open_range), lambda: compute(start, end))
 
 security = HTTPBearer()
 
@@ -68,37 +313,22 @@ async def root():
 
 @app.get("/api/apps")
 async def get_available_apps(
-    current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    exact: bool = False,
+    cache_control: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
 ):
     """Get list of all available apps/clients"""
-    from sqlalchemy import cast, Text
-
-    apps = db.query(
-        func.coalesce(cast(Event.properties['app_name'], Text), 'legacy').label('app_name'),
-        func.coalesce(cast(Event.properties['domain'], Text), 'unknown').label('domain'),
-        func.count(Event.id).label('event_count'),
-        func.count(distinct(Event.user_id)).label('user_count'),
-        func.min(Event.created_at).label('first_seen'),
-        func.max(Event.created_at).label('last_seen')
-    ).group_by(
-        cast(Event.properties['app_name'], Text),
-        cast(Event.properties['domain'], Text)
-    ).all()
-
-    return {
-        "apps": [
-            {
-                "app_name": app.app_name,
-                "domain": app.domain,
-                "event_count": app.event_count,
-                "user_count": app.user_count,
-                "first_seen": app.first_seen,
-                "last_seen": app.last_seen
-            }
-            for app in apps
-        ]
-    }
+    exact = exact or not USE_ROLLUPS
+
+    async def compute():
+        return {"apps": await run_report(list_apps, exact=exact)}
+
+    if not use_cache(cache_control):
+        return await compute()
+
+    # The app list always includes the open bucket
+    key = await response_cache.key("apps", {"exact": exact}, None)
+    return await response_cache.get_or_compute(key, response_cache.ttl(open_range=True), compute)
 
 @app.post("/api/auth/login", response_model=Token)
 async def login(user_data: UserLogin, db: Session = Depends(get_db)):
@@ -118,209 +348,186 @@ async def events_options():
     return {"message": "OK"}
 
 @app.post("/api/events", response_model=EventResponse)
-async def track_event(event: EventCreate, db: Session = Depends(get_db)):
-    """Track a new event"""
-    # Create event record
-    db_event = Event(
-        event_type=event.event_type,
-        user_id=event.user_id,
-        session_id=event.session_id,
-        page_url=event.page_url,
-        country=event.country,
-        properties=event.properties or {}
-    )
-    db.add(db_event)
-
-    # Update or create session
-    session = db.query(UserSession).filter(
-        UserSession.session_id == event.session_id
-    ).first()
-
-    if not session:
-        session = UserSession(
-            session_id=event.session_id,
-            user_id=event.user_id,
-            start_time=datetime.utcnow(),
-            last_activity=datetime.utcnow(),
-            country=event.country
-        )
-        db.add(session)
-    else:
-        session.last_activity = datetime.utcnow()
-        # Update country if it was Unknown and now we have a real country
-        if session.country == "Unknown" and event.country != "Unknown":
-            session.country = event.country
-
-    db.commit()
-    db.refresh(db_event)
-
-    # Store in Redis for real-time tracking
-    redis_key = f"realtime:{datetime.utcnow().strftime('%Y-%m-%d:%H:%M')}"
-    redis_client.hincrby(redis_key, "events", 1)
-    redis_client.hincrby(f"country:{event.country}", "count", 1)
-    redis_client.expire(redis_key, 3600)  # Expire after 1 hour
+async def track_event(event: EventCreate, db: AsyncSession = Depends(get_async_db)):
+    """Track a new event; a retry with the same ``event_id`` returns the original"""
+    fresh, claimed = await deduplicator.claim([event])
+    if not fresh:
+        original = await db.run_sync(find_event, event.event_id)
+        if original is not None:
+            return original
+        if ingest_queue:
+            # The original is still waiting in the queue
+            return JSONResponse(status_code=status.HTTP_202_ACCEPTED, content={"accepted": 0})
+
+    if ingest_queue:
+        return await enqueue_events(fresh, claimed)
+
+    try:
+        db_event, inserted = await db.run_sync(write_event, event)
+    except Exception:
+        await deduplicator.release(claimed)
+        raise
+
+    # Store in Redis for real-time tracking, including an event the dedup
+    # filter took for a retry whose original is no longer stored
+    if inserted:
+        await record_realtime_async(async_redis_client, [event])
 
     return db_event
 
-@app.get("/api/analytics/summary", response_model=AnalyticsSummary)
-async def get_analytics_summary(
+@app.options("/api/events/batch")
+async def events_batch_options():
+    """Handle CORS preflight for batch events endpoint"""
+    return {"message": "OK"}
+
+@app.post("/api/events/batch", response_model=EventBatchResponse)
+async def track_events_batch(events: List[EventCreate], db: AsyncSession = Depends(get_async_db)):
+    """Track many events at once with one bulk insert and one session upsert"""
+    if len(events) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batch exceeds {MAX_BATCH_SIZE} events"
+        )
+
+    events, claimed = await deduplicator.claim(events)
+    if ingest_queue:
+        return await enqueue_events(events, claimed)
+
+    try:
+        kept = await db.run_sync(write_events, events)
+    except Exception:
+        await deduplicator.release(claimed)
+        raise
+    await record_realtime_async(async_redis_client, [events[index] for index in kept])
+
+    return {"accepted": len(kept)}
+
+@app.get("/api/events/export")
+async def export_events(
+    start_date: str,
+    end_date: str,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None,
+    format: str = "parquet",
+    current_user: dict = Depends(get_current_user)
+):
+    """Stream events in [start_date, end_date) as Parquet or an Arrow IPC stream"""
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"format must be one of {', '.join(sorted(EXPORT_FORMATS))}"
+        )
+    start = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
+    end = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
+    media_type, extension = EXPORT_FORMATS[format]
+    headers = {"Content-Disposition": f'attachment; filename="events.{extension}"'}
+    headers.update(await retention_headers(start))
+
+    # A sync generator: Starlette pulls each chunk in a worker thread
+    return StreamingResponse(
+        export_stream(start, end, app_name, domain, format),
+        media_type=media_type,
+        headers=headers
+    )
+
+@app.get("/api/events")
+async def list_events(
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     app_name: Optional[str] = None,
     domain: Optional[str] = None,
-    current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    event_type: Optional[str] = None,
+    country: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(1000, ge=1, le=MAX_PAGE_ROWS),
+    order: str = "desc",
+    current_user: dict = Depends(get_current_user)
 ):
-    """Get analytics summary for dashboard (all apps or filtered by app_name/domain)"""
-    # Default to last 7 days if no dates provided
-    if not end_date:
-        end_date = datetime.utcnow()
-    else:
-        end_date = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-
-    if not start_date:
-        start_date = end_date - timedelta(days=7)
-    else:
-        start_date = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-
-    # Calculate previous period for comparison
-    period_length = (end_date - start_date).days
-    prev_start = start_date - timedelta(days=period_length)
-    prev_end = start_date
-
-    # Build base filter
-    def build_filter(start, end):
-        from sqlalchemy import cast, Text
-        filters = [Event.created_at >= start, Event.created_at <= end]
-        if app_name:
-            filters.append(cast(Event.properties['app_name'], Text) == app_name)
-        if domain:
-            filters.append(cast(Event.properties['domain'], Text) == domain)
-        return and_(*filters)
-
-    current_filter = build_filter(start_date, end_date)
-    prev_filter = build_filter(prev_start, prev_end)
-
-    # Current period metrics
-    total_users = db.query(func.count(distinct(Event.user_id))).filter(
-        current_filter
-    ).scalar() or 0
-
-    event_count = db.query(func.count(Event.id)).filter(
-        current_filter
-    ).scalar() or 0
-
-    conversion_filter = build_filter(start_date, end_date)
-    conversions = db.query(func.count(Event.id)).filter(
-        and_(conversion_filter, Event.event_type == 'conversion')
-    ).scalar() or 0
-
-    # New users (first event in this period)
-    # Build subquery for new users with app/domain filter
-    from sqlalchemy import cast, Text
-    new_user_subquery = db.query(Event.user_id)
-    new_user_filters = [Event.created_at >= start_date]
-    if app_name:
-        new_user_filters.append(cast(Event.properties['app_name'], Text) == app_name)
-    if domain:
-        new_user_filters.append(cast(Event.properties['domain'], Text) == domain)
-
-    new_user_subquery = new_user_subquery.filter(and_(*new_user_filters)).group_by(Event.user_id).having(
-        func.min(Event.created_at) >= start_date
+    """Filtered events as NDJSON, paged by an opaque (created_at, id) cursor"""
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="order must be asc or desc")
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    start = datetime.fromisoformat(start_date.replace('Z', '+00:00')) if start_date else None
+    end = datetime.fromisoformat(end_date.replace('Z', '+00:00')) if end_date else None
+
+    return StreamingResponse(
+        list_events_stream(
+            start=start, end=end, app_name=app_name, domain=domain, event_type=event_type,
+            country=country, after=after, limit=limit, descending=order == "desc"
+        ),
+        media_type="application/x-ndjson",
+        headers=await retention_headers(start)
     )
 
-    new_users = db.query(func.count(distinct(Event.user_id))).filter(
-        and_(
-            current_filter,
-            Event.user_id.in_(new_user_subquery)
-        )
-    ).scalar() or 0
-
-    # Previous period metrics for comparison
-    prev_total_users = db.query(func.count(distinct(Event.user_id))).filter(
-        prev_filter
-    ).scalar() or 0
-
-    prev_event_count = db.query(func.count(Event.id)).filter(
-        prev_filter
-    ).scalar() or 0
-
-    prev_conversion_filter = build_filter(prev_start, prev_end)
-    prev_conversions = db.query(func.count(Event.id)).filter(
-        and_(prev_conversion_filter, Event.event_type == 'conversion')
-    ).scalar() or 0
-
-    # Previous period new users with app/domain filter
-    prev_new_user_subquery = db.query(Event.user_id)
-    prev_new_user_filters = [Event.created_at >= prev_start]
-    if app_name:
-        prev_new_user_filters.append(cast(Event.properties['app_name'], Text) == app_name)
-    if domain:
-        prev_new_user_filters.append(cast(Event.properties['domain'], Text) == domain)
-
-    prev_new_user_subquery = prev_new_user_subquery.filter(and_(*prev_new_user_filters)).group_by(Event.user_id).having(
-        func.min(Event.created_at) >= prev_start
-    )
+@app.get("/api/ingest/stats")
+async def get_ingest_stats(current_user: dict = Depends(get_current_user)):
+    """Queue depth and flush latency of the write-behind ingest queue, session
+    cache hit rates, app registry totals awaiting a flush and dropped duplicates"""
+    stats = {"mode": INGEST_MODE}
+    if ingest_queue:
+        stats.update(ingest_queue.stats())
+    stats["session_cache"] = session_state.stats()
+    stats["app_registry"] = app_buffer.stats()
+    stats["dedup"] = deduplicator.stats()
+    return stats
+
+def collect_component_metrics():
+    lines = gauges("session_cache", session_state.stats(), "Ingest session state cache")
+    lines += gauges("app_registry", app_buffer.stats(), "App registry totals awaiting a flush")
+    lines += gauges("dedup", deduplicator.stats(), "Ingest event_id dedup filter")
+    if ingest_queue:
+        lines += gauges("ingest_queue", ingest_queue.stats(), "Write-behind ingest queue")
+    if response_cache:
+        lines += gauges("response_cache", response_cache.stats(), "Analytics response cache")
+    for name, job in scheduler.stats.items():
+        lines += gauges(f"scheduler_{name}", job, f"Background job {name}")
+    lines += gauges("realtime_stream", {
+        "filters": len(realtime_broadcaster.tickers),
+        "subscribers": sum(len(queues) for queues in realtime_broadcaster.subscribers.values()),
+    }, "Realtime stream")
+    return lines
+
+metrics.add_collector(collect_component_metrics)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus metrics: request latency, SQL and Redis work per route, queue and cache stats"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    prev_new_users = db.query(func.count(distinct(Event.user_id))).filter(
-        and_(
-            prev_filter,
-            Event.user_id.in_(prev_new_user_subquery)
+@app.get("/api/analytics/summary", response_model=AnalyticsSummary)
+async def get_analytics_summary(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None,
+    exact: bool = False,
+    views: bool = False,
+    cache_control: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get analytics summary for dashboard (all apps or filtered by app_name/domain)
+
+    Distinct user counts come from HyperLogLog sketches in the rollups;
+    pass ``exact=true`` for precise COUNT(DISTINCT) queries over raw events,
+    or ``views=true`` to read the periodically refreshed materialized views
+    (``data_as_of`` in the response tells how fresh they are).
+    A ``Cache-Control: no-cache`` request header bypasses the response cache.
+    """
+    start_date, end_date = parse_range(start_date, end_date, days=7)
+    approximate = USE_ROLLUPS and not exact
+
+    async def compute(start, end):
+        return await run_report(
+            build_summary, start, end, app_name=app_name, domain=domain, approximate=approximate, views=views
         )
-    ).scalar() or 0
-
-    # Calculate percentage changes
-    def calc_change(current, previous):
-        if previous == 0:
-            return 100.0 if current > 0 else 0.0
-        return round(((current - previous) / previous) * 100, 1)
-
-    # Get trend data (hourly for <=24h, daily for longer periods)
-    trend_data = []
-    period_hours = (end_date - start_date).total_seconds() / 3600
-
-    if period_hours <= 24:
-        # Hourly aggregates for 24-hour view
-        current_time = start_date.replace(minute=0, second=0, microsecond=0)
-        while current_time <= end_date:
-            next_time = current_time + timedelta(hours=1)
-            hourly_filter = build_filter(current_time, next_time)
-            hourly_users = db.query(func.count(distinct(Event.user_id))).filter(
-                hourly_filter
-            ).scalar() or 0
-
-            trend_data.append({
-                "date": current_time.strftime("%Y-%m-%d %H:%M:%S"),
-                "users": hourly_users
-            })
-            current_time = next_time
-    else:
-        # Daily aggregates for longer periods
-        current_date = start_date
-        while current_date <= end_date:
-            next_date = current_date + timedelta(days=1)
-            daily_filter = build_filter(current_date, next_date)
-            daily_users = db.query(func.count(distinct(Event.user_id))).filter(
-                daily_filter
-            ).scalar() or 0
-
-            trend_data.append({
-                "date": current_date.strftime("%Y-%m-%d"),
-                "users": daily_users
-            })
-            current_date = next_date
-
-    return {
-        "total_users": total_users,
-        "total_users_change": calc_change(total_users, prev_total_users),
-        "event_count": event_count,
-        "event_count_change": calc_change(event_count, prev_event_count),
-        "conversions": conversions,
-        "conversions_change": calc_change(conversions, prev_conversions),
-        "new_users": new_users,
-        "new_users_change": calc_change(new_users, prev_new_users),
-        "trend_data": trend_data
-    }
+
+    return await cached_report(
+        "summary", {"app_name": app_name, "domain": domain, "exact": not approximate, "views": views},
+        start_date, end_date, app_name, cache_control, compute
+    )
 
 @app.get("/api/analytics/{app_name}/summary", response_model=AnalyticsSummary)
 async def get_app_specific_summary(
@@ -328,8 +535,10 @@ async def get_app_specific_summary(
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     domain: Optional[str] = None,
-    current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    exact: bool = False,
+    views: bool = False,
+    cache_control: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
 ):
     """Get analytics summary for a specific app"""
     return await get_analytics_summary(
@@ -337,96 +546,161 @@ async def get_app_specific_summary(
         end_date=end_date,
         app_name=app_name,
         domain=domain,
-        current_user=current_user,
-        db=db
+        exact=exact,
+        views=views,
+        cache_control=cache_control,
+        current_user=current_user
+    )
+
+@app.get("/api/analytics/funnel", response_model=FunnelReport)
+async def get_funnel(
+    steps: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None,
+    window_hours: float = Query(24.0, gt=0),
+    cache_control: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """Ordered funnel over comma-separated event types, e.g. ``steps=pageview,click,conversion``
+
+    A user reaches a step when its events follow the steps in order and
+    within ``window_hours`` of the first step. Defaults to the last 7 days.
+    """
+    step_list = [step.strip() for step in steps.split(",") if step.strip()]
+    if not 2 <= len(step_list) <= MAX_FUNNEL_STEPS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"steps must list between 2 and {MAX_FUNNEL_STEPS} event types"
+        )
+    start_date, end_date = parse_range(start_date, end_date, days=7)
+
+    async def compute(start, end):
+        return await run_report(
+            funnel_report, step_list, start, end, timedelta(hours=window_hours), app_name=app_name, domain=domain
+        )
+
+    return await cached_report(
+        "funnel", {"steps": step_list, "window_hours": window_hours, "app_name": app_name, "domain": domain},
+        start_date, end_date, app_name, cache_control, compute
+    )
+
+@app.get("/api/analytics/retention", response_model=RetentionReport)
+async def get_retention(
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None,
+    period: str = "week",
+    cache_control: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """Cohort retention grid by first active day or week in the range (default: last 8 weeks)"""
+    if period not in RETENTION_PERIODS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"period must be one of {', '.join(RETENTION_PERIODS)}"
+        )
+    start_date, end_date = parse_range(start_date, end_date, days=56)
+
+    async def compute(start, end):
+        return await run_report(retention_report, start, end, period, app_name=app_name, domain=domain)
+
+    return await cached_report(
+        "retention", {"period": period, "app_name": app_name, "domain": domain},
+        start_date, end_date, app_name, cache_control, compute
+    )
+
+@app.get("/api/analytics/breakdown", response_model=BreakdownReport)
+async def get_breakdown(
+    dimension: str,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=MAX_BREAKDOWN_VALUES),
+    exact: bool = False,
+    cache_control: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """Top values of page_url, country, event_type or app_name with event and user counts"""
+    if dimension not in BREAKDOWN_DIMENSIONS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"dimension must be one of {', '.join(BREAKDOWN_DIMENSIONS)}"
+        )
+    start_date, end_date = parse_range(start_date, end_date, days=30)
+    exact = exact or not USE_ROLLUPS
+
+    async def compute(start, end):
+        return await run_report(
+            breakdown, dimension, start, end, app_name=app_name, domain=domain, limit=limit, exact=exact
+        )
+
+    return await cached_report(
+        "breakdown",
+        {"dimension": dimension, "app_name": app_name, "domain": domain, "limit": limit, "exact": exact},
+        start_date, end_date, app_name, cache_control, compute
     )
 
 @app.get("/api/analytics/{app_name}/realtime", response_model=RealtimeUsers)
 async def get_app_specific_realtime(
     app_name: str,
     domain: Optional[str] = None,
-    current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: dict = Depends(get_current_user)
 ):
     """Get real-time analytics for a specific app"""
     return await get_realtime_users(
         app_name=app_name,
         domain=domain,
-        current_user=current_user,
-        db=db
+        current_user=current_user
     )
 
 @app.get("/api/analytics/realtime", response_model=RealtimeUsers)
 async def get_realtime_users(
     app_name: Optional[str] = None,
     domain: Optional[str] = None,
-    current_user: dict = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: dict = Depends(get_current_user)
 ):
     """Get real-time user activity (last 30 minutes) - all apps or filtered by app_name/domain"""
-    thirty_min_ago = datetime.utcnow() - timedelta(minutes=30)
-
-    # Build filter for app/domain
-    def build_event_filter(*time_filters):
-        from sqlalchemy import cast, Text
-        filters = list(time_filters)
-        if app_name:
-            filters.append(cast(Event.properties['app_name'], Text) == app_name)
-        if domain:
-            filters.append(cast(Event.properties['domain'], Text) == domain)
-        return and_(*filters)
-
-    # Get active sessions in last 30 minutes
-    session_query = db.query(UserSession).filter(
-        UserSession.last_activity >= thirty_min_ago
-    )
-    active_sessions = session_query.all()
-
-    active_users_count = len(set([s.user_id for s in active_sessions]))
+    return await compute_realtime(app_name, domain)
 
-    # Users by minute (last 30 minutes)
-    users_by_minute = []
-    for i in range(30):
-        minute_time = datetime.utcnow() - timedelta(minutes=29-i)
-        minute_start = minute_time.replace(second=0, microsecond=0)
-        minute_end = minute_start + timedelta(minutes=1)
-
-        minute_filter = build_event_filter(
-            Event.created_at >= minute_start,
-            Event.created_at < minute_end
+@app.get("/api/analytics/realtime/stream")
+async def stream_realtime_users(
+    request: Request,
+    token: str,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+):
+    """Server-sent events: a realtime snapshot on connect, then deltas as they change"""
+    # EventSource cannot set an Authorization header, so the token is a query parameter
+    if not verify_token(token):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid authentication credentials"
         )
-        minute_users = db.query(func.count(distinct(Event.user_id))).filter(
-            minute_filter
-        ).scalar() or 0
-
-        users_by_minute.append({
-            "minute": minute_start.strftime("%H:%M"),
-            "users": minute_users
-        })
-
-    # Users by country
-    users_by_country = []
-    country_data = db.query(
-        UserSession.country,
-        func.count(distinct(UserSession.user_id)).label('user_count')
-    ).filter(
-        UserSession.last_activity >= thirty_min_ago
-    ).group_by(UserSession.country).all()
-
-    for country, count in country_data:
-        users_by_country.append({
-            "country": country or "Unknown",
-            "users": count
-        })
-
-    # Sort by user count descending
-    users_by_country.sort(key=lambda x: x["users"], reverse=True)
-
-    return {
-        "active_users": active_users_count,
-        "users_by_minute": users_by_minute,
-        "users_by_country": users_by_country[:10]  # Top 10 countries
-    }
+
+    async def events():
+        # Subscribed once the response starts streaming: a client gone before
+        # then never runs the generator, so its finally could not unsubscribe
+        queue = realtime_broadcaster.subscribe(app_name, domain)
+        try:
+            while not await request.is_disconnected():
+                try:
+                    kind, payload = await asyncio.wait_for(queue.get(), REALTIME_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {kind}\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            realtime_broadcaster.unsubscribe(app_name, domain, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 if __name__ == "__main__":
     import uvicorn
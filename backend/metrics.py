@@ -0,0 +1,198 @@
+"""Request, database and Redis instrumentation rendered in the Prometheus text format"""
+import inspect
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+
+# Upper bounds (seconds) of the request latency histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Statements longer than this are cut in profile output
+PROFILE_SQL_LENGTH = 500
+
+
+class RequestStats:
+    """Work done on behalf of one request, collected through a context variable"""
+
+    def __init__(self, profile: bool = False):
+        self.profile = profile
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.redis_commands = 0
+        self.redis_roundtrips = 0
+        self.query_log: List[dict] = []
+
+
+# asyncio tasks, run_sync greenlets and asyncio.to_thread all inherit it
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+class Metrics:
+    """Thread-safe counters and histograms keyed by label tuples
+
+    Request handlers, the ingest queue thread and scheduler threads all
+    report here; work outside a request is labelled ``route="background"``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests: Dict[Tuple[str, str, str], int] = {}
+        self.latency: Dict[Tuple[str, str], List[int]] = {}
+        self.latency_sum: Dict[Tuple[str, str], float] = {}
+        self.queries: Dict[str, int] = {}
+        self.db_seconds: Dict[str, float] = {}
+        self.redis_commands: Dict[str, int] = {}
+        self.redis_roundtrips: Dict[str, int] = {}
+        self.collectors: List[Callable[[], List[str]]] = []
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        with self._lock:
+            key = (method, route, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            buckets = self.latency.setdefault((method, route), [0] * (len(LATENCY_BUCKETS) + 1))
+            buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.latency_sum[(method, route)] = self.latency_sum.get((method, route), 0.0) + seconds
+            self._add(route, stats.queries, stats.db_seconds, stats.redis_commands, stats.redis_roundtrips)
+
+    def observe_background(self, queries: int = 0, db_seconds: float = 0.0, redis_commands: int = 0, redis_roundtrips: int = 0):
+        with self._lock:
+            self._add("background", queries, db_seconds, redis_commands, redis_roundtrips)
+
+    def _add(self, route: str, queries: int, db_seconds: float, redis_commands: int, redis_roundtrips: int):
+        self.queries[route] = self.queries.get(route, 0) + queries
+        self.db_seconds[route] = self.db_seconds.get(route, 0.0) + db_seconds
+        self.redis_commands[route] = self.redis_commands.get(route, 0) + redis_commands
+        self.redis_roundtrips[route] = self.redis_roundtrips.get(route, 0) + redis_roundtrips
+
+    def add_collector(self, collector: Callable[[], List[str]]):
+        """Register a callable returning extra exposition lines at scrape time"""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            lines += _header("http_requests_total", "counter", "HTTP requests by route and status")
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+
+            lines += _header("http_request_duration_seconds", "histogram", "HTTP request latency by route")
+            for (method, route), buckets in sorted(self.latency.items()):
+                labels = f'method="{method}",route="{route}"'
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), buckets):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f"http_request_duration_seconds_sum{{{labels}}} {self.latency_sum[(method, route)]:.6f}")
+                lines.append(f"http_request_duration_seconds_count{{{labels}}} {cumulative}")
+
+            for name, kind, help_text, values in (
+                ("db_queries_total", "counter", "SQL statements executed", self.queries),
+                ("db_query_seconds_total", "counter", "Time spent executing SQL", self.db_seconds),
+                ("redis_commands_total", "counter", "Redis commands sent", self.redis_commands),
+                ("redis_roundtrips_total", "counter", "Redis round-trips (a pipeline is one)", self.redis_roundtrips),
+            ):
+                lines += _header(name, kind, help_text)
+                for route, value in sorted(values.items()):
+                    lines.append(f'{name}{{route="{route}"}} {value:.6f}' if isinstance(value, float)
+                                 else f'{name}{{route="{route}"}} {value}')
+
+        for collector in self.collectors:
+            lines += collector()
+        return "\n".join(lines) + "\n"
+
+
+def _header(name: str, kind: str, help_text: str) -> List[str]:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+
+
+def gauges(prefix: str, values: dict, help_text: str) -> List[str]:
+    """Exposition lines for the numeric entries of a stats dict"""
+    lines = []
+    for key, value in values.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        name = f"{prefix}_{key}"
+        lines += _header(name, "gauge", f"{help_text}: {key}")
+        lines.append(f"{name} {value}")
+    return lines
+
+
+metrics = Metrics()
+
+
+def instrument_engine(engine):
+    """Count and time every statement executed on a (sync) engine"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["query_started"].pop()
+        stats = current_request.get()
+        if stats is None:
+            metrics.observe_background(queries=1, db_seconds=seconds)
+            return
+        stats.queries += 1
+        stats.db_seconds += seconds
+        if stats.profile:
+            stats.query_log.append({
+                "sql": " ".join(statement.split())[:PROFILE_SQL_LENGTH],
+                "ms": round(seconds * 1000, 3),
+                "rows": cursor.rowcount,
+            })
+
+
+def _count_redis(commands: int):
+    stats = current_request.get()
+    if stats is None:
+        metrics.observe_background(redis_commands=commands, redis_roundtrips=1)
+    else:
+        stats.redis_commands += commands
+        stats.redis_roundtrips += 1
+
+
+def instrument_redis(client):
+    """Count commands and round-trips of a redis or redis.asyncio client
+
+    Wraps the client's ``execute_command`` and the ``execute`` of the
+    pipelines it creates; redis-py has no hooks of its own for this.
+    """
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    if _is_async(execute_command):
+        async def counted_command(*args, **kwargs):
+            _count_redis(1)
+            return await execute_command(*args, **kwargs)
+    else:
+        def counted_command(*args, **kwargs):
+            _count_redis(1)
+            return execute_command(*args, **kwargs)
+
+    def counted_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+        if _is_async(execute):
+            async def counted_execute(*a, **kw):
+                _count_redis(len(pipe.command_stack))
+                return await execute(*a, **kw)
+        else:
+            def counted_execute(*a, **kw):
+                _count_redis(len(pipe.command_stack))
+                return execute(*a, **kw)
+        pipe.execute = counted_execute
+        return pipe
+
+    client.execute_command = counted_command
+    client.pipeline = counted_pipeline
+    return client
+
+
+def _is_async(method) -> bool:
+    return inspect.iscoroutinefunction(method)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, JSON, Index, Float
+from sqlalchemy import Column, Integer, BigInteger, Boolean, String, DateTime, JSON, Index, Float, LargeBinary
 from sqlalchemy.sql import func
 from database import Base
 from datetime import datetime
@@ -6,18 +6,26 @@ from datetime import datetime
 class Event(Base):
     __tablename__ = "events"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
     event_type = Column(String, index=True, nullable=False)  # 'pageview', 'click', 'conversion', etc.
     user_id = Column(String, index=True, nullable=False)
     session_id = Column(String, index=True, nullable=False)
     page_url = Column(String)
     country = Column(String, index=True)
     properties = Column(JSON, default={})
-    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+    # Promoted from properties at ingest so app/domain filters can use an index
+    app_name = Column(String, nullable=False, server_default='legacy')
+    domain = Column(String, nullable=False, server_default='unknown')
+    # Client idempotency key; retries carrying it are dropped at ingest (see EventId)
+    event_id = Column(String)
+    # Range partition key, so it is part of the primary key
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), primary_key=True, index=True)
 
     __table_args__ = (
         Index('idx_event_user_created', 'user_id', 'created_at'),
         Index('idx_event_type_created', 'event_type', 'created_at'),
+        Index('idx_event_app_domain_created', 'app_name', 'domain', 'created_at'),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
     )
 
 class User(Base):
@@ -40,7 +48,129 @@ class Session(Base):
     last_activity = Column(DateTime(timezone=True), server_default=func.now(), index=True)
     country = Column(String)
     properties = Column(JSON, default={})
+    # Folded in from the session's events by the sessionization job
+    app_name = Column(String)
+    domain = Column(String)
+    event_count = Column(Integer, nullable=False, server_default='0')
+    pageviews = Column(Integer, nullable=False, server_default='0')
+    duration_seconds = Column(Integer, nullable=False, server_default='0')
+    entry_page = Column(String)
+    exit_page = Column(String)
+    bounced = Column(Boolean)
 
     __table_args__ = (
         Index('idx_session_user_activity', 'user_id', 'last_activity'),
+        Index('idx_session_start', 'start_time'),
+        Index('idx_session_app_domain_start', 'app_name', 'domain', 'start_time'),
+    )
+
+class UserFirstSeen(Base):
+    """Time of a user's first event in each scope (see analytics.dimension_scopes)"""
+    __tablename__ = "user_first_seen"
+
+    # "_all", "app:<app>", "domain:<domain>" or "app:<app>:<domain>" (escaped by analytics.scope_part)
+    scope = Column(String, primary_key=True)
+    user_id = Column(String, primary_key=True)
+    first_seen = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index('idx_user_first_seen_scope_time', 'scope', 'first_seen'),
+    )
+
+class AppRegistry(Base):
+    """Running totals per app/domain, folded in from ingest by a background job"""
+    __tablename__ = "app_registry"
+
+    app_name = Column(String, primary_key=True)
+    domain = Column(String, primary_key=True)
+    event_count = Column(BigInteger, nullable=False, default=0)
+    users = Column(LargeBinary, nullable=False)  # serialized HyperLogLog sketch
+    user_count = Column(BigInteger, nullable=False, default=0)  # estimate from ``users``
+    first_seen = Column(DateTime(timezone=True))
+    last_seen = Column(DateTime(timezone=True))
+
+class EventHourly(Base):
+    """Hourly event rollup; ``users`` is a serialized HyperLogLog sketch"""
+    __tablename__ = "events_hourly"
+
+    bucket = Column(DateTime, primary_key=True)  # UTC hour start
+    app_name = Column(String, primary_key=True)
+    domain = Column(String, primary_key=True)
+    event_type = Column(String, primary_key=True)
+    country = Column(String, primary_key=True)
+    event_count = Column(BigInteger, nullable=False, default=0)
+    users = Column(LargeBinary, nullable=False)
+    first_seen = Column(DateTime(timezone=True))
+    last_seen = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        Index('idx_events_hourly_app_bucket', 'app_name', 'domain', 'bucket'),
+    )
+
+class EventDaily(Base):
+    """Daily event rollup merged from closed hourly buckets"""
+    __tablename__ = "events_daily"
+
+    bucket = Column(DateTime, primary_key=True)  # UTC day start
+    app_name = Column(String, primary_key=True)
+    domain = Column(String, primary_key=True)
+    event_type = Column(String, primary_key=True)
+    country = Column(String, primary_key=True)
+    event_count = Column(BigInteger, nullable=False, default=0)
+    users = Column(LargeBinary, nullable=False)
+    first_seen = Column(DateTime(timezone=True))
+    last_seen = Column(DateTime(timezone=True))
+
+    __table_args__ = (
+        Index('idx_events_daily_app_bucket', 'app_name', 'domain', 'bucket'),
     )
+
+class PageHourly(Base):
+    """Top pages of an hour per app/domain (heavy hitters); ``users`` is a HyperLogLog sketch"""
+    __tablename__ = "pages_hourly"
+
+    bucket = Column(DateTime, primary_key=True)  # UTC hour start
+    app_name = Column(String, primary_key=True)
+    domain = Column(String, primary_key=True)
+    page_url = Column(String, primary_key=True)
+    event_count = Column(BigInteger, nullable=False, default=0)
+    users = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        Index('idx_pages_hourly_app_bucket', 'app_name', 'domain', 'bucket'),
+    )
+
+class PageDaily(Base):
+    """Top pages of a day per app/domain, merged from its hourly top pages"""
+    __tablename__ = "pages_daily"
+
+    bucket = Column(DateTime, primary_key=True)  # UTC day start
+    app_name = Column(String, primary_key=True)
+    domain = Column(String, primary_key=True)
+    page_url = Column(String, primary_key=True)
+    event_count = Column(BigInteger, nullable=False, default=0)
+    users = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        Index('idx_pages_daily_app_bucket', 'app_name', 'domain', 'bucket'),
+    )
+
+class EventId(Base):
+    """Client event ids ingested within the dedup window; the primary key
+    turns away retries that got past the Redis filter"""
+    __tablename__ = "event_ids"
+
+    event_id = Column(String, primary_key=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)  # created_at of the stored event
+
+    __table_args__ = (
+        Index('idx_event_ids_created', 'created_at'),
+    )
+
+class RollupState(Base):
+    """Watermark of the rollup job: every event before ``rolled_up_to`` is aggregated"""
+    __tablename__ = "rollup_state"
+
+    name = Column(String, primary_key=True)
+    rolled_up_to = Column(DateTime, nullable=False)  # UTC hour boundary
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
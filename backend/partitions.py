@@ -0,0 +1,191 @@
+"""Range partitions of the events table: creation ahead of time and retention"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import Session
+
+from analytics import (
+    FIRST_SEEN_COMPLETE, FIRST_SEEN_NAME, RETENTION_NAME, ROLLUP_NAME, SESSIONS_NAME, as_utc
+)
+from models import RollupState
+
+logger = logging.getLogger(__name__)
+
+# "month" or "day"; must match how the table was first partitioned
+PARTITION_INTERVAL = os.getenv("EVENT_PARTITION_INTERVAL", "month")
+# Future partitions kept ready so inserts never hit the default partition
+PARTITIONS_AHEAD = int(os.getenv("EVENT_PARTITIONS_AHEAD", "3"))
+# Raw events older than this are dropped a whole partition at a time (0 keeps everything)
+RETENTION_DAYS = int(os.getenv("EVENT_RETENTION_DAYS", "0"))
+PARTITION_LOCK_ID = 73010002
+
+_NAME_FORMAT = {"month": "events_p%Y%m", "day": "events_p%Y%m%d"}
+
+
+def partition_start(value: datetime) -> datetime:
+    value = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    return value.replace(day=1) if PARTITION_INTERVAL == "month" else value
+
+
+def next_partition(start: datetime) -> datetime:
+    if PARTITION_INTERVAL == "month":
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def partition_name(start: datetime) -> str:
+    return start.strftime(_NAME_FORMAT[PARTITION_INTERVAL])
+
+
+def is_partitioned(db: Session) -> bool:
+    relkind = db.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('events')")).scalar()
+    return relkind == 'p'
+
+
+def existing_partitions(db: Session) -> dict:
+    """Map of partition start (UTC) to partition name, from the naming convention"""
+    names = db.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'events'::regclass"
+    )).scalars()
+
+    partitions = {}
+    for name in names:
+        try:
+            partitions[datetime.strptime(name, _NAME_FORMAT[PARTITION_INTERVAL])] = name
+        except ValueError:
+            continue  # default partition or a partition of another interval
+    return partitions
+
+
+def ensure_partitions(db: Session) -> int:
+    """Create the current and upcoming partitions plus the default catch-all"""
+    db.execute(text("CREATE TABLE IF NOT EXISTS events_default PARTITION OF events DEFAULT"))
+
+    start = partition_start(datetime.utcnow())
+    end = start
+    for _ in range(PARTITIONS_AHEAD + 1):
+        end = next_partition(end)
+    return create_partitions(db, start, end)
+
+
+def create_partitions(db: Session, start: datetime, end: datetime) -> int:
+    """Create the missing partitions covering [start, end) in UTC"""
+    existing = existing_partitions(db)
+    has_default = db.execute(text("SELECT to_regclass('events_default')")).scalar() is not None
+    created = 0
+    start = partition_start(start)
+    while start < end:
+        following = next_partition(start)
+        if start not in existing:
+            if has_default and _default_has_rows(db, start, following):
+                _move_default_rows(db, start, following)
+            else:
+                db.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {partition_name(start)} PARTITION OF events "
+                    f"FOR VALUES FROM ('{start.isoformat()}+00') TO ('{following.isoformat()}+00')"
+                ))
+            created += 1
+        start = following
+    return created
+
+
+def _default_has_rows(db: Session, start: datetime, end: datetime) -> bool:
+    return db.execute(
+        text("SELECT EXISTS (SELECT 1 FROM events_default WHERE created_at >= :start AND created_at < :end)"),
+        {"start": as_utc(start), "end": as_utc(end)}
+    ).scalar()
+
+
+def _move_default_rows(db: Session, start: datetime, end: datetime):
+    """Create the partition of [start, end) out of rows that landed in the
+    default partition, which Postgres refuses to create it over; runs in
+    the caller's transaction so readers never miss the moved rows"""
+    name = partition_name(start)
+    db.execute(text(f"CREATE TABLE {name} (LIKE events INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    moved = db.execute(text(
+        f"WITH moved AS (DELETE FROM events_default WHERE created_at >= :start AND created_at < :end "
+        f"RETURNING *) INSERT INTO {name} SELECT * FROM moved"
+    ), {"start": as_utc(start), "end": as_utc(end)}).rowcount
+    db.execute(text(
+        f"ALTER TABLE events ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{start.isoformat()}+00') TO ('{end.isoformat()}+00')"
+    ))
+    logger.info("Moved %d events from events_default into new partition %s", moved, name)
+
+
+def raw_events_watermark(db: Session) -> datetime:
+    """Every job reading raw events is done with the events before the returned UTC time"""
+    watermark = datetime.max
+    # The rollups and sessionization fold events forwards; a job that never ran holds nothing back
+    for name in (ROLLUP_NAME, SESSIONS_NAME):
+        state = db.get(RollupState, name)
+        if state is not None:
+            watermark = min(watermark, state.rolled_up_to)
+    # The first-seen backfill walks backwards through history and needs all of it until complete
+    state = db.get(RollupState, FIRST_SEEN_NAME)
+    if state is not None and state.rolled_up_to > FIRST_SEEN_COMPLETE:
+        watermark = min(watermark, FIRST_SEEN_COMPLETE)
+    return watermark
+
+
+def drop_expired_partitions(db: Session) -> int:
+    """Drop partitions past the retention window that every job reading raw events already covers"""
+    if RETENTION_DAYS <= 0:
+        return 0
+
+    cutoff = min(datetime.utcnow() - timedelta(days=RETENTION_DAYS), raw_events_watermark(db))
+
+    dropped = 0
+    for start, name in sorted(existing_partitions(db).items()):
+        if next_partition(start) > cutoff:
+            break
+        db.execute(text(f"ALTER TABLE events DETACH PARTITION {name}"))
+        db.execute(text(f"DROP TABLE {name}"))
+        dropped += 1
+        logger.info("Dropped expired events partition %s", name)
+        _record_retained_from(db, next_partition(start))
+    return dropped
+
+
+def _record_retained_from(db: Session, value: datetime):
+    """Remember where raw history now starts, for ``analytics.retained_from``"""
+    state = db.get(RollupState, RETENTION_NAME)
+    if state is None:
+        db.add(RollupState(name=RETENTION_NAME, rolled_up_to=value))
+    elif value > state.rolled_up_to:
+        state.rolled_up_to = value
+
+
+def prepare_partitions(db: Session):
+    """Create the default and upcoming partitions before the API serves
+
+    ``create_all`` makes ``events`` a partitioned table without partitions,
+    which rejects every insert; this waits for the lock rather than leave
+    the table to the first run of the scheduled job.
+    """
+    db.execute(select(func.pg_advisory_xact_lock(PARTITION_LOCK_ID)))
+    if is_partitioned(db):
+        created = ensure_partitions(db)
+        if created:
+            logger.info("Created %d events partitions at startup", created)
+    db.commit()
+
+
+def maintain_partitions(db: Session):
+    """Scheduled job: keep partitions ahead of time and apply retention"""
+    if not db.execute(select(func.pg_try_advisory_xact_lock(PARTITION_LOCK_ID))).scalar():
+        db.rollback()
+        return
+    if not is_partitioned(db):
+        logger.warning("events is not partitioned; run db/migrations/002_partition_events.sql")
+        db.rollback()
+        return
+
+    created = ensure_partitions(db)
+    dropped = drop_expired_partitions(db)
+    db.commit()
+    if created or dropped:
+        logger.info("Events partitions: %d created, %d dropped", created, dropped)
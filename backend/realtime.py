@@ -0,0 +1,267 @@
+"""Real-time snapshot of the last 30 minutes of activity"""
+import asyncio
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, Optional, Set, Tuple
+
+from sqlalchemy import func, distinct, tuple_
+from sqlalchemy.orm import Session
+
+from analytics import app_filters, as_utc, dimension_scopes, filter_scope, utc_naive
+from metrics import current_request
+from models import Event, Session as UserSession
+
+logger = logging.getLogger(__name__)
+
+WINDOW_MINUTES = 30
+TOP_COUNTRIES = 10
+# Pending messages per stream subscriber before it is resynchronized
+SUBSCRIBER_QUEUE_SIZE = 10
+# Per-minute Redis keys outlive the window by a few minutes so readers never
+# see a minute disappear while it is still inside it
+REALTIME_KEY_TTL = (WINDOW_MINUTES + 5) * 60
+# Countries ranked by events whose distinct users are counted for the top list
+COUNTRY_CANDIDATES = TOP_COUNTRIES * 2
+
+
+def realtime_snapshot(
+    db: Session,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+) -> dict:
+    """Active users, users per minute and users by country in two grouped queries"""
+    now = datetime.utcnow()
+    window_start = now - timedelta(minutes=WINDOW_MINUTES)
+    first_minute = (now - timedelta(minutes=WINDOW_MINUTES - 1)).replace(second=0, microsecond=0)
+    minutes = [first_minute + timedelta(minutes=i) for i in range(WINDOW_MINUTES)]
+
+    # Users by minute: one GROUP BY over the minute offset from the first bucket
+    minute = func.floor(
+        func.extract('epoch', Event.created_at - as_utc(first_minute)) / 60
+    ).label('minute')
+    minute_rows = db.query(
+        minute,
+        func.count(distinct(Event.user_id))
+    ).filter(
+        Event.created_at >= as_utc(first_minute),
+        Event.created_at < as_utc(minutes[-1] + timedelta(minutes=1)),
+        *app_filters(app_name, domain)
+    ).group_by(minute).all()
+    users_by_minute = {int(index): users for index, users in minute_rows}
+
+    # Active users and users by country from active sessions; the empty
+    # grouping set adds the overall distinct count as an extra row
+    country_rows = db.query(
+        UserSession.country,
+        func.grouping(UserSession.country).label('is_total'),
+        func.count(distinct(UserSession.user_id)).label('user_count')
+    ).filter(
+        UserSession.last_activity >= as_utc(window_start)
+    ).group_by(
+        func.grouping_sets(UserSession.country, tuple_())
+    ).all()
+
+    active_users = 0
+    users_by_country = []
+    for country, is_total, count in country_rows:
+        if is_total:
+            active_users = count
+        else:
+            users_by_country.append({"country": country or "Unknown", "users": count})
+
+    # Sort by user count descending
+    users_by_country.sort(key=lambda x: x["users"], reverse=True)
+
+    return {
+        "active_users": active_users,
+        "users_by_minute": [
+            {"minute": minute_start.strftime("%H:%M"), "users": users_by_minute.get(index, 0)}
+            for index, minute_start in enumerate(minutes)
+        ],
+        "users_by_country": users_by_country[:TOP_COUNTRIES]
+    }
+
+
+def minute_key(scope: str, minute: datetime) -> str:
+    """Prefix of the per-minute keys of a scope
+
+    ``{prefix}:n`` event count, ``{prefix}:u`` HyperLogLog of user ids,
+    ``{prefix}:c`` sorted set of countries by events and ``{prefix}:u:{country}``
+    HyperLogLog of the users seen from that country.
+    """
+    return f"rt:{scope}:{minute.strftime('%Y%m%d%H%M')}"
+
+
+def queue_realtime_updates(pipe, events: Iterable[Tuple[str, str, str, str, datetime]]):
+    """Queue the per-minute updates for ``(app_name, domain, user_id, country,
+    received_at)`` tuples on a Redis pipeline, aggregated per key first"""
+    counts = Counter()
+    users = defaultdict(set)
+    countries = defaultdict(Counter)
+    for app_name, domain, user_id, country, received_at in events:
+        country = country or "Unknown"
+        minute = utc_naive(received_at)
+        for scope in dimension_scopes(app_name, domain):
+            prefix = minute_key(scope, minute)
+            counts[prefix] += 1
+            users[f"{prefix}:u"].add(user_id)
+            users[f"{prefix}:u:{country}"].add(user_id)
+            countries[prefix][country] += 1
+
+    for prefix, count in counts.items():
+        pipe.incrby(f"{prefix}:n", count)
+        pipe.expire(f"{prefix}:n", REALTIME_KEY_TTL)
+        for country, country_count in countries[prefix].items():
+            pipe.zincrby(f"{prefix}:c", country_count, country)
+        pipe.expire(f"{prefix}:c", REALTIME_KEY_TTL)
+    for key, user_ids in users.items():
+        pipe.pfadd(key, *user_ids)
+        pipe.expire(key, REALTIME_KEY_TTL)
+
+
+async def redis_realtime_snapshot(
+    redis_client,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None
+) -> dict:
+    """``realtime_snapshot`` from the per-minute Redis keys, in two round-trips
+
+    Active users are the union of the window's user sketches rather than
+    sessions with recent activity; both count users seen in the last
+    ``WINDOW_MINUTES`` minutes. Users are only counted for the
+    ``COUNTRY_CANDIDATES`` countries with the most events in the window.
+    """
+    scope = filter_scope(app_name, domain)
+    now = datetime.utcnow()
+    first_minute = (now - timedelta(minutes=WINDOW_MINUTES - 1)).replace(second=0, microsecond=0)
+    prefixes = [minute_key(scope, first_minute + timedelta(minutes=i)) for i in range(WINDOW_MINUTES)]
+    user_keys = [f"{prefix}:u" for prefix in prefixes]
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key in user_keys:
+        pipe.pfcount(key)
+    pipe.pfcount(*user_keys)
+    for prefix in prefixes:
+        pipe.zrange(f"{prefix}:c", 0, -1, withscores=True)
+    replies = await pipe.execute()
+
+    per_minute = replies[:WINDOW_MINUTES]
+    active_users = replies[WINDOW_MINUTES]
+    country_events = Counter()
+    for members in replies[WINDOW_MINUTES + 1:]:
+        for country, score in members:
+            country_events[country.decode() if isinstance(country, bytes) else country] += score
+
+    candidates = [country for country, _ in country_events.most_common(COUNTRY_CANDIDATES)]
+    users_by_country = []
+    if candidates:
+        pipe = redis_client.pipeline(transaction=False)
+        for country in candidates:
+            pipe.pfcount(*[f"{prefix}:u:{country}" for prefix in prefixes])
+        counts = await pipe.execute()
+        users_by_country = [
+            {"country": country, "users": users}
+            for country, users in zip(candidates, counts) if users
+        ]
+        users_by_country.sort(key=lambda x: x["users"], reverse=True)
+
+    return {
+        "active_users": active_users,
+        "users_by_minute": [
+            {"minute": (first_minute + timedelta(minutes=i)).strftime("%H:%M"), "users": users}
+            for i, users in enumerate(per_minute)
+        ],
+        "users_by_country": users_by_country[:TOP_COUNTRIES]
+    }
+
+
+def snapshot_delta(previous: dict, current: dict) -> Optional[dict]:
+    """Fields of ``current`` that differ from ``previous``; minutes are sent
+    individually so clients only receive the buckets that changed or slid in"""
+    delta = {}
+    if current["active_users"] != previous["active_users"]:
+        delta["active_users"] = current["active_users"]
+
+    previous_minutes = {m["minute"]: m["users"] for m in previous["users_by_minute"]}
+    minutes = [m for m in current["users_by_minute"] if previous_minutes.get(m["minute"]) != m["users"]]
+    if minutes:
+        delta["users_by_minute"] = minutes
+
+    if current["users_by_country"] != previous["users_by_country"]:
+        delta["users_by_country"] = current["users_by_country"]
+
+    return delta or None
+
+
+class RealtimeBroadcaster:
+    """Shares one realtime computation per (app_name, domain) among all subscribers
+
+    The first subscriber for a filter starts a ticker that computes the
+    snapshot every ``interval`` seconds; every subscriber receives the full
+    snapshot on connect and deltas afterwards. The ticker stops when the
+    last subscriber leaves, so cost scales with distinct filters rather than
+    with open dashboards.
+    """
+
+    def __init__(self, compute: Callable[[Optional[str], Optional[str]], Awaitable[dict]], interval: float):
+        self.compute = compute
+        self.interval = interval
+        self.subscribers: Dict[tuple, Set[asyncio.Queue]] = {}
+        self.tickers: Dict[tuple, asyncio.Task] = {}
+        self.latest: Dict[tuple, dict] = {}
+
+    def subscribe(self, app_name: Optional[str], domain: Optional[str]) -> asyncio.Queue:
+        key = (app_name, domain)
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers.setdefault(key, set()).add(queue)
+        if key in self.latest:
+            queue.put_nowait(("snapshot", self.latest[key]))
+        if key not in self.tickers:
+            self.tickers[key] = asyncio.create_task(self._tick(key))
+        return queue
+
+    def unsubscribe(self, app_name: Optional[str], domain: Optional[str], queue: asyncio.Queue):
+        key = (app_name, domain)
+        subscribers = self.subscribers.get(key, set())
+        subscribers.discard(queue)
+        if not subscribers:
+            self.subscribers.pop(key, None)
+            self.latest.pop(key, None)
+            ticker = self.tickers.pop(key, None)
+            if ticker:
+                ticker.cancel()
+
+    async def stop(self):
+        for ticker in self.tickers.values():
+            ticker.cancel()
+        await asyncio.gather(*self.tickers.values(), return_exceptions=True)
+        self.tickers.clear()
+
+    async def _tick(self, key: tuple):
+        # Started from the first subscriber's request; the work is shared, not theirs
+        current_request.set(None)
+        while True:
+            try:
+                snapshot = await self.compute(*key)
+            except Exception:
+                logger.exception("Realtime snapshot for %s failed", key)
+            else:
+                self._publish(key, snapshot)
+            await asyncio.sleep(self.interval)
+
+    def _publish(self, key: tuple, snapshot: dict):
+        previous = self.latest.get(key)
+        self.latest[key] = snapshot
+        delta = snapshot_delta(previous, snapshot) if previous else None
+        if previous and delta is None:
+            return
+
+        for queue in self.subscribers.get(key, ()):
+            if queue.full():
+                # A slow client missed deltas; resynchronize it with a full snapshot
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(("snapshot", snapshot))
+            else:
+                queue.put_nowait(("delta", delta) if previous else ("snapshot", snapshot))
@@ -0,0 +1,315 @@
+"""Incremental maintenance of the hourly and daily event rollups"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, distinct, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from analytics import (
+    ROLLUP_NAME, event_app_name, event_domain, event_country,
+    as_utc, utc_naive, floor_hour, ceil_hour, floor_day
+)
+from models import Event, EventHourly, EventDaily, PageHourly, PageDaily, RollupState
+from sketches import HyperLogLog
+
+logger = logging.getLogger(__name__)
+
+# Events may reach Postgres a little after they happened (write-behind
+# queue, client retries), so an hour is only closed once this has passed
+ROLLUP_GRACE = timedelta(minutes=int(os.getenv("ROLLUP_GRACE_MINUTES", "5")))
+# Hours aggregated per transaction while catching up on a backlog
+ROLLUP_CHUNK_HOURS = 24
+# Postgres advisory lock id keeping concurrent API workers from double counting
+ROLLUP_LOCK_ID = 73010001
+# Pages kept per hour and per day for each app/domain; rarer pages are dropped
+PAGE_TOP_K = int(os.getenv("PAGE_TOP_K", "100"))
+
+hour_bucket = func.date_trunc('hour', func.timezone('UTC', Event.created_at))
+
+
+def run_rollups(db: Session) -> int:
+    """Aggregate every closed hour since the watermark; returns hours processed"""
+    processed = 0
+    while True:
+        hours = _rollup_chunk(db)
+        if not hours:
+            return processed
+        processed += hours
+
+
+def _rollup_chunk(db: Session) -> int:
+    if not db.execute(select(func.pg_try_advisory_xact_lock(ROLLUP_LOCK_ID))).scalar():
+        db.rollback()
+        return 0
+
+    state = db.get(RollupState, ROLLUP_NAME)
+    if state is None:
+        # min() over the bare column can be answered from each partition's index
+        first_event = db.query(func.min(Event.created_at)).scalar()
+        if first_event is None:
+            db.rollback()
+            return 0
+        state = RollupState(name=ROLLUP_NAME, rolled_up_to=floor_hour(utc_naive(first_event)))
+        db.add(state)
+
+    start = state.rolled_up_to
+    end = min(floor_hour(datetime.utcnow() - ROLLUP_GRACE), start + timedelta(hours=ROLLUP_CHUNK_HOURS))
+    if end <= start:
+        db.commit()
+        return 0
+
+    hourly = _aggregate_hours(db, start, end)
+    if hourly:
+        _upsert(db, EventHourly, hourly)
+        _upsert(db, EventDaily, _merge_into_days(db, hourly))
+    _rollup_pages(db, start, end)
+
+    state.rolled_up_to = end
+    db.commit()
+
+    hours = int((end - start).total_seconds() // 3600)
+    logger.info("Rolled up %d hours (%d rows) up to %s", hours, len(hourly), end)
+    return hours
+
+
+def rebuild_rollups(db: Session, start: datetime, end: datetime) -> int:
+    """Recompute the rollups of already rolled-up hours in [start, end)
+
+    For events written behind the watermark, e.g. by a bulk import: the
+    affected hours are regrouped from raw events and their days rebuilt
+    from the hourly rows. Hours past the watermark are left to the job.
+    Returns hours rebuilt.
+    """
+    # Wait for the job rather than skipping: the caller needs the rebuild done
+    db.execute(select(func.pg_advisory_xact_lock(ROLLUP_LOCK_ID)))
+    watermark = db.query(RollupState.rolled_up_to).filter(RollupState.name == ROLLUP_NAME).scalar()
+    start = floor_hour(utc_naive(start))
+    end = min(ceil_hour(utc_naive(end)), watermark) if watermark else start
+    if end <= start:
+        db.commit()
+        return 0
+
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(end, chunk_start + timedelta(hours=ROLLUP_CHUNK_HOURS))
+        db.query(EventHourly).filter(
+            EventHourly.bucket >= chunk_start, EventHourly.bucket < chunk_end
+        ).delete(synchronize_session=False)
+        hourly = _aggregate_hours(db, chunk_start, chunk_end)
+        if hourly:
+            _upsert(db, EventHourly, hourly)
+        db.query(PageHourly).filter(
+            PageHourly.bucket >= chunk_start, PageHourly.bucket < chunk_end
+        ).delete(synchronize_session=False)
+        _insert_top_pages(db, chunk_start, chunk_end)
+        chunk_start = chunk_end
+
+    day = floor_day(start)
+    while day < end:
+        _rebuild_day(db, day)
+        _rebuild_page_day(db, day)
+        day += timedelta(days=1)
+
+    db.commit()
+    hours = int((end - start).total_seconds() // 3600)
+    logger.info("Rebuilt rollups for %d hours from %s", hours, start)
+    return hours
+
+
+def _aggregate_hours(db: Session, start: datetime, end: datetime) -> list:
+    """Hourly rollup rows for raw events in [start, end)"""
+    rows = db.query(
+        hour_bucket,
+        event_app_name,
+        event_domain,
+        Event.event_type,
+        event_country,
+        func.count(Event.id),
+        func.min(Event.created_at),
+        func.max(Event.created_at),
+        func.array_agg(distinct(Event.user_id))
+    ).filter(
+        Event.created_at >= as_utc(start),
+        Event.created_at < as_utc(end)
+    ).group_by(
+        hour_bucket, event_app_name, event_domain, Event.event_type, event_country
+    ).all()
+
+    hourly = []
+    for bucket, app_name, domain, event_type, country, count, first_seen, last_seen, user_ids in rows:
+        hourly.append({
+            "bucket": bucket,
+            "app_name": app_name,
+            "domain": domain,
+            "event_type": event_type,
+            "country": country,
+            "event_count": count,
+            "users": HyperLogLog().update(user_ids).to_bytes(),
+            "first_seen": first_seen,
+            "last_seen": last_seen,
+        })
+    return hourly
+
+
+def _rebuild_day(db: Session, day: datetime):
+    """Replace a day's daily rows with the merge of its hourly rows"""
+    hourly = db.query(EventHourly).filter(
+        EventHourly.bucket >= day, EventHourly.bucket < day + timedelta(days=1)
+    ).all()
+    db.query(EventDaily).filter(EventDaily.bucket == day).delete(synchronize_session=False)
+
+    days = {}
+    for row in hourly:
+        key = (row.app_name, row.domain, row.event_type, row.country)
+        current = days.get(key)
+        if current is None:
+            days[key] = {
+                "bucket": day,
+                "app_name": row.app_name,
+                "domain": row.domain,
+                "event_type": row.event_type,
+                "country": row.country,
+                "event_count": row.event_count,
+                "users": HyperLogLog().merge_bytes(row.users),
+                "first_seen": row.first_seen,
+                "last_seen": row.last_seen,
+            }
+            continue
+        current["event_count"] += row.event_count
+        current["users"].merge_bytes(row.users)
+        current["first_seen"] = min(current["first_seen"], row.first_seen)
+        current["last_seen"] = max(current["last_seen"], row.last_seen)
+
+    if days:
+        _upsert(db, EventDaily, [dict(row, users=row["users"].to_bytes()) for row in days.values()])
+
+
+def _merge_into_days(db: Session, hourly: list) -> list:
+    """Fold freshly closed hours into the existing daily rows they belong to"""
+    days = {}
+    for row in hourly:
+        key = (floor_day(row["bucket"]), row["app_name"], row["domain"], row["event_type"], row["country"])
+        day = days.get(key)
+        if day is None:
+            days[key] = dict(row, bucket=key[0], users=HyperLogLog().merge_bytes(row["users"]))
+            continue
+        day["event_count"] += row["event_count"]
+        day["users"].merge_bytes(row["users"])
+        day["first_seen"] = min(day["first_seen"], row["first_seen"])
+        day["last_seen"] = max(day["last_seen"], row["last_seen"])
+
+    existing = db.query(EventDaily).filter(
+        tuple_(
+            EventDaily.bucket, EventDaily.app_name, EventDaily.domain,
+            EventDaily.event_type, EventDaily.country
+        ).in_(list(days.keys()))
+    ).all()
+    for current in existing:
+        day = days[(current.bucket, current.app_name, current.domain, current.event_type, current.country)]
+        day["event_count"] += current.event_count
+        day["users"].merge_bytes(current.users)
+        if current.first_seen:
+            day["first_seen"] = min(day["first_seen"], current.first_seen)
+        if current.last_seen:
+            day["last_seen"] = max(day["last_seen"], current.last_seen)
+
+    return [dict(day, users=day["users"].to_bytes()) for day in days.values()]
+
+
+def _rollup_pages(db: Session, start: datetime, end: datetime):
+    """Top pages of the hours in [start, end) and of the days they belong to"""
+    if not _insert_top_pages(db, start, end):
+        return
+    day = floor_day(start)
+    while day < end:
+        _rebuild_page_day(db, day)
+        day += timedelta(days=1)
+
+
+def _insert_top_pages(db: Session, start: datetime, end: datetime) -> int:
+    """Write the PAGE_TOP_K busiest pages of each hour and app/domain in [start, end)"""
+    event_count = func.count(Event.id)
+    ranked = select(
+        hour_bucket.label('bucket'),
+        event_app_name.label('app_name'),
+        event_domain.label('domain'),
+        Event.page_url,
+        event_count.label('event_count'),
+        func.array_agg(distinct(Event.user_id)).label('user_ids'),
+        func.row_number().over(
+            partition_by=(hour_bucket, event_app_name, event_domain),
+            order_by=event_count.desc()
+        ).label('rank')
+    ).where(
+        Event.created_at >= as_utc(start),
+        Event.created_at < as_utc(end),
+        Event.page_url.isnot(None)
+    ).group_by(hour_bucket, event_app_name, event_domain, Event.page_url).subquery()
+
+    rows = [
+        {
+            "bucket": row.bucket,
+            "app_name": row.app_name,
+            "domain": row.domain,
+            "page_url": row.page_url,
+            "event_count": row.event_count,
+            "users": HyperLogLog().update(row.user_ids).to_bytes(),
+        }
+        for row in db.execute(select(ranked).where(ranked.c.rank <= PAGE_TOP_K))
+    ]
+    if rows:
+        db.execute(insert(PageHourly).values(rows).on_conflict_do_nothing())
+    return len(rows)
+
+
+def _rebuild_page_day(db: Session, day: datetime):
+    """Replace a day's top pages with the top of its hours' merged top pages"""
+    hourly = db.query(PageHourly).filter(
+        PageHourly.bucket >= day, PageHourly.bucket < day + timedelta(days=1)
+    ).all()
+    db.query(PageDaily).filter(PageDaily.bucket == day).delete(synchronize_session=False)
+
+    pages = {}
+    for row in hourly:
+        key = (row.app_name, row.domain, row.page_url)
+        page = pages.get(key)
+        if page is None:
+            pages[key] = page = {"event_count": 0, "users": HyperLogLog()}
+        page["event_count"] += row.event_count
+        page["users"].merge_bytes(row.users)
+
+    by_app = {}
+    for (app_name, domain, page_url), page in pages.items():
+        by_app.setdefault((app_name, domain), []).append((page["event_count"], page_url, page["users"]))
+    rows = []
+    for (app_name, domain), app_pages in by_app.items():
+        app_pages.sort(key=lambda page: page[0], reverse=True)
+        rows += [
+            {
+                "bucket": day,
+                "app_name": app_name,
+                "domain": domain,
+                "page_url": page_url,
+                "event_count": event_count,
+                "users": users.to_bytes(),
+            }
+            for event_count, page_url, users in app_pages[:PAGE_TOP_K]
+        ]
+    if rows:
+        db.execute(insert(PageDaily).values(rows))
+
+
+def _upsert(db: Session, model, rows: list):
+    stmt = insert(model).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["bucket", "app_name", "domain", "event_type", "country"],
+        set_={
+            "event_count": stmt.excluded.event_count,
+            "users": stmt.excluded.users,
+            "first_seen": stmt.excluded.first_seen,
+            "last_seen": stmt.excluded.last_seen,
+        }
+    )
+    db.execute(stmt)
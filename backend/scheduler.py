@@ -0,0 +1,63 @@
+"""Periodic background jobs run inside the API process"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """Runs blocking ``job(db)`` callables on a fixed interval in worker threads
+
+    Jobs that must not run concurrently across API workers are expected to
+    take a Postgres advisory lock themselves.
+    """
+
+    def __init__(self):
+        self.jobs: List[tuple] = []
+        self.tasks: List[asyncio.Task] = []
+        self.stats: Dict[str, dict] = {}
+
+    def add(self, name: str, interval: float, job: Callable):
+        if interval > 0:
+            self.jobs.append((name, interval, job))
+            self.stats[name] = {"interval": interval, "runs": 0, "errors": 0, "last_run": None, "last_duration_ms": 0.0}
+
+    async def start(self):
+        for name, interval, job in self.jobs:
+            self.tasks.append(asyncio.create_task(self._loop(name, interval, job)))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def _loop(self, name: str, interval: float, job: Callable):
+        while True:
+            await self.run(name, job)
+            await asyncio.sleep(interval)
+
+    async def run(self, name: str, job: Callable):
+        stats = self.stats[name]
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self._call, job)
+        except Exception:
+            stats["errors"] += 1
+            logger.exception("Background job %s failed", name)
+        stats["runs"] += 1
+        stats["last_run"] = datetime.utcnow().isoformat()
+        stats["last_duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    @staticmethod
+    def _call(job: Callable):
+        db = SessionLocal()
+        try:
+            job(db)
+        finally:
+            db.close()
@@ -9,6 +9,8 @@ class EventCreate(BaseModel):
     page_url: Optional[str] = None
     country: Optional[str] = "Unknown"
     properties: Optional[Dict[str, Any]] = {}
+    # Idempotency key (e.g. a UUID generated by the SDK); retries reusing it are dropped
+    event_id: Optional[str] = None
 
 class EventResponse(BaseModel):
     id: int
@@ -17,11 +19,15 @@ class EventResponse(BaseModel):
     session_id: str
     page_url: Optional[str]
     country: Optional[str]
+    event_id: Optional[str] = None
     created_at: datetime
 
     class Config:
         from_attributes = True
 
+class EventBatchResponse(BaseModel):
+    accepted: int
+
 class TrendDataPoint(BaseModel):
     date: str
     users: int
@@ -35,7 +41,50 @@ class AnalyticsSummary(BaseModel):
     conversions_change: float
     new_users: int
     new_users_change: float
+    sessions: int = 0
+    sessions_change: float = 0.0
+    avg_session_duration: float = 0.0  # seconds
+    avg_session_duration_change: float = 0.0
+    bounce_rate: float = 0.0  # % of sessions with a single event
+    bounce_rate_change: float = 0.0
+    pages_per_session: float = 0.0
     trend_data: List[TrendDataPoint]
+    source: str = "raw"  # "raw", "rollups" or "views"
+    data_as_of: Optional[datetime] = None  # events up to this time are reflected
+    retained_from: Optional[datetime] = None  # set when retention dropped raw events the range needs
+
+class FunnelStep(BaseModel):
+    event_type: str
+    users: int
+    conversion_rate: float  # % of users entering the funnel
+    step_conversion_rate: float  # % of users reaching the previous step
+
+class FunnelReport(BaseModel):
+    window_hours: float
+    steps: List[FunnelStep]
+    retained_from: Optional[datetime] = None  # set when retention dropped raw events the range needs
+
+class RetentionCohort(BaseModel):
+    cohort: str
+    users: int
+    retained: List[int]  # active users per period since the cohort's first
+    retention: List[float]
+
+class RetentionReport(BaseModel):
+    period: str
+    cohorts: List[RetentionCohort]
+    retained_from: Optional[datetime] = None  # set when retention dropped raw events the range needs
+
+class BreakdownValue(BaseModel):
+    value: str
+    events: int
+    users: int
+
+class BreakdownReport(BaseModel):
+    dimension: str
+    approximate: bool  # users are sketch estimates, page counts lower bounds
+    values: List[BreakdownValue]
+    retained_from: Optional[datetime] = None  # set when retention dropped raw events the range needs
 
 class MinuteData(BaseModel):
     minute: str
@@ -0,0 +1,134 @@
+"""In-process cache of session state for coalescing session writes at ingest"""
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import List
+
+
+class SessionStateCache:
+    """LRU + TTL map of session_id to the session's last known state
+
+    Ingest asks the cache which session rows actually need writing: sessions
+    it has not seen, sessions whose country can be upgraded from "Unknown"
+    and sessions whose ``last_activity`` was last written ``write_interval``
+    or more earlier. Other events only advance the cached ``last_activity``
+    and mark the entry dirty; ``take_dirty`` hands those to a periodic flush,
+    and evicted dirty entries are written with the batch that evicted them.
+    Rows whose transaction fails come back through ``restore`` as dirty.
+    The cache is shared by the event loop, the ingest queue thread and the
+    scheduler thread, hence the lock.
+    """
+
+    def __init__(self, max_size: int, ttl: float, write_interval: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.write_interval = timedelta(seconds=write_interval)
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def plan(self, sessions: List[dict]) -> List[dict]:
+        """Session rows from a batch that must be upserted now"""
+        if self.max_size <= 0 or not self.write_interval:
+            return sessions
+
+        now = time.monotonic()
+        writes = []
+        with self._lock:
+            for row in sessions:
+                entry = self._entries.get(row["session_id"])
+                if entry is not None and now - entry["seen"] > self.ttl:
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    writes.append(row)
+                    self._store(row, now)
+                    continue
+
+                self.hits += 1
+                self._entries.move_to_end(row["session_id"])
+                entry["seen"] = now
+                last_activity = max(entry["last_activity"], row["last_activity"])
+                upgrade_country = entry["country"] == "Unknown" and row["country"] != "Unknown"
+                if upgrade_country or last_activity - entry["written"] >= self.write_interval:
+                    writes.append(dict(row, last_activity=last_activity))
+                    self._store(dict(row, last_activity=last_activity), now)
+                else:
+                    self.coalesced += 1
+                    entry["last_activity"] = last_activity
+                    entry["dirty"] = True
+
+            while len(self._entries) > self.max_size:
+                session_id, entry = self._entries.popitem(last=False)
+                if entry["dirty"]:
+                    writes.append(self._row(session_id, entry))
+        return writes
+
+    def take_dirty(self) -> List[dict]:
+        """Rows for every entry whose latest activity has not been written yet"""
+        rows = []
+        with self._lock:
+            for session_id, entry in self._entries.items():
+                if entry["dirty"]:
+                    rows.append(self._row(session_id, entry))
+                    entry["written"] = entry["last_activity"]
+                    entry["dirty"] = False
+        return rows
+
+    def restore(self, rows: List[dict]):
+        """Mark rows from ``plan`` or ``take_dirty`` that were not committed as
+        unwritten again, so the next flush retries them"""
+        if self.max_size <= 0 or not self.write_interval:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            for row in rows:
+                entry = self._entries.get(row["session_id"])
+                if entry is None:
+                    self._store(row, now)
+                    entry = self._entries[row["session_id"]]
+                else:
+                    entry["last_activity"] = max(entry["last_activity"], row["last_activity"])
+                    entry["start_time"] = min(entry["start_time"], row["start_time"])
+                    if entry["country"] == "Unknown":
+                        entry["country"] = row["country"]
+                entry["dirty"] = True
+
+    def _store(self, row: dict, now: float):
+        self._entries[row["session_id"]] = {
+            "user_id": row["user_id"],
+            "start_time": row["start_time"],
+            "country": row["country"],
+            "last_activity": row["last_activity"],
+            "written": row["last_activity"],
+            "dirty": False,
+            "seen": now,
+        }
+        self._entries.move_to_end(row["session_id"])
+
+    @staticmethod
+    def _row(session_id: str, entry: dict) -> dict:
+        # start_time only matters on insert, i.e. for a restored new session
+        return {
+            "session_id": session_id,
+            "user_id": entry["user_id"],
+            "start_time": entry["start_time"],
+            "last_activity": entry["last_activity"],
+            "country": entry["country"],
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            dirty = sum(1 for entry in self._entries.values() if entry["dirty"])
+            return {
+                "size": len(self._entries),
+                "dirty": dirty,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+            }
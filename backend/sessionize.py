@@ -0,0 +1,153 @@
+"""Incremental sessionization: per-session metrics folded from events into sessions"""
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, distinct, func, select
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg, insert
+from sqlalchemy.orm import Session
+
+from analytics import SESSIONS_NAME, as_utc, utc_naive, floor_hour
+from models import Event, RollupState, Session as UserSession
+from rollups import ROLLUP_GRACE
+
+logger = logging.getLogger(__name__)
+
+# Hours of events folded in per transaction while catching up on a backlog
+SESSIONIZE_CHUNK_HOURS = 6
+# Postgres advisory lock id keeping concurrent API workers from counting events twice
+SESSIONIZE_LOCK_ID = 73010005
+
+
+def run_sessionization(db: Session) -> int:
+    """Fold every event before the grace period since the watermark into the
+    session metrics; returns hours processed"""
+    processed = 0
+    while True:
+        hours = _sessionize_chunk(db)
+        if not hours:
+            return processed
+        processed += hours
+
+
+def _sessionize_chunk(db: Session) -> int:
+    if not db.execute(select(func.pg_try_advisory_xact_lock(SESSIONIZE_LOCK_ID))).scalar():
+        db.rollback()
+        return 0
+
+    state = db.get(RollupState, SESSIONS_NAME)
+    if state is None:
+        first_event = db.query(func.min(Event.created_at)).scalar()
+        if first_event is None:
+            db.rollback()
+            return 0
+        state = RollupState(name=SESSIONS_NAME, rolled_up_to=floor_hour(utc_naive(first_event)))
+        db.add(state)
+
+    start = state.rolled_up_to
+    end = min(datetime.utcnow() - ROLLUP_GRACE, start + timedelta(hours=SESSIONIZE_CHUNK_HOURS))
+    if end <= start:
+        db.commit()
+        return 0
+
+    sessions = _upsert_metrics(db, [
+        Event.created_at >= as_utc(start),
+        Event.created_at < as_utc(end)
+    ], replace=False)
+
+    state.rolled_up_to = end
+    db.commit()
+
+    logger.info("Sessionized events up to %s (%d sessions)", end, sessions)
+    return max(int((end - start).total_seconds() // 3600), 1)
+
+
+def rebuild_session_metrics(db: Session, start: datetime, end: datetime) -> int:
+    """Recompute the metrics of sessions with events in [start, end) behind
+    the watermark, e.g. after a bulk import; returns sessions rebuilt
+
+    Events past the watermark are left to the job.
+    """
+    db.execute(select(func.pg_advisory_xact_lock(SESSIONIZE_LOCK_ID)))
+    watermark = db.query(RollupState.rolled_up_to).filter(RollupState.name == SESSIONS_NAME).scalar()
+    if watermark is None or utc_naive(start) >= watermark:
+        db.commit()
+        return 0
+
+    touched = select(distinct(Event.session_id)).where(
+        Event.created_at >= as_utc(start),
+        Event.created_at < as_utc(min(utc_naive(end), watermark))
+    )
+    sessions = _upsert_metrics(db, [
+        Event.session_id.in_(touched),
+        Event.created_at < as_utc(watermark)
+    ], replace=True)
+    db.commit()
+
+    logger.info("Rebuilt metrics of %d sessions", sessions)
+    return sessions
+
+
+def _upsert_metrics(db: Session, filters: list, replace: bool) -> int:
+    """Aggregate the events matching ``filters`` per session, in created_at
+    order, and merge the results into sessions
+
+    A chunk's events all follow the previous chunk's, so its exit page
+    replaces the stored one and its entry page only fills an empty one.
+    With ``replace`` the filters cover each session's whole history and
+    the metrics are overwritten instead of added to.
+    """
+    first_event = func.min(Event.created_at)
+    last_event = func.max(Event.created_at)
+    event_count = func.count()
+    grouped = select(
+        Event.session_id,
+        func.min(Event.user_id),
+        first_event,
+        last_event,
+        func.min(Event.country),
+        func.min(Event.app_name),
+        func.min(Event.domain),
+        event_count,
+        func.count().filter(Event.event_type == 'pageview'),
+        func.extract('epoch', last_event - first_event).cast(UserSession.duration_seconds.type),
+        array_agg(aggregate_order_by(Event.page_url, Event.created_at))[1],
+        array_agg(aggregate_order_by(Event.page_url, Event.created_at.desc()))[1],
+        event_count == 1
+    ).where(*filters).group_by(Event.session_id)
+
+    stmt = insert(UserSession).from_select([
+        "session_id", "user_id", "start_time", "last_activity", "country", "app_name", "domain",
+        "event_count", "pageviews", "duration_seconds", "entry_page", "exit_page", "bounced"
+    ], grouped)
+    excluded = stmt.excluded
+    start_time = func.least(UserSession.start_time, excluded.start_time)
+    duration = func.extract('epoch', excluded.last_activity - start_time).cast(UserSession.duration_seconds.type)
+    if replace:
+        metrics = {
+            "event_count": excluded.event_count,
+            "pageviews": excluded.pageviews,
+            "duration_seconds": duration,
+            "entry_page": excluded.entry_page,
+            "exit_page": excluded.exit_page,
+            "bounced": excluded.bounced,
+        }
+    else:
+        metrics = {
+            "event_count": UserSession.event_count + excluded.event_count,
+            "pageviews": UserSession.pageviews + excluded.pageviews,
+            "duration_seconds": func.greatest(UserSession.duration_seconds, duration),
+            "entry_page": case((UserSession.event_count == 0, excluded.entry_page), else_=UserSession.entry_page),
+            "exit_page": excluded.exit_page,
+            "bounced": UserSession.event_count + excluded.event_count == 1,
+        }
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserSession.session_id],
+        set_=dict(
+            metrics,
+            start_time=start_time,
+            last_activity=func.greatest(UserSession.last_activity, excluded.last_activity),
+            app_name=func.coalesce(UserSession.app_name, excluded.app_name),
+            domain=func.coalesce(UserSession.domain, excluded.domain),
+        )
+    )
+    return db.execute(stmt).rowcount
@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+import ingest
+from schemas import EventCreate
+
+
+class FakeSession:
+    def close(self):
+        pass
+
+
+class FakeDeduplicator:
+    def __init__(self):
+        self.released = []
+
+    async def release(self, event_ids):
+        self.released += event_ids
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Batches handed to write_events; every event is stored"""
+    batches = []
+
+    def write_events(db, events, received_at):
+        batches.append([event.event_id for event in events])
+        return list(range(len(events)))
+
+    monkeypatch.setattr(ingest, "SessionLocal", FakeSession)
+    monkeypatch.setattr(ingest, "write_events", write_events)
+    monkeypatch.setattr(ingest, "record_realtime", lambda redis_client, events, received_at: None)
+    return batches
+
+
+def make_events(count):
+    return [EventCreate(event_type="pageview", user_id="u", session_id="s", event_id=str(i)) for i in range(count)]
+
+
+def run_queue(queue, scenario):
+    async def main():
+        await queue.start()
+        await scenario()
+        await queue.stop()
+    asyncio.run(main())
+
+
+def test_flushes_in_batches_of_batch_size(written):
+    queue = ingest.IngestQueue(None, max_size=100, batch_size=4, flush_interval=0.01)
+
+    async def scenario():
+        queue.put_many(make_events(10))
+        await asyncio.sleep(0.1)
+
+    run_queue(queue, scenario)
+    assert [len(batch) for batch in written] == [4, 4, 2]
+    assert queue.stats()["flushed"] == 10
+
+
+def test_stop_writes_the_batch_being_collected(written):
+    # Long enough that only stop() can end the collection
+    queue = ingest.IngestQueue(None, max_size=100, batch_size=500, flush_interval=60)
+
+    async def scenario():
+        queue.put_many(make_events(10))
+        await asyncio.sleep(0.05)
+
+    run_queue(queue, scenario)
+    assert sum(written, []) == [str(i) for i in range(10)]
+
+
+def test_full_queue_rejects_the_whole_request(written):
+    queue = ingest.IngestQueue(None, max_size=5, batch_size=500, flush_interval=60)
+
+    async def scenario():
+        assert queue.put_many(make_events(3))
+        assert not queue.put_many(make_events(3))
+
+    run_queue(queue, scenario)
+    assert queue.stats()["rejected"] == 3
+    assert len(sum(written, [])) == 3
+
+
+def test_failed_write_releases_claimed_ids(monkeypatch):
+    def write_events(db, events, received_at):
+        raise RuntimeError("database unavailable")
+
+    monkeypatch.setattr(ingest, "SessionLocal", FakeSession)
+    monkeypatch.setattr(ingest, "write_events", write_events)
+    deduplicator = FakeDeduplicator()
+    queue = ingest.IngestQueue(None, max_size=100, batch_size=500, flush_interval=0.01, deduplicator=deduplicator)
+
+    async def scenario():
+        queue.put_many(make_events(3), claimed=["0", "2"])
+        await asyncio.sleep(0.1)
+
+    run_queue(queue, scenario)
+    assert deduplicator.released == ["0", "2"]
+    assert queue.stats()["failed"] == 3
+
+
+def test_realtime_failure_keeps_the_batch_written(written, monkeypatch):
+    def record_realtime(redis_client, events, received_at):
+        raise ConnectionError("redis unavailable")
+
+    monkeypatch.setattr(ingest, "record_realtime", record_realtime)
+    deduplicator = FakeDeduplicator()
+    queue = ingest.IngestQueue(None, max_size=100, batch_size=500, flush_interval=0.01, deduplicator=deduplicator)
+
+    async def scenario():
+        queue.put_many(make_events(2), claimed=["0", "1"])
+        await asyncio.sleep(0.1)
+
+    run_queue(queue, scenario)
+    stats = queue.stats()
+    assert (stats["flushed"], stats["failed"], stats["realtime_failed"]) == (2, 0, 2)
+    assert deduplicator.released == []
+
+
+def test_realtime_counts_only_stored_events(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(ingest, "SessionLocal", FakeSession)
+    # The second event duplicates one already in the database
+    monkeypatch.setattr(ingest, "write_events", lambda db, events, received_at: [0, 2])
+    monkeypatch.setattr(
+        ingest, "record_realtime",
+        lambda redis_client, events, received_at: recorded.extend(event.event_id for event in events)
+    )
+    queue = ingest.IngestQueue(None, max_size=100, batch_size=500, flush_interval=0.01)
+
+    async def scenario():
+        queue.put_many(make_events(3))
+        await asyncio.sleep(0.1)
+
+    run_queue(queue, scenario)
+    assert recorded == ["0", "2"]
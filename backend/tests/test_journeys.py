@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+from journeys import funnel_report
+
+START = datetime(2026, 1, 1)
+STEPS = ["pageview", "click", "conversion"]
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def partitions(self):
+        yield self.rows
+
+
+class FakeDB:
+    """Serves funnel rows as the query would: sorted by user and time"""
+
+    def __init__(self, events):
+        self.rows = sorted(
+            ((user_id, event_type, START + timedelta(hours=hours)) for user_id, event_type, hours in events),
+            key=lambda row: (row[0], row[2])
+        )
+
+    def execute(self, statement):
+        return FakeResult(self.rows)
+
+    def get(self, model, name):
+        return None
+
+
+def reached(events, steps=STEPS, window_hours=24):
+    report = funnel_report(FakeDB(events), steps, START, START + timedelta(days=7), timedelta(hours=window_hours))
+    return [step["users"] for step in report["steps"]]
+
+
+def test_users_count_for_every_step_up_to_their_furthest():
+    assert reached([
+        ("a", "pageview", 0), ("a", "click", 1), ("a", "conversion", 2),
+        ("b", "pageview", 0), ("b", "click", 1),
+        ("c", "pageview", 0),
+    ]) == [3, 2, 1]
+
+
+def test_steps_must_happen_in_order():
+    assert reached([("a", "click", 0), ("a", "pageview", 1), ("a", "conversion", 2)]) == [1, 0, 0]
+
+
+def test_steps_must_fall_within_the_window_of_the_first_step():
+    assert reached([("a", "pageview", 0), ("a", "click", 1), ("a", "conversion", 30)]) == [1, 1, 0]
+
+
+def test_a_later_first_step_restarts_the_window():
+    assert reached([
+        ("a", "pageview", 0), ("a", "click", 1),
+        ("a", "pageview", 40), ("a", "click", 41), ("a", "conversion", 50),
+    ]) == [1, 1, 1]
+
+
+def test_repeated_event_types_advance_one_step_per_event():
+    steps = ["pageview", "pageview", "conversion"]
+    assert reached([("a", "pageview", 0), ("a", "conversion", 1)], steps=steps) == [1, 0, 0]
+    assert reached([("a", "pageview", 0), ("a", "pageview", 1), ("a", "conversion", 2)], steps=steps) == [1, 1, 1]
+
+
+def test_conversion_rates():
+    db = FakeDB([
+        ("a", "pageview", 0), ("a", "click", 1),
+        ("b", "pageview", 0), ("b", "click", 1),
+        ("c", "pageview", 0), ("d", "pageview", 0),
+    ])
+    report = funnel_report(db, ["pageview", "click"], START, START + timedelta(days=7), timedelta(hours=24))
+    assert [(step["conversion_rate"], step["step_conversion_rate"]) for step in report["steps"]] == [
+        (100.0, 100.0), (50.0, 50.0)
+    ]
+    assert report["retained_from"] is None
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import partitions
+from analytics import FIRST_SEEN_COMPLETE, FIRST_SEEN_NAME, RETENTION_NAME, ROLLUP_NAME, SESSIONS_NAME
+from models import RollupState
+
+
+class FakeResult:
+    def __init__(self, values):
+        self.values = values
+
+    def scalars(self):
+        return iter(self.values)
+
+
+class FakeDB:
+    """Just enough of a Session for the retention job: rollup_state rows,
+    partition names, and a log of the statements run"""
+
+    def __init__(self, watermarks, partition_names):
+        self.states = {name: RollupState(name=name, rolled_up_to=value) for name, value in watermarks.items()}
+        self.partition_names = partition_names
+        self.statements = []
+
+    def get(self, model, name):
+        return self.states.get(name)
+
+    def add(self, state):
+        self.states[state.name] = state
+
+    def execute(self, statement):
+        self.statements.append(str(statement))
+        return FakeResult(self.partition_names)
+
+    def dropped(self):
+        return [sql.split()[-1] for sql in self.statements if sql.startswith("DROP TABLE")]
+
+
+MONTHS = ["events_p202601", "events_p202602", "events_p202603", "events_p202604", "events_default"]
+
+
+@pytest.fixture(autouse=True)
+def monthly_retention(monkeypatch):
+    monkeypatch.setattr(partitions, "PARTITION_INTERVAL", "month")
+    # Long enough ago that only the watermarks hold partitions back
+    monkeypatch.setattr(partitions, "RETENTION_DAYS", 1)
+
+
+def test_raw_events_watermark_is_the_earliest_forward_watermark():
+    db = FakeDB({ROLLUP_NAME: datetime(2026, 4, 1), SESSIONS_NAME: datetime(2026, 3, 1)}, [])
+    assert partitions.raw_events_watermark(db) == datetime(2026, 3, 1)
+
+
+def test_jobs_that_never_ran_hold_nothing_back():
+    assert partitions.raw_events_watermark(FakeDB({}, [])) == datetime.max
+
+
+def test_incomplete_first_seen_backfill_blocks_every_drop():
+    db = FakeDB({
+        ROLLUP_NAME: datetime(2026, 5, 1),
+        SESSIONS_NAME: datetime(2026, 5, 1),
+        FIRST_SEEN_NAME: datetime(2026, 2, 10),
+    }, MONTHS)
+    assert partitions.raw_events_watermark(db) == FIRST_SEEN_COMPLETE
+    assert partitions.drop_expired_partitions(db) == 0
+    assert db.dropped() == []
+
+
+def test_drop_stops_at_the_sessions_watermark():
+    db = FakeDB({
+        ROLLUP_NAME: datetime(2026, 5, 1),
+        SESSIONS_NAME: datetime(2026, 3, 15),
+        FIRST_SEEN_NAME: FIRST_SEEN_COMPLETE,
+    }, MONTHS)
+    assert partitions.drop_expired_partitions(db) == 2
+    assert db.dropped() == ["events_p202601", "events_p202602"]
+    assert db.states[RETENTION_NAME].rolled_up_to == datetime(2026, 3, 1)
+
+
+def test_retention_disabled_drops_nothing(monkeypatch):
+    monkeypatch.setattr(partitions, "RETENTION_DAYS", 0)
+    db = FakeDB({ROLLUP_NAME: datetime.utcnow() + timedelta(days=1)}, MONTHS)
+    assert partitions.drop_expired_partitions(db) == 0
+    assert db.statements == []
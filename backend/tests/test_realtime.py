@@ -0,0 +1,31 @@
+from realtime import snapshot_delta
+
+
+def snapshot(active_users, minutes, countries=()):
+    return {
+        "active_users": active_users,
+        "users_by_minute": [{"minute": minute, "users": users} for minute, users in minutes],
+        "users_by_country": [{"country": country, "users": users} for country, users in countries],
+    }
+
+
+def test_unchanged_snapshot_has_no_delta():
+    current = snapshot(5, [("12:00", 2), ("12:01", 3)], [("US", 5)])
+    assert snapshot_delta(current, current) is None
+
+
+def test_only_changed_and_new_minutes_are_sent():
+    previous = snapshot(5, [("12:00", 2), ("12:01", 3)])
+    current = snapshot(5, [("12:01", 4), ("12:02", 1)])
+    assert snapshot_delta(previous, current) == {
+        "users_by_minute": [{"minute": "12:01", "users": 4}, {"minute": "12:02", "users": 1}],
+    }
+
+
+def test_active_users_and_countries_are_sent_whole_when_changed():
+    previous = snapshot(5, [("12:00", 2)], [("US", 5)])
+    current = snapshot(6, [("12:00", 2)], [("US", 5), ("DE", 1)])
+    assert snapshot_delta(previous, current) == {
+        "active_users": 6,
+        "users_by_country": current["users_by_country"],
+    }
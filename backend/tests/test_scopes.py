@@ -0,0 +1,36 @@
+from datetime import datetime
+
+from sqlalchemy.dialects import postgresql
+
+from analytics import dimension_scopes, filter_scope, scope_part
+from models import Event
+from realtime import minute_key
+
+
+def test_colons_in_names_cannot_collide_with_another_pair():
+    assert dimension_scopes("a:b", "c")[3] != dimension_scopes("a", "b:c")[3]
+    assert dimension_scopes("a\\", "b")[3] != dimension_scopes("a", "\\b")[3]
+
+
+def test_filter_scope_matches_the_scopes_written_at_ingest():
+    app_name, domain = "shop:eu", "example.com"
+    assert set(dimension_scopes(app_name, domain)) == {
+        filter_scope(None, None),
+        filter_scope(app_name, None),
+        filter_scope(None, domain),
+        filter_scope(app_name, domain),
+    }
+
+
+def test_plain_names_keep_their_scope():
+    assert dimension_scopes("shop", "example.com") == ("_all", "app:shop", "domain:example.com", "app:shop:example.com")
+
+
+def test_sql_scopes_escape_like_python_scopes():
+    sql = str(scope_part(Event.app_name).compile(dialect=postgresql.dialect()))
+    assert sql.startswith("replace(replace(events.app_name")
+
+
+def test_realtime_keys_use_the_escaped_scope():
+    minute = datetime(2026, 1, 1, 12, 30)
+    assert minute_key(filter_scope("a:b", None), minute) == "rt:app:a\\:b:202601011230"
@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+
+from session_state import SessionStateCache
+
+START = datetime(2026, 1, 1, 12, 0)
+
+
+def row(session_id, seconds, country="US"):
+    at = START + timedelta(seconds=seconds)
+    return {
+        "session_id": session_id, "user_id": "u-" + session_id,
+        "start_time": at, "last_activity": at, "country": country,
+    }
+
+
+def make_cache(max_size=10):
+    return SessionStateCache(max_size=max_size, ttl=3600, write_interval=60)
+
+
+def test_new_sessions_are_written():
+    cache = make_cache()
+    assert cache.plan([row("a", 0), row("b", 0)]) == [row("a", 0), row("b", 0)]
+
+
+def test_activity_within_the_write_interval_is_coalesced_until_flushed():
+    cache = make_cache()
+    cache.plan([row("a", 0)])
+    assert cache.plan([row("a", 10)]) == []
+    assert cache.plan([row("a", 20)]) == []
+
+    dirty = cache.take_dirty()
+    assert [(r["session_id"], r["last_activity"]) for r in dirty] == [("a", START + timedelta(seconds=20))]
+    assert cache.take_dirty() == []
+
+
+def test_activity_past_the_write_interval_is_written():
+    cache = make_cache()
+    cache.plan([row("a", 0)])
+    writes = cache.plan([row("a", 90)])
+    assert [r["last_activity"] for r in writes] == [START + timedelta(seconds=90)]
+
+
+def test_unknown_country_is_upgraded_immediately():
+    cache = make_cache()
+    cache.plan([row("a", 0, country="Unknown")])
+    assert [r["country"] for r in cache.plan([row("a", 5)])] == ["US"]
+
+
+def test_evicted_dirty_entries_are_written_with_the_evicting_batch():
+    cache = make_cache(max_size=1)
+    cache.plan([row("a", 0)])
+    cache.plan([row("a", 10)])
+    writes = cache.plan([row("b", 0)])
+    assert [(r["session_id"], r["last_activity"]) for r in writes] == [
+        ("b", START), ("a", START + timedelta(seconds=10))
+    ]
+
+
+def test_restore_marks_a_failed_plan_dirty_again():
+    cache = make_cache()
+    writes = cache.plan([row("a", 0)])
+    cache.restore(writes)
+
+    dirty = cache.take_dirty()
+    assert dirty == [row("a", 0)]
+    assert cache.take_dirty() == []
+
+
+def test_restore_keeps_later_activity_and_the_original_start():
+    cache = make_cache()
+    writes = cache.plan([row("a", 0)])
+    cache.plan([row("a", 30)])
+    cache.restore(writes)
+
+    [restored] = cache.take_dirty()
+    assert restored["start_time"] == START
+    assert restored["last_activity"] == START + timedelta(seconds=30)
+
+
+def test_restore_of_a_failed_flush_brings_back_evicted_entries():
+    cache = make_cache(max_size=1)
+    cache.plan([row("a", 0)])
+    cache.plan([row("a", 10)])
+    flushed = cache.take_dirty()
+    cache.plan([row("b", 0)])  # evicts the now clean entry of "a"
+    cache.restore(flushed)
+
+    assert [r["session_id"] for r in cache.take_dirty()] == ["a"]
+
+
+def test_disabled_cache_writes_everything_and_ignores_restore():
+    cache = SessionStateCache(max_size=0, ttl=3600, write_interval=60)
+    rows = [row("a", 0), row("a", 10)]
+    assert cache.plan(rows) == rows
+    cache.restore(rows)
+    assert cache.take_dirty() == []
@@ -0,0 +1,59 @@
+import pytest
+
+from sketches import HyperLogLog
+
+
+def users(start, stop):
+    return [f"user-{i}" for i in range(start, stop)]
+
+
+def test_small_sketch_serializes_sparsely_and_round_trips():
+    sketch = HyperLogLog().update(users(0, 50))
+    data = sketch.to_bytes()
+    assert len(data) < 2 + 3 * 50 + 1
+    assert HyperLogLog.from_bytes(data).registers == sketch.registers
+
+
+def test_large_sketch_serializes_densely_and_round_trips():
+    sketch = HyperLogLog().update(users(0, 20000))
+    data = sketch.to_bytes()
+    assert len(data) == 2 + sketch.size
+    assert HyperLogLog.from_bytes(data).registers == sketch.registers
+
+
+@pytest.mark.parametrize("distinct", [100, 5000, 50000])
+def test_count_is_within_a_few_standard_errors(distinct):
+    sketch = HyperLogLog().update(users(0, distinct))
+    assert abs(sketch.count() - distinct) <= distinct * 0.05
+
+
+def test_duplicates_do_not_change_the_count():
+    once = HyperLogLog().update(users(0, 1000))
+    twice = HyperLogLog().update(users(0, 1000) * 2)
+    assert once.registers == twice.registers
+
+
+def test_merge_equals_the_sketch_of_the_union():
+    union = HyperLogLog().update(users(0, 3000))
+    merged = HyperLogLog().update(users(0, 2000)).merge(HyperLogLog().update(users(1000, 3000)))
+    assert merged.registers == union.registers
+
+
+def test_merge_bytes_matches_merge_for_both_encodings():
+    base = users(0, 100)
+    for other in (users(50, 150), users(0, 20000)):
+        expected = HyperLogLog().update(base).merge(HyperLogLog().update(other))
+        merged = HyperLogLog().update(base).merge_bytes(HyperLogLog().update(other).to_bytes())
+        assert merged.registers == expected.registers
+
+
+def test_merging_different_precisions_is_rejected():
+    with pytest.raises(ValueError):
+        HyperLogLog(precision=12).merge(HyperLogLog(precision=10))
+    with pytest.raises(ValueError):
+        HyperLogLog(precision=12).merge_bytes(HyperLogLog(precision=10).to_bytes())
+
+
+def test_empty_sketch_counts_zero():
+    assert HyperLogLog().count() == 0
+    assert HyperLogLog.from_bytes(HyperLogLog().to_bytes()).count() == 0
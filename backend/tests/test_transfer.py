@@ -0,0 +1,33 @@
+import base64
+from datetime import datetime, timezone
+
+import pytest
+
+from transfer import decode_cursor, encode_cursor
+
+
+def test_cursor_round_trips():
+    created_at = datetime(2026, 3, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+    assert decode_cursor(encode_cursor(created_at, 42)) == (created_at, 42)
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor(datetime(2026, 3, 1, tzinfo=timezone.utc), 2 ** 40)
+    assert set(cursor) <= set("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_=")
+
+
+def encoded(text):
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"\xff\xfe").decode(),
+    encoded("2026-03-01T00:00:00"),
+    encoded("2026-03-01T00:00:00|1|2"),
+    encoded("yesterday|1"),
+    encoded("2026-03-01T00:00:00|one"),
+])
+def test_malformed_cursors_raise_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
@@ -0,0 +1,415 @@
+"""Raw event listing, columnar export and COPY-based bulk import
+
+    python transfer.py export --start 2024-01-01 --end 2024-02-01 --app-name shop -o shop.parquet
+    python transfer.py import events.jsonl
+"""
+import argparse
+import base64
+import binascii
+import csv
+import io
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Iterator, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import redis
+from sqlalchemy import and_, case, func, select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from analytics import app_filters, as_utc, utc_naive
+from app_registry import add_backdated_events
+from cache import bump_generations
+from database import SessionLocal
+from first_seen import first_seen_rows, upsert_first_seen
+from ingest import event_dimensions
+from models import Event, Session as UserSession
+from partitions import create_partitions, is_partitioned
+from rollups import rebuild_rollups
+from sessionize import rebuild_session_metrics
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per server-side cursor round-trip and written per row group / record batch
+EXPORT_CHUNK_ROWS = 50_000
+# Rows per COPY; each chunk is committed together with its session upserts
+IMPORT_CHUNK_ROWS = 100_000
+# Largest page GET /api/events returns, and rows fetched per cursor round-trip
+MAX_PAGE_ROWS = 50_000
+LIST_CHUNK_ROWS = 5_000
+
+EXPORT_FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+EVENT_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("event_type", pa.string()),
+    ("user_id", pa.string()),
+    ("session_id", pa.string()),
+    ("page_url", pa.string()),
+    ("country", pa.string()),
+    ("app_name", pa.string()),
+    ("domain", pa.string()),
+    ("properties", pa.string()),  # JSON text
+    ("created_at", pa.timestamp("us", tz="UTC")),
+])
+
+COPY_COLUMNS = ["event_type", "user_id", "session_id", "page_url", "country", "properties", "app_name", "domain", "created_at"]
+
+
+class _ChunkSink:
+    """Write-only file object whose contents are handed out chunk by chunk"""
+
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def export_events(
+    db: Session,
+    start: datetime,
+    end: datetime,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None,
+    file_format: str = "parquet"
+) -> Iterator[bytes]:
+    """Events in [start, end) as Parquet or an Arrow IPC stream, in bounded-memory chunks
+
+    Rows come from a server-side cursor ``EXPORT_CHUNK_ROWS`` at a time and
+    each chunk becomes one row group (Parquet) or record batch (Arrow).
+    """
+    stmt = select(
+        Event.id, Event.event_type, Event.user_id, Event.session_id, Event.page_url,
+        Event.country, Event.app_name, Event.domain, Event.properties, Event.created_at
+    ).where(
+        Event.created_at >= as_utc(start),
+        Event.created_at < as_utc(end),
+        *app_filters(app_name, domain)
+    ).order_by(Event.created_at, Event.id).execution_options(yield_per=EXPORT_CHUNK_ROWS)
+
+    sink = _ChunkSink()
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(sink, EVENT_SCHEMA, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(sink, EVENT_SCHEMA)
+
+    for rows in db.execute(stmt).partitions():
+        columns = list(zip(*rows))
+        columns[8] = [json.dumps(value) if value is not None else None for value in columns[8]]
+        batch = pa.record_batch(
+            [pa.array(column, type=field.type) for column, field in zip(columns, EVENT_SCHEMA)],
+            schema=EVENT_SCHEMA
+        )
+        if file_format == "parquet":
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        yield sink.drain()
+
+    writer.close()
+    yield sink.drain()
+
+
+def export_stream(start: datetime, end: datetime, app_name: Optional[str], domain: Optional[str], file_format: str):
+    """``export_events`` with its own session, for StreamingResponse and the CLI"""
+    db = SessionLocal()
+    try:
+        yield from export_events(db, start, end, app_name=app_name, domain=domain, file_format=file_format)
+    finally:
+        db.close()
+
+
+def encode_cursor(created_at: datetime, event_id: int) -> str:
+    """Opaque keyset cursor for the row a page ended on"""
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{event_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """(created_at, id) from ``encode_cursor``; raises ValueError when malformed"""
+    try:
+        created_at, event_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(event_id)
+    except (UnicodeDecodeError, binascii.Error) as exc:
+        raise ValueError("malformed cursor") from exc
+
+
+def list_events(
+    db: Session,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    app_name: Optional[str] = None,
+    domain: Optional[str] = None,
+    event_type: Optional[str] = None,
+    country: Optional[str] = None,
+    after: Optional[tuple] = None,
+    limit: int = 1000,
+    descending: bool = True
+) -> Iterator[bytes]:
+    """One page of events as NDJSON, read through a server-side cursor
+
+    Pages are delimited by (created_at, id) rather than OFFSET, so deep pages
+    cost the same as the first. The last line is ``{"next_cursor": ...}``,
+    null once the result set is exhausted.
+    """
+    filters = list(app_filters(app_name, domain))
+    if start:
+        filters.append(Event.created_at >= as_utc(start))
+    if end:
+        filters.append(Event.created_at < as_utc(end))
+    if event_type:
+        filters.append(Event.event_type == event_type)
+    if country:
+        filters.append(Event.country == country)
+    if after:
+        created_at, event_id = as_utc(after[0]), after[1]
+        # The plain created_at bound lets the planner use the created_at index
+        # and prune partitions; the row comparison breaks ties on id
+        if descending:
+            filters += [Event.created_at <= created_at, tuple_(Event.created_at, Event.id) < (created_at, event_id)]
+        else:
+            filters += [Event.created_at >= created_at, tuple_(Event.created_at, Event.id) > (created_at, event_id)]
+
+    order = (Event.created_at.desc(), Event.id.desc()) if descending else (Event.created_at, Event.id)
+    stmt = select(
+        Event.id, Event.event_type, Event.user_id, Event.session_id, Event.page_url,
+        Event.country, Event.app_name, Event.domain, Event.properties, Event.created_at
+    ).where(*filters).order_by(*order).limit(limit).execution_options(
+        yield_per=min(limit, LIST_CHUNK_ROWS)
+    )
+
+    count = 0
+    last = None
+    for rows in db.execute(stmt).partitions():
+        lines = []
+        for row in rows:
+            record = row._asdict()
+            record["created_at"] = record["created_at"].isoformat()
+            lines.append(json.dumps(record))
+            last = row
+        count += len(rows)
+        yield ("\n".join(lines) + "\n").encode()
+
+    next_cursor = encode_cursor(last.created_at, last.id) if last is not None and count == limit else None
+    yield (json.dumps({"next_cursor": next_cursor}) + "\n").encode()
+
+
+def list_events_stream(**kwargs):
+    """``list_events`` with its own session, for StreamingResponse"""
+    db = SessionLocal()
+    try:
+        yield from list_events(db, **kwargs)
+    finally:
+        db.close()
+
+
+def read_records(path: str, chunk_rows: int = IMPORT_CHUNK_ROWS) -> Iterator[List[dict]]:
+    """Event dicts from a JSONL or Parquet file, ``chunk_rows`` at a time"""
+    if path.endswith(".parquet"):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pylist()
+        return
+
+    with open(path) as f:
+        chunk = []
+        for line in f:
+            if line.strip():
+                chunk.append(json.loads(line))
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def _parse_time(value, default: datetime) -> datetime:
+    if value is None:
+        return default
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return as_utc(value)
+
+
+def _normalize(record: dict, now: datetime) -> dict:
+    """Column values for an imported record; accepts the API's event shape and exports"""
+    properties = record.get("properties") or {}
+    if isinstance(properties, str):
+        properties = json.loads(properties)
+    app_name, domain = event_dimensions(properties)
+    return {
+        "event_type": record["event_type"],
+        "user_id": record["user_id"],
+        "session_id": record["session_id"],
+        "page_url": record.get("page_url"),
+        "country": record.get("country") or "Unknown",
+        "properties": properties,
+        "app_name": record.get("app_name") or app_name,
+        "domain": record.get("domain") or domain,
+        "created_at": _parse_time(record.get("created_at"), now),
+    }
+
+
+def import_events(db: Session, chunks: Iterable[List[dict]], redis_client=None) -> int:
+    """Bulk-load events with COPY, upserting their sessions, first-seen times
+    and app registry totals and rebuilding the rollups and session metrics
+    they affect; returns the number of events loaded
+
+    With ``redis_client`` the cached analytics of the imported apps are
+    invalidated afterwards.
+    """
+    now = datetime.now(timezone.utc)
+    partitioned = is_partitioned(db)
+    loaded = 0
+    first = last = None
+    app_names = set()
+
+    for records in chunks:
+        rows = [_normalize(record, now) for record in records]
+        if not rows:
+            continue
+        chunk_first = min(row["created_at"] for row in rows)
+        chunk_last = max(row["created_at"] for row in rows)
+        first = chunk_first if first is None else min(first, chunk_first)
+        last = chunk_last if last is None else max(last, chunk_last)
+
+        if partitioned:
+            # Historical rows need their partitions, or they all land in events_default
+            create_partitions(db, utc_naive(chunk_first), utc_naive(chunk_last) + timedelta(seconds=1))
+
+        _copy_events(db, rows)
+        _upsert_imported_sessions(db, rows)
+        seen = [(row["app_name"], row["domain"], row["user_id"], row["created_at"]) for row in rows]
+        upsert_first_seen(db, first_seen_rows(seen), backdated=True)
+        add_backdated_events(db, seen)
+        db.commit()
+        app_names.update(row["app_name"] for row in rows)
+        loaded += len(rows)
+        logger.info("Imported %d events", loaded)
+
+    if loaded:
+        rebuild_rollups(db, first, last + timedelta(seconds=1))
+        rebuild_session_metrics(db, first, last + timedelta(seconds=1))
+        if redis_client is not None:
+            pipe = redis_client.pipeline(transaction=False)
+            bump_generations(pipe, app_names)
+            pipe.execute()
+    return loaded
+
+
+def _copy_events(db: Session, rows: List[dict]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([
+            json.dumps(row[column]) if column == "properties" else
+            row[column].isoformat() if column == "created_at" else row[column]
+            for column in COPY_COLUMNS
+        ])
+    buffer.seek(0)
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_expert(f"COPY events ({', '.join(COPY_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+
+
+def _upsert_imported_sessions(db: Session, rows: List[dict]):
+    """Widen sessions to cover imported events, which may predate what is stored"""
+    sessions = {}
+    for row in rows:
+        session = sessions.get(row["session_id"])
+        if session is None:
+            sessions[row["session_id"]] = {
+                "session_id": row["session_id"],
+                "user_id": row["user_id"],
+                "start_time": row["created_at"],
+                "last_activity": row["created_at"],
+                "country": row["country"],
+            }
+            continue
+        session["start_time"] = min(session["start_time"], row["created_at"])
+        session["last_activity"] = max(session["last_activity"], row["created_at"])
+        if session["country"] == "Unknown" and row["country"] != "Unknown":
+            session["country"] = row["country"]
+
+    stmt = insert(UserSession).values(list(sessions.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserSession.session_id],
+        set_={
+            "start_time": func.least(UserSession.start_time, stmt.excluded.start_time),
+            "last_activity": func.greatest(UserSession.last_activity, stmt.excluded.last_activity),
+            "country": case(
+                (
+                    and_(UserSession.country == "Unknown", stmt.excluded.country != "Unknown"),
+                    stmt.excluded.country
+                ),
+                else_=UserSession.country
+            ),
+        }
+    )
+    db.execute(stmt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export events to Parquet/Arrow or bulk-import them from JSONL/Parquet")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    exporter = commands.add_parser("export", help="write events in a time range to a file")
+    exporter.add_argument("--start", required=True, help="ISO start of the range (inclusive)")
+    exporter.add_argument("--end", required=True, help="ISO end of the range (exclusive)")
+    exporter.add_argument("--app-name")
+    exporter.add_argument("--domain")
+    exporter.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="parquet")
+    exporter.add_argument("-o", "--output", required=True)
+
+    importer = commands.add_parser("import", help="COPY events from a .jsonl or .parquet file")
+    importer.add_argument("path")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    if args.command == "export":
+        start = _parse_time(args.start, None)
+        end = _parse_time(args.end, None)
+        with open(args.output, "wb") as f:
+            for chunk in export_stream(start, end, args.app_name, args.domain, args.format):
+                f.write(chunk)
+        logger.info("Wrote %s", args.output)
+    else:
+        db = SessionLocal()
+        try:
+            redis_client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+            loaded = import_events(db, read_records(args.path), redis_client)
+        finally:
+            db.close()
+        logger.info("Loaded %d events from %s", loaded, args.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Materialized views of per-user activity: creation and concurrent refresh"""
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import func, select, text
+from sqlalchemy.orm import Session
+
+from analytics import DAILY_VIEW, HOURLY_VIEW, HOURLY_VIEW_HOURS
+from models import RollupState
+
+logger = logging.getLogger(__name__)
+
+# Seconds between refreshes of each view (0 disables the job). The daily view
+# re-reads every event, the hourly one only the last HOURLY_VIEW_HOURS hours
+DAILY_VIEW_REFRESH_INTERVAL = float(os.getenv("MV_DAILY_REFRESH_INTERVAL", "0"))
+HOURLY_VIEW_REFRESH_INTERVAL = float(os.getenv("MV_HOURLY_REFRESH_INTERVAL", "0"))
+# Postgres advisory lock ids keeping concurrent API workers from refreshing a view twice
+VIEW_LOCK_IDS = {DAILY_VIEW: 73010006, HOURLY_VIEW: 73010007}
+
+# Kept in sync with db/materialized_views.sql
+VIEW_QUERIES = {
+    DAILY_VIEW: (
+        "SELECT date_trunc('day', created_at AT TIME ZONE 'UTC') AS bucket, app_name, domain, user_id, "
+        "count(*) AS event_count, count(*) FILTER (WHERE event_type = 'conversion') AS conversions "
+        "FROM events GROUP BY 1, 2, 3, 4"
+    ),
+    HOURLY_VIEW: (
+        "SELECT date_trunc('hour', created_at AT TIME ZONE 'UTC') AS bucket, app_name, domain, user_id, "
+        "count(*) AS event_count, count(*) FILTER (WHERE event_type = 'conversion') AS conversions "
+        f"FROM events WHERE created_at >= date_trunc('hour', now()) - interval '{HOURLY_VIEW_HOURS} hours' "
+        "GROUP BY 1, 2, 3, 4"
+    ),
+}
+
+
+def ensure_view(db: Session, name: str) -> bool:
+    """Create a view and the unique index REFRESH ... CONCURRENTLY needs, if
+    missing; returns whether the view had to be created"""
+    created = db.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is None
+    db.execute(text(f"CREATE MATERIALIZED VIEW IF NOT EXISTS {name} AS {VIEW_QUERIES[name]}"))
+    db.execute(text(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS {name}_key ON {name}(bucket, app_name, domain, user_id)"
+    ))
+    db.execute(text(f"CREATE INDEX IF NOT EXISTS {name}_app_bucket ON {name}(app_name, domain, bucket)"))
+    return created
+
+
+def refresh_view(db: Session, name: str) -> bool:
+    """Refresh a view without blocking its readers and record the refresh
+    time; returns False when another worker holds the refresh"""
+    if not db.execute(select(func.pg_try_advisory_xact_lock(VIEW_LOCK_IDS[name]))).scalar():
+        db.rollback()
+        return False
+
+    # Taken before the refresh reads events, so the view reflects at least this
+    refreshed_at = datetime.utcnow()
+    # A view created just now already holds fresh data
+    if not ensure_view(db, name):
+        db.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {name}"))
+
+    state = db.get(RollupState, name)
+    if state is None:
+        db.add(RollupState(name=name, rolled_up_to=refreshed_at))
+    else:
+        state.rolled_up_to = refreshed_at
+    db.commit()
+
+    logger.info("Refreshed %s as of %s", name, refreshed_at)
+    return True
+
+
+def refresh_daily_view(db: Session) -> bool:
+    """Scheduled job: refresh the per-day activity view"""
+    return refresh_view(db, DAILY_VIEW)
+
+
+def refresh_hourly_view(db: Session) -> bool:
+    """Scheduled job: refresh the activity view of the last HOURLY_VIEW_HOURS hours"""
+    return refresh_view(db, HOURLY_VIEW)
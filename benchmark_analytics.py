@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""
+Analytics Query Benchmark
+Bulk-loads synthetic events into Postgres and times the analytics endpoints against them
+
+    python3 benchmark_analytics.py load --rows 10M --truncate
+    python3 benchmark_analytics.py run --output bench-10m.json --compare bench-10m-before.json
+
+`load` talks to Postgres directly (DATABASE_URL) and reuses the backend's
+partition and rollup code; `run` talks to the API over HTTP like the dashboard.
+"""
+
+import argparse
+import asyncio
+import bisect
+import csv
+import io
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+# Reuse the backend's models, partitioning and rollups
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend"))
+
+API_URL = "http://localhost:8000"
+
+COUNTRIES = ["United States", "United Kingdom", "Canada", "Germany", "France", "Japan", "Australia", "India", "Brazil", "Spain"]
+PAGES = ["/", "/products", "/about", "/contact", "/pricing", "/blog", "/features", "/demo", "/docs", "/login"]
+EVENT_TYPES = ["pageview", "click", "scroll", "engagement", "conversion"]
+EVENT_WEIGHTS = list(itertools.accumulate([50, 25, 15, 8, 2]))
+
+# Synthetic apps are named bench_app_{n} so they are easy to tell apart
+APP_PREFIX = "bench_app_"
+COPY_COLUMNS = "event_type, user_id, session_id, page_url, country, properties, app_name, domain, created_at"
+
+RANGES = {"1h": timedelta(hours=1), "24h": timedelta(hours=24), "7d": timedelta(days=7), "90d": timedelta(days=90)}
+
+
+def parse_count(value):
+    """Row counts such as 1M, 10M, 100M or 250000"""
+    units = {"K": 1_000, "M": 1_000_000, "B": 1_000_000_000}
+    value = value.strip().upper()
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def zipf_cumulative(n, skew):
+    """Cumulative Zipf weights for ranks 1..n; skew 0 is uniform"""
+    return list(itertools.accumulate(1.0 / (rank ** skew) for rank in range(1, n + 1)))
+
+
+class EventStream(io.RawIOBase):
+    """File-like CSV producer for COPY, generating rows lazily in chunks"""
+
+    CHUNK_ROWS = 20_000
+
+    def __init__(self, args, start, span_seconds):
+        self.args = args
+        self.start = start
+        self.span = span_seconds
+        self.remaining = args.rows
+        self.buffer = b""
+        self.offset = 0
+        self.app_weights = zipf_cumulative(args.apps, args.app_skew)
+        self.domain_weights = zipf_cumulative(args.domains, args.domain_skew)
+        self.user_weights = zipf_cumulative(args.users, args.user_skew)
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        if self.offset >= len(self.buffer):
+            if not self.remaining:
+                return 0
+            self.buffer = self._chunk()
+            self.offset = 0
+        size = min(len(target), len(self.buffer) - self.offset)
+        target[:size] = self.buffer[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+    def _pick(self, weights, count):
+        total = weights[-1]
+        return [bisect.bisect_left(weights, random.random() * total) for _ in range(count)]
+
+    def _chunk(self):
+        count = min(self.CHUNK_ROWS, self.remaining)
+        self.remaining -= count
+        apps = self._pick(self.app_weights, count)
+        domains = self._pick(self.domain_weights, count)
+        users = self._pick(self.user_weights, count)
+        event_types = random.choices(EVENT_TYPES, cum_weights=EVENT_WEIGHTS, k=count)
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        for app, domain, user, event_type in zip(apps, domains, users, event_types):
+            offset = random.random() * self.span
+            created_at = self.start + timedelta(seconds=offset)
+            app_name = f"{APP_PREFIX}{app}"
+            domain_name = f"site{domain}.bench"
+            writer.writerow((
+                event_type,
+                f"user_{user}",
+                # One session per user per day keeps session cardinality realistic
+                f"session_{user}_{int(offset // 86400)}",
+                random.choice(PAGES),
+                COUNTRIES[user % len(COUNTRIES)],
+                json.dumps({"app_name": app_name, "domain": domain_name}),
+                app_name,
+                domain_name,
+                created_at.isoformat(),
+            ))
+        return out.getvalue().encode()
+
+
+def load(args):
+    from sqlalchemy import text
+
+    from app_registry import seed_app_registry
+    from database import engine, SessionLocal
+    from first_seen import rebuild_first_seen
+    from partitions import create_partitions, is_partitioned
+    from rollups import run_rollups
+    from sessionize import rebuild_session_metrics, run_sessionization
+
+    end = datetime.now(timezone.utc)
+    start = end - timedelta(days=args.days)
+
+    db = SessionLocal()
+    try:
+        if args.truncate:
+            print("Truncating events, sessions, first-seen times, app registry and rollups...")
+            db.execute(text("TRUNCATE events, event_ids, sessions, user_first_seen, app_registry, events_hourly, events_daily, pages_hourly, pages_daily, rollup_state"))
+        if is_partitioned(db):
+            # Partitions must exist before COPY, or history lands in events_default
+            created = create_partitions(db, start.replace(tzinfo=None), end.replace(tzinfo=None) + timedelta(days=1))
+            print(f"Created {created} partitions")
+        db.commit()
+    finally:
+        db.close()
+
+    print(f"Loading {args.rows:,} events over {args.days} days "
+          f"({args.apps} apps, {args.domains} domains, {args.users:,} users)...")
+    started = time.perf_counter()
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                f"COPY events ({COPY_COLUMNS}) FROM STDIN WITH (FORMAT csv)",
+                io.BufferedReader(EventStream(args, start, (end - start).total_seconds()), 1 << 20)
+            )
+            print(f"  COPY events: {time.perf_counter() - started:.1f}s "
+                  f"({args.rows / (time.perf_counter() - started):,.0f} rows/s)")
+
+            step = time.perf_counter()
+            cursor.execute(
+                "INSERT INTO sessions (session_id, user_id, start_time, last_activity, country) "
+                "SELECT session_id, min(user_id), min(created_at), max(created_at), min(country) "
+                "FROM events WHERE app_name LIKE %s GROUP BY session_id "
+                "ON CONFLICT (session_id) DO UPDATE SET "
+                "start_time = LEAST(sessions.start_time, excluded.start_time), "
+                "last_activity = GREATEST(sessions.last_activity, excluded.last_activity)",
+                (APP_PREFIX + "%",)
+            )
+            print(f"  sessions ({cursor.rowcount:,} rows): {time.perf_counter() - step:.1f}s")
+
+            step = time.perf_counter()
+            cursor.execute("ANALYZE events")
+            cursor.execute("ANALYZE sessions")
+            print(f"  ANALYZE: {time.perf_counter() - step:.1f}s")
+        connection.commit()
+    finally:
+        connection.close()
+
+    step = time.perf_counter()
+    db = SessionLocal()
+    try:
+        rows = rebuild_first_seen(db, start, end + timedelta(seconds=1))
+        db.commit()
+    finally:
+        db.close()
+    print(f"  first-seen ({rows:,} rows): {time.perf_counter() - step:.1f}s")
+
+    if not args.skip_rollups:
+        step = time.perf_counter()
+        db = SessionLocal()
+        try:
+            hours = run_rollups(db)
+        finally:
+            db.close()
+        print(f"  rollups ({hours} hours): {time.perf_counter() - step:.1f}s")
+
+    step = time.perf_counter()
+    db = SessionLocal()
+    try:
+        # Loaded history may lie behind an existing watermark; the job covers the rest
+        rebuild_session_metrics(db, start, end + timedelta(seconds=1))
+        hours = run_sessionization(db)
+    finally:
+        db.close()
+    print(f"  session metrics ({hours} hours): {time.perf_counter() - step:.1f}s")
+
+    step = time.perf_counter()
+    db = SessionLocal()
+    try:
+        apps = seed_app_registry(db, reset=True)
+    finally:
+        db.close()
+    print(f"  app registry ({apps} apps): {time.perf_counter() - step:.1f}s")
+
+    print(f"Done in {time.perf_counter() - started:.1f}s")
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_cases(args):
+    """(name, path, params) for every endpoint and range being timed"""
+    now = datetime.now(timezone.utc)
+    app_filter = {"app_name": args.app_name} if args.app_name else {}
+    cases = []
+    for exact in (False, True):
+        mode = "exact" if exact else "approx"
+        for label, span in RANGES.items():
+            params = {"start_date": (now - span).isoformat(), "end_date": now.isoformat(), "exact": str(exact).lower()}
+            cases.append((f"summary[{label},{mode}]", "/api/analytics/summary", dict(params, **app_filter)))
+        cases.append((f"apps[{mode}]", "/api/apps", {"exact": str(exact).lower()}))
+    cases.append(("realtime", "/api/analytics/realtime", app_filter))
+    return cases
+
+
+async def run(args):
+    async with httpx.AsyncClient(base_url=args.api_url, timeout=args.timeout) as client:
+        response = await client.post("/api/auth/login", json={"email": args.email, "password": args.password})
+        response.raise_for_status()
+        client.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+        # Time the queries themselves rather than the Redis response cache
+        client.headers["Cache-Control"] = "no-cache"
+
+        results = {}
+        for name, path, params in benchmark_cases(args):
+            timings = []
+            for i in range(args.warmup + args.repeat):
+                started = time.perf_counter()
+                response = await client.get(path, params=params)
+                elapsed = (time.perf_counter() - started) * 1000
+                response.raise_for_status()
+                if i >= args.warmup:
+                    timings.append(elapsed)
+            timings.sort()
+            results[name] = {
+                "min_ms": round(timings[0], 2),
+                "median_ms": round(statistics.median(timings), 2),
+                "p95_ms": round(timings[min(len(timings) - 1, int(0.95 * len(timings)))], 2),
+                "max_ms": round(timings[-1], 2),
+            }
+            print(f"{name:<28} median {results[name]['median_ms']:>9.1f} ms   max {results[name]['max_ms']:>9.1f} ms")
+
+    return {
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "commit": git_commit(),
+        "config": {"api_url": args.api_url, "repeat": args.repeat, "warmup": args.warmup, "app_name": args.app_name},
+        "results": results,
+    }
+
+
+def compare(report, baseline_path):
+    """Print the median change of every case against an earlier report"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print("-" * 60)
+    print(f"Compared with {baseline_path} (commit {baseline.get('commit')})")
+    for name, current in report["results"].items():
+        before = baseline["results"].get(name)
+        if not before:
+            continue
+        change = (current["median_ms"] - before["median_ms"]) / before["median_ms"] * 100 if before["median_ms"] else 0.0
+        print(f"{name:<28} {before['median_ms']:>9.1f} -> {current['median_ms']:>9.1f} ms  ({change:+.1f}%)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load synthetic analytics data and time the analytics endpoints")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    loader = commands.add_parser("load", help="bulk-load synthetic events and sessions with COPY")
+    loader.add_argument("--rows", type=parse_count, default=parse_count("1M"), help="events to load, e.g. 1M, 10M, 100M")
+    loader.add_argument("--days", type=int, default=90, help="days of history the events are spread over (default 90)")
+    loader.add_argument("--apps", type=int, default=20, help="distinct app names (default 20)")
+    loader.add_argument("--app-skew", type=float, default=1.1, help="Zipf exponent of app popularity (0 = uniform)")
+    loader.add_argument("--domains", type=int, default=5, help="distinct domains (default 5)")
+    loader.add_argument("--domain-skew", type=float, default=1.0, help="Zipf exponent of domain popularity")
+    loader.add_argument("--users", type=int, default=100_000, help="distinct user ids (default 100000)")
+    loader.add_argument("--user-skew", type=float, default=0.8, help="Zipf exponent of user activity")
+    loader.add_argument("--truncate", action="store_true", help="empty events, sessions, first-seen times, app registry and rollups first")
+    loader.add_argument("--skip-rollups", action="store_true", help="do not run the rollup job after loading")
+
+    runner = commands.add_parser("run", help="time the analytics endpoints over 1h, 24h, 7d and 90d ranges")
+    runner.add_argument("--api-url", default=API_URL, help=f"API base URL (default {API_URL})")
+    runner.add_argument("--email", default="demo@analytics.com")
+    runner.add_argument("--password", default="demo123")
+    runner.add_argument("--app-name", help="filter every query to one app, e.g. bench_app_0")
+    runner.add_argument("--repeat", type=int, default=5, help="timed requests per case (default 5)")
+    runner.add_argument("--warmup", type=int, default=1, help="untimed requests per case (default 1)")
+    runner.add_argument("--timeout", type=float, default=300.0, help="request timeout in seconds (default 300)")
+    runner.add_argument("--output", help="write the JSON report to this file")
+    runner.add_argument("--compare", help="earlier JSON report to compare medians against")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "load":
+        load(args)
+    else:
+        report = asyncio.run(run(args))
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Report written to {args.output}")
+        if args.compare:
+            compare(report, args.compare)
@@ -1,16 +1,39 @@
 -- Initialize analytics database
 
--- Create events table
+-- Create events table, range partitioned by month on created_at
 CREATE TABLE IF NOT EXISTS events (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     event_type VARCHAR(100) NOT NULL,
     user_id VARCHAR(255) NOT NULL,
     session_id VARCHAR(255) NOT NULL,
     page_url TEXT,
     country VARCHAR(100),
     properties JSONB DEFAULT '{}',
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-);
+    app_name VARCHAR(255) NOT NULL DEFAULT 'legacy',
+    domain VARCHAR(255) NOT NULL DEFAULT 'unknown',
+    event_id VARCHAR(255),
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+-- Monthly partitions from last month to three months ahead; the backend's
+-- partition job keeps creating upcoming ones (names must stay events_pYYYYMM)
+DO $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', CURRENT_DATE - INTERVAL '1 month');
+BEGIN
+    WHILE month_start <= date_trunc('month', CURRENT_DATE + INTERVAL '3 months') LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF events FOR VALUES FROM (%L) TO (%L)',
+            'events_p' || to_char(month_start, 'YYYYMM'),
+            month_start AT TIME ZONE 'UTC',
+            (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC'
+        );
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+END $$;
+
+CREATE TABLE IF NOT EXISTS events_default PARTITION OF events DEFAULT;
 
 -- Create users table
 CREATE TABLE IF NOT EXISTS users (
@@ -30,7 +53,97 @@ CREATE TABLE IF NOT EXISTS sessions (
     start_time TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     last_activity TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     country VARCHAR(100),
-    properties JSONB DEFAULT '{}'
+    properties JSONB DEFAULT '{}',
+    -- Per-session metrics maintained by the sessionization job
+    app_name VARCHAR(255),
+    domain VARCHAR(255),
+    event_count INTEGER NOT NULL DEFAULT 0,
+    pageviews INTEGER NOT NULL DEFAULT 0,
+    duration_seconds INTEGER NOT NULL DEFAULT 0,
+    entry_page TEXT,
+    exit_page TEXT,
+    bounced BOOLEAN
+);
+
+-- Create rollup tables (bucket is the UTC hour/day start, users is a HyperLogLog sketch)
+CREATE TABLE IF NOT EXISTS events_hourly (
+    bucket TIMESTAMP NOT NULL,
+    app_name VARCHAR(255) NOT NULL,
+    domain VARCHAR(255) NOT NULL,
+    event_type VARCHAR(100) NOT NULL,
+    country VARCHAR(100) NOT NULL,
+    event_count BIGINT NOT NULL DEFAULT 0,
+    users BYTEA NOT NULL,
+    first_seen TIMESTAMP WITH TIME ZONE,
+    last_seen TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (bucket, app_name, domain, event_type, country)
+);
+
+CREATE TABLE IF NOT EXISTS events_daily (
+    bucket TIMESTAMP NOT NULL,
+    app_name VARCHAR(255) NOT NULL,
+    domain VARCHAR(255) NOT NULL,
+    event_type VARCHAR(100) NOT NULL,
+    country VARCHAR(100) NOT NULL,
+    event_count BIGINT NOT NULL DEFAULT 0,
+    users BYTEA NOT NULL,
+    first_seen TIMESTAMP WITH TIME ZONE,
+    last_seen TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (bucket, app_name, domain, event_type, country)
+);
+
+-- Top PAGE_TOP_K pages per hour/day and app/domain, for page breakdowns
+CREATE TABLE IF NOT EXISTS pages_hourly (
+    bucket TIMESTAMP NOT NULL,
+    app_name VARCHAR(255) NOT NULL,
+    domain VARCHAR(255) NOT NULL,
+    page_url VARCHAR(500) NOT NULL,
+    event_count BIGINT NOT NULL DEFAULT 0,
+    users BYTEA NOT NULL,
+    PRIMARY KEY (bucket, app_name, domain, page_url)
+);
+
+CREATE TABLE IF NOT EXISTS pages_daily (
+    bucket TIMESTAMP NOT NULL,
+    app_name VARCHAR(255) NOT NULL,
+    domain VARCHAR(255) NOT NULL,
+    page_url VARCHAR(500) NOT NULL,
+    event_count BIGINT NOT NULL DEFAULT 0,
+    users BYTEA NOT NULL,
+    PRIMARY KEY (bucket, app_name, domain, page_url)
+);
+
+-- First event time of each user per filter scope ("_all", "app:<app>", "domain:<domain>", "app:<app>:<domain>",
+-- with ':' and '\' escaped by a backslash in <app> and <domain>)
+CREATE TABLE IF NOT EXISTS user_first_seen (
+    scope VARCHAR(600) NOT NULL,
+    user_id VARCHAR(255) NOT NULL,
+    first_seen TIMESTAMP WITH TIME ZONE NOT NULL,
+    PRIMARY KEY (scope, user_id)
+);
+
+-- Running totals per app/domain for /api/apps (users is a HyperLogLog sketch)
+CREATE TABLE IF NOT EXISTS app_registry (
+    app_name VARCHAR(255) NOT NULL,
+    domain VARCHAR(255) NOT NULL,
+    event_count BIGINT NOT NULL DEFAULT 0,
+    users BYTEA NOT NULL,
+    user_count BIGINT NOT NULL DEFAULT 0,
+    first_seen TIMESTAMP WITH TIME ZONE,
+    last_seen TIMESTAMP WITH TIME ZONE,
+    PRIMARY KEY (app_name, domain)
+);
+
+-- Client event ids ingested within DEDUP_WINDOW_SECONDS; the primary key rejects retries
+CREATE TABLE IF NOT EXISTS event_ids (
+    event_id VARCHAR(255) PRIMARY KEY,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS rollup_state (
+    name VARCHAR(100) PRIMARY KEY,
+    rolled_up_to TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Create indexes for better query performance
@@ -41,12 +154,22 @@ CREATE INDEX IF NOT EXISTS idx_events_created_at ON events(created_at);
 CREATE INDEX IF NOT EXISTS idx_events_country ON events(country);
 CREATE INDEX IF NOT EXISTS idx_events_user_created ON events(user_id, created_at);
 CREATE INDEX IF NOT EXISTS idx_events_type_created ON events(event_type, created_at);
+CREATE INDEX IF NOT EXISTS idx_events_app_domain_created ON events(app_name, domain, created_at);
 
 CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id);
 CREATE INDEX IF NOT EXISTS idx_sessions_session_id ON sessions(session_id);
 CREATE INDEX IF NOT EXISTS idx_sessions_user_id ON sessions(user_id);
 CREATE INDEX IF NOT EXISTS idx_sessions_last_activity ON sessions(last_activity);
 CREATE INDEX IF NOT EXISTS idx_sessions_user_activity ON sessions(user_id, last_activity);
+CREATE INDEX IF NOT EXISTS idx_session_start ON sessions(start_time);
+CREATE INDEX IF NOT EXISTS idx_session_app_domain_start ON sessions(app_name, domain, start_time);
+
+CREATE INDEX IF NOT EXISTS idx_events_hourly_app_bucket ON events_hourly(app_name, domain, bucket);
+CREATE INDEX IF NOT EXISTS idx_events_daily_app_bucket ON events_daily(app_name, domain, bucket);
+CREATE INDEX IF NOT EXISTS idx_pages_hourly_app_bucket ON pages_hourly(app_name, domain, bucket);
+CREATE INDEX IF NOT EXISTS idx_pages_daily_app_bucket ON pages_daily(app_name, domain, bucket);
+CREATE INDEX IF NOT EXISTS idx_user_first_seen_scope_time ON user_first_seen(scope, first_seen);
+CREATE INDEX IF NOT EXISTS idx_event_ids_created ON event_ids(created_at);
 
 -- Insert sample data for demonstration
 INSERT INTO events (event_type, user_id, session_id, page_url, country, created_at)
@@ -0,0 +1,36 @@
+-- Materialized views of per-user activity for /api/analytics/summary?views=true
+--
+-- Runs after init.sql on a new database. Existing databases get the views from
+-- the refresh jobs (MV_DAILY_REFRESH_INTERVAL, MV_HOURLY_REFRESH_INTERVAL),
+-- which create them when missing. Keep in sync with backend/views.py.
+
+-- One row per user, app/domain and UTC day
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_user_activity_daily AS
+SELECT
+    date_trunc('day', created_at AT TIME ZONE 'UTC') AS bucket,
+    app_name,
+    domain,
+    user_id,
+    count(*) AS event_count,
+    count(*) FILTER (WHERE event_type = 'conversion') AS conversions
+FROM events
+GROUP BY 1, 2, 3, 4;
+
+-- One row per user, app/domain and UTC hour of the last 48 hours
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_user_activity_hourly AS
+SELECT
+    date_trunc('hour', created_at AT TIME ZONE 'UTC') AS bucket,
+    app_name,
+    domain,
+    user_id,
+    count(*) AS event_count,
+    count(*) FILTER (WHERE event_type = 'conversion') AS conversions
+FROM events
+WHERE created_at >= date_trunc('hour', now()) - interval '48 hours'
+GROUP BY 1, 2, 3, 4;
+
+-- REFRESH MATERIALIZED VIEW CONCURRENTLY needs a unique index on each view
+CREATE UNIQUE INDEX IF NOT EXISTS mv_user_activity_daily_key ON mv_user_activity_daily(bucket, app_name, domain, user_id);
+CREATE INDEX IF NOT EXISTS mv_user_activity_daily_app_bucket ON mv_user_activity_daily(app_name, domain, bucket);
+CREATE UNIQUE INDEX IF NOT EXISTS mv_user_activity_hourly_key ON mv_user_activity_hourly(bucket, app_name, domain, user_id);
+CREATE INDEX IF NOT EXISTS mv_user_activity_hourly_app_bucket ON mv_user_activity_hourly(app_name, domain, bucket);
@@ -0,0 +1,35 @@
+-- Promote properties->>'app_name' / properties->>'domain' to indexed columns
+--
+-- Run against an existing database (new databases get these from init.sql):
+--   docker exec -i analytics_db psql -U analytics_user -d analytics < db/migrations/001_event_app_columns.sql
+--
+-- Each statement runs in its own transaction, so the backfill commits in
+-- batches and the index is built without locking out ingest.
+
+-- Constant defaults make these instant, no table rewrite
+ALTER TABLE events ADD COLUMN IF NOT EXISTS app_name VARCHAR(255) NOT NULL DEFAULT 'legacy';
+ALTER TABLE events ADD COLUMN IF NOT EXISTS domain VARCHAR(255) NOT NULL DEFAULT 'unknown';
+
+-- Backfill existing rows in id batches
+DO $$
+DECLARE
+    batch_start INTEGER;
+    max_id INTEGER;
+    batch_size CONSTANT INTEGER := 50000;
+BEGIN
+    SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) INTO batch_start, max_id FROM events;
+    WHILE batch_start <= max_id LOOP
+        UPDATE events
+        SET app_name = COALESCE(NULLIF(properties->>'app_name', ''), 'legacy'),
+            domain = COALESCE(NULLIF(properties->>'domain', ''), 'unknown')
+        WHERE id >= batch_start AND id < batch_start + batch_size
+          AND (properties->>'app_name' IS NOT NULL OR properties->>'domain' IS NOT NULL);
+        COMMIT;
+        batch_start := batch_start + batch_size;
+    END LOOP;
+END $$;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_events_app_domain_created
+    ON events(app_name, domain, created_at);
+
+ANALYZE events;
@@ -0,0 +1,71 @@
+-- Convert events into a table range-partitioned by month on created_at
+--
+-- Run against an existing database (new databases get this from init.sql):
+--   docker exec -i analytics_db psql -U analytics_user -d analytics < db/migrations/002_partition_events.sql
+--
+-- Requires 001_event_app_columns.sql. The copy runs in one transaction and
+-- blocks ingest while it runs, so schedule it in a quiet window. Partition
+-- names must follow events_pYYYYMM for the backend's partition job.
+
+BEGIN;
+
+ALTER TABLE events RENAME TO events_unpartitioned;
+ALTER INDEX events_pkey RENAME TO events_unpartitioned_pkey;
+
+CREATE TABLE events (
+    id INTEGER NOT NULL DEFAULT nextval('events_id_seq'),
+    event_type VARCHAR(100) NOT NULL,
+    user_id VARCHAR(255) NOT NULL,
+    session_id VARCHAR(255) NOT NULL,
+    page_url TEXT,
+    country VARCHAR(100),
+    properties JSONB DEFAULT '{}',
+    app_name VARCHAR(255) NOT NULL DEFAULT 'legacy',
+    domain VARCHAR(255) NOT NULL DEFAULT 'unknown',
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE events_id_seq OWNED BY events.id;
+
+-- One partition per month from the oldest event to three months ahead
+DO $$
+DECLARE
+    month_start TIMESTAMP;
+BEGIN
+    SELECT date_trunc('month', COALESCE(MIN(created_at), CURRENT_TIMESTAMP) AT TIME ZONE 'UTC')
+    INTO month_start FROM events_unpartitioned;
+
+    WHILE month_start <= date_trunc('month', CURRENT_DATE + INTERVAL '3 months') LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF events FOR VALUES FROM (%L) TO (%L)',
+            'events_p' || to_char(month_start, 'YYYYMM'),
+            month_start AT TIME ZONE 'UTC',
+            (month_start + INTERVAL '1 month') AT TIME ZONE 'UTC'
+        );
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+END $$;
+
+CREATE TABLE events_default PARTITION OF events DEFAULT;
+
+INSERT INTO events (id, event_type, user_id, session_id, page_url, country, properties, app_name, domain, created_at)
+SELECT id, event_type, user_id, session_id, page_url, country, properties, app_name, domain,
+       COALESCE(created_at, CURRENT_TIMESTAMP)
+FROM events_unpartitioned;
+
+DROP TABLE events_unpartitioned;
+
+-- Indexes on the parent cascade to every partition
+CREATE INDEX idx_events_user_id ON events(user_id);
+CREATE INDEX idx_events_session_id ON events(session_id);
+CREATE INDEX idx_events_event_type ON events(event_type);
+CREATE INDEX idx_events_created_at ON events(created_at);
+CREATE INDEX idx_events_country ON events(country);
+CREATE INDEX idx_events_user_created ON events(user_id, created_at);
+CREATE INDEX idx_events_type_created ON events(event_type, created_at);
+CREATE INDEX idx_events_app_domain_created ON events(app_name, domain, created_at);
+
+COMMIT;
+
+ANALYZE events;
@@ -0,0 +1,20 @@
+-- Add the per-session metric columns maintained by the sessionization job
+--
+-- Run against an existing database (new databases get these from init.sql):
+--   docker exec -i analytics_db psql -U analytics_user -d analytics < db/migrations/003_session_metrics.sql
+--
+-- No backfill is needed: the job starts from the first event and folds
+-- history into these columns in chunks once the API is running.
+
+-- Nullable columns and constant defaults, no table rewrite
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS app_name VARCHAR(255);
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS domain VARCHAR(255);
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS event_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS pageviews INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS duration_seconds INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS entry_page TEXT;
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS exit_page TEXT;
+ALTER TABLE sessions ADD COLUMN IF NOT EXISTS bounced BOOLEAN;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_session_start ON sessions(start_time);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_session_app_domain_start ON sessions(app_name, domain, start_time);
@@ -0,0 +1,15 @@
+-- Add the event_id idempotency key and the table of recently ingested ids
+--
+-- Run against an existing database (new databases get these from init.sql):
+--   docker exec -i analytics_db psql -U analytics_user -d analytics < db/migrations/004_event_ids.sql
+--
+-- No backfill: events stored before this migration carry no event_id.
+
+-- Nullable column without a default, no table rewrite
+ALTER TABLE events ADD COLUMN IF NOT EXISTS event_id VARCHAR(255);
+
+CREATE TABLE IF NOT EXISTS event_ids (
+    event_id VARCHAR(255) PRIMARY KEY,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_event_ids_created ON event_ids(created_at);
@@ -25,6 +25,28 @@ import RealtimeWidget from './RealtimeWidget';
 
 const API_URL = process.env.REACT_APP_API_URL || 'http://localhost:8000';
 
+// Merge a realtime stream delta into the last snapshot; minutes that slid into
+// the window are appended and the oldest ones dropped
+function applyRealtimeDelta(current, delta) {
+  if (!current) {
+    return current;
+  }
+  const next = { ...current, ...delta };
+  if (delta.users_by_minute) {
+    const minutes = [...current.users_by_minute];
+    delta.users_by_minute.forEach((bucket) => {
+      const index = minutes.findIndex((m) => m.minute === bucket.minute);
+      if (index >= 0) {
+        minutes[index] = bucket;
+      } else {
+        minutes.push(bucket);
+      }
+    });
+    next.users_by_minute = minutes.slice(-current.users_by_minute.length);
+  }
+  return next;
+}
+
 function Dashboard({ darkMode, setDarkMode, onLogout }) {
   const [analytics, setAnalytics] = useState(null);
   const [realtime, setRealtime] = useState(null);
@@ -144,18 +166,54 @@ function Dashboard({ darkMode, setDarkMode, onLogout }) {
     fetchApps();
   }, []);
 
+  const subscribeRealtime = () => {
+    const token = localStorage.getItem('token');
+    if (!token) {
+      console.warn('[Dashboard] No token found, skipping realtime stream');
+      return () => {};
+    }
+
+    // EventSource cannot send headers, so the token goes in the query string
+    const params = new URLSearchParams({ token });
+    if (selectedApp !== 'all') {
+      const appData = apps.find(app => `${app.app_name}_${app.domain}` === selectedApp);
+      if (appData) {
+        params.set('app_name', appData.app_name.replace(/"/g, ''));
+        params.set('domain', appData.domain.replace(/"/g, ''));
+      }
+    }
+
+    const source = new EventSource(`${API_URL}/api/analytics/realtime/stream?${params}`);
+    source.addEventListener('snapshot', (event) => {
+      setRealtime(JSON.parse(event.data));
+    });
+    source.addEventListener('delta', (event) => {
+      setRealtime((current) => applyRealtimeDelta(current, JSON.parse(event.data)));
+    });
+    source.onerror = () => {
+      // The browser reconnects on its own and the server resends a snapshot
+      console.warn('[Dashboard] Realtime stream interrupted, reconnecting');
+    };
+    return () => source.close();
+  };
+
   useEffect(() => {
     fetchAnalytics();
-    fetchRealtime();
 
-    // Refresh realtime data every 30 seconds
-    const interval = setInterval(fetchRealtime, 30000);
-    return () => clearInterval(interval);
+    if (!window.EventSource) {
+      // Fall back to polling every 30 seconds where server-sent events are unavailable
+      fetchRealtime();
+      const interval = setInterval(fetchRealtime, 30000);
+      return () => clearInterval(interval);
+    }
+    return subscribeRealtime();
   }, [timeRange, selectedApp, apps]);
 
   const handleRefresh = () => {
     fetchAnalytics();
-    fetchRealtime();
+    if (!window.EventSource) {
+      fetchRealtime();
+    }
   };
 
   return (
@@ -1,15 +1,27 @@
 #!/usr/bin/env python3
 """
-Event Traffic Simulator
-Generates realistic analytics events to populate the dashboard
+Event Traffic Simulator and Ingestion Benchmark
+Generates realistic analytics events at a fixed rate and measures how the API keeps up
+
+Requests are scheduled open-loop: each one is sent at its planned time whether or
+not earlier requests have completed, and latency is measured from that planned
+time, so a slow server shows up as latency instead of silently lowering the load.
+
+Examples:
+    python3 simulate_traffic.py                                  # 1 event/s until Ctrl+C
+    python3 simulate_traffic.py --rate 2000 --duration 60 --batch-size 100 --output results.json
 """
 
-import requests
+import argparse
+import asyncio
+import json
 import random
+import subprocess
 import time
-import uuid
 from datetime import datetime
 
+import httpx
+
 API_URL = "http://localhost:8000"
 
 # Sample data
@@ -17,20 +29,17 @@ COUNTRIES = ["United States", "United Kingdom", "Canada", "Germany", "France", "
 PAGES = ["/", "/products", "/about", "/contact", "/pricing", "/blog", "/features", "/demo", "/docs", "/login"]
 EVENT_TYPES = ["pageview", "click", "scroll", "engagement", "conversion"]
 
-# Generate some consistent user IDs and session IDs
-USERS = [f"user_{i}" for i in range(1, 51)]
-SESSIONS = {}
+# Upper bounds (ms) of the latency histogram buckets
+HISTOGRAM_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf")]
 
-def get_or_create_session(user_id):
-    """Get existing session or create new one for user"""
-    if user_id not in SESSIONS or random.random() < 0.3:  # 30% chance of new session
-        SESSIONS[user_id] = f"session_{uuid.uuid4().hex[:8]}"
-    return SESSIONS[user_id]
 
-def generate_event():
-    """Generate a random analytics event"""
-    user_id = random.choice(USERS)
-    session_id = get_or_create_session(user_id)
+def generate_event(users, sessions_per_user, apps):
+    """Generate a random analytics event for one of ``users`` users"""
+    user = random.randrange(users)
+    # Sessions are drawn from a fixed pool per user, so session cardinality
+    # is bounded by users * sessions_per_user
+    session = random.randrange(sessions_per_user)
+    app = user % apps
 
     # Weight event types (more pageviews than conversions)
     event_type = random.choices(
@@ -39,14 +48,14 @@ def generate_event():
         k=1
     )[0]
 
-    event = {
+    return {
         "event_type": event_type,
-        "user_id": user_id,
-        "session_id": session_id,
+        "user_id": f"user_{user}",
+        "session_id": f"session_{user}_{session}",
         "page_url": random.choice(PAGES),
         "country": random.choice(COUNTRIES),
         "properties": {
-            "app_name": "traffic_simulator",
+            "app_name": "traffic_simulator" if apps == 1 else f"traffic_simulator_{app}",
             "app_version": "1.0.0",
             "domain": "simulator.local",
             "timestamp": datetime.utcnow().isoformat(),
@@ -54,100 +63,216 @@ def generate_event():
         }
     }
 
-    return event
 
-def send_event(event):
-    """Send event to the analytics API"""
-    try:
-        response = requests.post(f"{API_URL}/api/events", json=event, timeout=5)
-        if response.status_code == 200:
-            print(f"✓ Sent {event['event_type']} event for {event['user_id']} - {event['country']}")
-        else:
-            print(f"✗ Failed to send event: {response.status_code}")
-    except requests.exceptions.RequestException as e:
-        print(f"✗ Error sending event: {e}")
-
-def simulate_continuous_traffic(events_per_minute=10, duration_minutes=None):
-    """
-    Simulate continuous traffic
-
-    Args:
-        events_per_minute: Number of events to generate per minute
-        duration_minutes: How long to run (None = infinite)
-    """
-    print(f"Starting traffic simulation...")
-    print(f"Events per minute: {events_per_minute}")
-    print(f"Duration: {'Infinite' if duration_minutes is None else f'{duration_minutes} minutes'}")
-    print(f"Target API: {API_URL}")
-    print("-" * 60)
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def histogram(latencies):
+    counts = [0] * len(HISTOGRAM_BUCKETS)
+    for latency in latencies:
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if latency <= bound:
+                counts[i] += 1
+                break
+    return [
+        {"le_ms": "inf" if bound == float("inf") else bound, "count": count}
+        for bound, count in zip(HISTOGRAM_BUCKETS, counts)
+    ]
 
-    start_time = time.time()
-    event_count = 0
-    delay = 60.0 / events_per_minute  # Delay between events
 
+def git_commit():
+    """Commit of the working tree, to tell benchmark runs apart"""
     try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    """Open-loop load generator collecting per-request latencies"""
+
+    def __init__(self, args):
+        self.args = args
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.dropped = 0
+        self.events_sent = 0
+        self.events_accepted = 0
+        self.inflight = 0
+
+    async def send(self, client, events, planned):
+        """Send one request and record its latency from the planned send time"""
+        self.inflight += 1
+        try:
+            if self.args.batch_size > 1:
+                response = await client.post("/api/events/batch", json=events)
+            else:
+                response = await client.post("/api/events", json=events[0])
+            status = str(response.status_code)
+            if response.status_code in (200, 202):
+                self.events_accepted += len(events)
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+            self.errors += 1
+        finally:
+            self.inflight -= 1
+
+        self.latencies.append((time.perf_counter() - planned) * 1000)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    async def report_progress(self, started):
         while True:
-            if duration_minutes and (time.time() - start_time) > (duration_minutes * 60):
-                break
+            await asyncio.sleep(1)
+            elapsed = time.perf_counter() - started
+            print(
+                f"{elapsed:6.0f}s  sent {self.events_sent:>9}  accepted {self.events_accepted:>9}  "
+                f"in flight {self.inflight:>5}  errors {self.errors}  dropped {self.dropped}"
+            )
 
-            event = generate_event()
-            send_event(event)
-            event_count += 1
+    async def run(self):
+        args = self.args
+        request_rate = args.rate / args.batch_size
+        interval = 1.0 / request_rate
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        tasks = set()
 
-            time.sleep(delay)
+        async with httpx.AsyncClient(
+            base_url=args.api_url,
+            limits=limits,
+            timeout=args.timeout,
+            headers={"ngrok-skip-browser-warning": "true"}
+        ) as client:
+            started = time.perf_counter()
+            progress = None if args.quiet else asyncio.create_task(self.report_progress(started))
+            sent = 0
+            try:
+                while args.duration is None or time.perf_counter() - started < args.duration:
+                    planned = started + sent * interval
+                    delay = planned - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    sent += 1
 
-    except KeyboardInterrupt:
-        print("\n" + "-" * 60)
-        print("Simulation stopped by user")
-
-    elapsed = time.time() - start_time
-    print(f"\nTotal events sent: {event_count}")
-    print(f"Duration: {elapsed:.1f} seconds")
-    print(f"Average rate: {event_count / (elapsed / 60):.1f} events/minute")
-
-def simulate_burst(num_events=100):
-    """
-    Send a burst of events quickly
-
-    Args:
-        num_events: Number of events to send
-    """
-    print(f"Sending burst of {num_events} events...")
+                    # Beyond the in-flight cap the client itself is the bottleneck;
+                    # count the request as dropped rather than queueing it
+                    if self.inflight >= args.concurrency:
+                        self.dropped += 1
+                        continue
+
+                    events = [
+                        generate_event(args.users, args.sessions_per_user, args.apps)
+                        for _ in range(args.batch_size)
+                    ]
+                    self.events_sent += len(events)
+                    task = asyncio.create_task(self.send(client, events, planned))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                send_window = time.perf_counter() - started
+                if tasks:
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                if progress:
+                    progress.cancel()
+
+        return self.results(send_window, time.perf_counter() - started)
+
+    def results(self, send_window, elapsed):
+        latencies = sorted(self.latencies)
+        args = self.args
+        return {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "commit": git_commit(),
+            "config": {
+                "api_url": args.api_url,
+                "target_events_per_second": args.rate,
+                "duration_seconds": args.duration,
+                "batch_size": args.batch_size,
+                "users": args.users,
+                "sessions_per_user": args.sessions_per_user,
+                "apps": args.apps,
+                "concurrency": args.concurrency,
+            },
+            "elapsed_seconds": round(elapsed, 3),
+            "requests": len(latencies),
+            "events_sent": self.events_sent,
+            "events_accepted": self.events_accepted,
+            "dropped_requests": self.dropped,
+            "errors": self.errors,
+            "statuses": self.statuses,
+            "throughput_events_per_second": round(self.events_accepted / send_window, 1) if send_window else 0,
+            "latency_ms": {
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] if latencies else None,
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+            },
+            "histogram": histogram(latencies),
+        }
+
+
+def print_summary(results):
+    latency = results["latency_ms"]
     print("-" * 60)
+    print(f"Requests:        {results['requests']} ({results['dropped_requests']} dropped, {results['errors']} errors)")
+    print(f"Statuses:        {results['statuses']}")
+    print(f"Events accepted: {results['events_accepted']} / {results['events_sent']}")
+    print(f"Throughput:      {results['throughput_events_per_second']} events/s "
+          f"(target {results['config']['target_events_per_second']})")
+    if latency["p50"] is not None:
+        print(f"Latency (ms):    p50 {latency['p50']:.1f}  p95 {latency['p95']:.1f}  "
+              f"p99 {latency['p99']:.1f}  max {latency['max']:.1f}")
+    for bucket in results["histogram"]:
+        if bucket["count"]:
+            print(f"  <= {bucket['le_ms']:>5} ms  {bucket['count']}")
 
-    for i in range(num_events):
-        event = generate_event()
-        send_event(event)
-        time.sleep(0.1)  # Small delay to avoid overwhelming the server
 
-    print(f"\nBurst complete! Sent {num_events} events.")
+def parse_args():
+    parser = argparse.ArgumentParser(description="Send analytics events at a fixed rate and measure ingest latency")
+    parser.add_argument("--api-url", default=API_URL, help=f"API base URL (default {API_URL})")
+    parser.add_argument("--rate", type=float, default=1.0, help="target events per second (default 1)")
+    parser.add_argument("--duration", type=float, default=None, help="seconds to run (default: until Ctrl+C)")
+    parser.add_argument("--batch-size", type=int, default=1,
+                        help="events per request; above 1 uses /api/events/batch (default 1)")
+    parser.add_argument("--users", type=int, default=50, help="distinct user ids (default 50)")
+    parser.add_argument("--sessions-per-user", type=int, default=3, help="distinct sessions per user (default 3)")
+    parser.add_argument("--apps", type=int, default=1, help="distinct app names, users are spread across them (default 1)")
+    parser.add_argument("--concurrency", type=int, default=256, help="maximum requests in flight (default 256)")
+    parser.add_argument("--timeout", type=float, default=10.0, help="request timeout in seconds (default 10)")
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--quiet", action="store_true", help="no per-second progress lines")
+    return parser.parse_args()
+
 
 if __name__ == "__main__":
-    import sys
+    args = parse_args()
 
     print("Analytics Traffic Simulator")
     print("=" * 60)
-    print()
-    print("Options:")
-    print("  1. Continuous traffic (default: 10 events/min)")
-    print("  2. Burst mode (send 100 events quickly)")
-    print("  3. Custom continuous (specify events/min)")
-    print()
-
-    choice = input("Select mode (1/2/3) [1]: ").strip() or "1"
-
-    if choice == "1":
-        simulate_continuous_traffic(events_per_minute=10)
-    elif choice == "2":
-        simulate_burst(num_events=100)
-    elif choice == "3":
-        try:
-            rate = int(input("Events per minute: "))
-            duration = input("Duration in minutes (leave empty for infinite): ").strip()
-            duration = int(duration) if duration else None
-            simulate_continuous_traffic(events_per_minute=rate, duration_minutes=duration)
-        except ValueError:
-            print("Invalid input. Using defaults.")
-            simulate_continuous_traffic(events_per_minute=10)
-    else:
-        print("Invalid choice. Exiting.")
+    print(f"Target: {args.rate} events/s to {args.api_url}"
+          f" ({'batches of ' + str(args.batch_size) if args.batch_size > 1 else 'one event per request'})")
+    print(f"Duration: {'until Ctrl+C' if args.duration is None else f'{args.duration} seconds'}")
+    print("-" * 60)
+
+    try:
+        results = asyncio.run(Benchmark(args).run())
+    except KeyboardInterrupt:
+        print("\nSimulation stopped by user")
+        raise SystemExit(1)
+
+    print_summary(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")